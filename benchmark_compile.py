@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+import argparse
+import sys
+import yaml
+import numpy as np
+import torch
+import torch.optim as optim
+
+from network.BEV_Unet import BEV_Unet
+from network.ptBEV import ptBEVnet
+from network.loss import panoptic_loss
+from dataloader.dataset import collate_fn_BEV,SemKITTI,SemKITTI_label_name,spherical_dataset
+from utils.configs import merge_configs
+from utils import common_utils
+
+#ignore weird np warning
+import warnings
+warnings.filterwarnings("ignore")
+
+def SemKITTI2train(label):
+    return label - 1 # uint8 trick
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def time_steps(my_model, loss_fn, optimizer, batches, device, visibility, train):
+    """Run one training (or inference) step per batch, returns the wall time of every step."""
+    time_list = []
+    for batch in batches:
+        vox_fea,vox_label,gt_center,gt_offset,grid,_,_,pt_fea = batch[:8]
+        vox_fea_ten = vox_fea.to(device)
+        pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).to(device) for i in pt_fea]
+        grid_ten = [torch.from_numpy(i[:,:2]).to(device) for i in grid]
+        label_tensor = SemKITTI2train(vox_label).type(torch.LongTensor).to(device)
+        gt_center_tensor = gt_center.to(device)
+        gt_offset_tensor = gt_offset.to(device)
+
+        synchronize(device)
+        start_time = time.time()
+        if train:
+            if visibility:
+                sem_prediction,center,offset = my_model(pt_fea_ten,grid_ten,vox_fea_ten)
+            else:
+                sem_prediction,center,offset = my_model(pt_fea_ten,grid_ten)
+            loss = loss_fn(sem_prediction,center,offset,label_tensor,gt_center_tensor,gt_offset_tensor)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        else:
+            with torch.no_grad():
+                if visibility:
+                    my_model(pt_fea_ten,grid_ten,vox_fea_ten)
+                else:
+                    my_model(pt_fea_ten,grid_ten)
+        synchronize(device)
+        time_list.append(time.time()-start_time)
+    return time_list
+
+def main(args):
+    with open(args.configs, 'r') as s:
+        new_args = yaml.safe_load(s)
+    args_dict = merge_configs(args,new_args)
+
+    data_path = args_dict['dataset']['path']
+    train_batch_size = args_dict['model']['train_batch_size']
+    compression_model = args_dict['dataset']['grid_size'][2]
+    grid_size = args_dict['dataset']['grid_size']
+    visibility = args_dict['model']['visibility']
+    if args_dict['model']['polar']:
+        fea_dim = 9
+        circular_padding = True
+    else:
+        fea_dim = 7
+        circular_padding = False
+    device = torch.device(args.device)
+
+    unique_label=np.asarray(sorted(list(SemKITTI_label_name.keys())))[1:] - 1
+
+    # prepare model in compile friendly mode, the eager run uses the same code path
+    my_BEV_model=BEV_Unet(n_class=len(unique_label), n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = circular_padding, use_vis_fea=visibility)
+    my_model = ptBEVnet(my_BEV_model, pt_model = 'pointnet', grid_size =  grid_size, fea_dim = fea_dim, max_pt_per_encode = 256,
+                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model,
+                            compile_friendly = True)
+    my_model.to(device)
+    if args.mode == 'train':
+        my_model.train()
+    else:
+        my_model.eval()
+    optimizer = optim.Adam(my_model.parameters())
+    loss_fn = panoptic_loss(center_loss_weight = args_dict['model']['center_loss_weight'], offset_loss_weight = args_dict['model']['offset_loss_weight'],\
+                            center_loss = args_dict['model']['center_loss'], offset_loss=args_dict['model']['offset_loss'], compile_friendly = True,\
+                            sparse = args_dict['model']['sparse_loss'])
+    loss_fn.to(device)
+
+    # load the benchmark batches once so that data loading is not timed
+    train_pt_dataset = SemKITTI(data_path + '/sequences/', imageset = 'train', return_ref = True, instance_pkl_path=args_dict['dataset']['instance_pkl_path'])
+    train_dataset=spherical_dataset(train_pt_dataset, args_dict['dataset'], grid_size = grid_size, ignore_label = 0)
+    train_dataset_loader = torch.utils.data.DataLoader(dataset = train_dataset,
+                                            batch_size = train_batch_size,
+                                            collate_fn = collate_fn_BEV,
+                                            shuffle = False,
+                                            num_workers = 4)
+    batches = []
+    for i_iter,batch in enumerate(train_dataset_loader):
+        if i_iter >= args.iters: break
+        batches.append(batch)
+    train = args.mode == 'train'
+
+    # eager
+    time_steps(my_model, loss_fn, optimizer, batches[:1], device, visibility, train)
+    eager_time = time_steps(my_model, loss_fn, optimizer, batches, device, visibility, train)
+
+    # compiled, the first pass over the batches includes compilation and recompilation for new shapes
+    common_utils.compile_module(my_model, args_dict['model']['compile_backend'])
+    common_utils.compile_module(loss_fn, args_dict['model']['compile_backend'])
+    warmup_time = time_steps(my_model, loss_fn, optimizer, batches, device, visibility, train)
+    compiled_time = time_steps(my_model, loss_fn, optimizer, batches, device, visibility, train)
+
+    print('%s step time over %d batches of %d scans on %s:' % (args.mode, len(batches), train_batch_size, device))
+    print('eager: %.4f seconds' % np.mean(eager_time))
+    print('compiled (%s): %.4f seconds, speedup %.2fx' % (args_dict['model']['compile_backend'], np.mean(compiled_time), np.mean(eager_time)/np.mean(compiled_time)))
+    print('compilation warm-up: %.1f seconds' % np.sum(warmup_time))
+
+if __name__ == '__main__':
+    # Benchmark settings
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-d', '--data_dir', default='data')
+    parser.add_argument('-c', '--configs', default='configs/SemanticKITTI_model/Panoptic-PolarNet.yaml')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--mode', default='train', choices=['train','inference'])
+    parser.add_argument('--iters', type=int, default=20)
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
@@ -23,6 +23,7 @@ class SemKITTI(data.Dataset):
         with open("semantic-kitti.yaml", 'r') as stream:
             semkittiyaml = yaml.safe_load(stream)
         self.learning_map = semkittiyaml['learning_map']
+        self.learning_map_inv = semkittiyaml['learning_map_inv']
         thing_class = semkittiyaml['thing_class']
         self.thing_list = [cl for cl, ignored in thing_class.items() if ignored]
         self.imageset = imageset
@@ -134,6 +135,10 @@ class voxel_dataset(data.Dataset):
         self.fixed_volume_space = fixed_volume_space
         self.max_volume_space = max_volume_space
         self.min_volume_space = min_volume_space
+        # drop the points outside of the fixed volume (nearest or ignore), see in_volume
+        self.cull_out_of_range = args['cull_out_of_range'] if fixed_volume_space else None
+        # merge the points of every sub-cell into one PointNet input point, see downsample_points
+        self.downsample_sub_cells = args['downsample_sub_cells']
 
         self.panoptic_proc = PanopticLabelGenerator(self.grid_size,sigma=args['gt_generator']['sigma'])
         if self.instance_aug:
@@ -178,6 +183,12 @@ class voxel_dataset(data.Dataset):
         if self.instance_aug:
             xyz,labels,insts,feat = self.inst_aug.instance_aug(xyz,labels.squeeze(),insts.squeeze(),feat)
 
+        if self.cull_out_of_range is not None:
+            point_xyz,point_labels,point_insts = xyz,labels,insts
+            in_range = in_volume(xyz,self.min_volume_space,self.max_volume_space,polar = False)
+            xyz,labels,insts = xyz[in_range],labels[in_range],insts[in_range]
+            if len(data) == 4: feat = feat[in_range]
+
         max_bound = np.percentile(xyz,100,axis = 0)
         min_bound = np.percentile(xyz,0,axis = 0)
         
@@ -239,10 +250,21 @@ class voxel_dataset(data.Dataset):
         elif len(data) == 4:
             return_fea = np.concatenate((return_xyz,feat),axis = 1)
         
+        if self.cull_out_of_range is not None:
+            point_grid_ind = culled_grid_ind(point_xyz,in_range,grid_ind,self.cull_out_of_range,min_bound,max_bound,intervals)
+            labels,insts = point_labels,point_insts
+        elif self.downsample_sub_cells is not None:
+            point_grid_ind = grid_ind
+
+        if self.downsample_sub_cells is not None:
+            grid_ind,return_fea = downsample_points(grid_ind,return_fea,self.grid_size,intervals,self.downsample_sub_cells)
+
         if self.return_test:
             data_tuple += (grid_ind,labels,insts,return_fea,index)
         else:
             data_tuple += (grid_ind,labels,insts,return_fea)
+        if self.cull_out_of_range is not None or self.downsample_sub_cells is not None:
+            data_tuple += (point_grid_ind,)
         return data_tuple
 
 # transformation between Cartesian coordinates and polar coordinates
@@ -257,7 +279,7 @@ def polar2cat(input_xyz_polar):
     return np.stack((x,y,input_xyz_polar[2]),axis=0)
 
 class spherical_dataset(data.Dataset):
-  def __init__(self, in_dataset, args, grid_size, ignore_label = 0, return_test = False, use_aug = False, fixed_volume_space= True, max_volume_space = [50,np.pi,1.5], min_volume_space = [3,-np.pi,-3]):
+  def __init__(self, in_dataset, args, grid_size, ignore_label = 0, return_test = False, use_aug = False, fixed_volume_space= True, max_volume_space = [50,np.pi,1.5], min_volume_space = [3,-np.pi,-3], tta = None):
         'Initialization'
         self.point_cloud_dataset = in_dataset
         self.grid_size = np.asarray(grid_size)
@@ -269,6 +291,12 @@ class spherical_dataset(data.Dataset):
         self.fixed_volume_space = fixed_volume_space
         self.max_volume_space = max_volume_space
         self.min_volume_space = min_volume_space
+        # drop the points outside of the fixed volume (nearest or ignore), see in_volume
+        self.cull_out_of_range = args['cull_out_of_range'] if fixed_volume_space else None
+        # merge the points of every sub-cell into one PointNet input point, see downsample_points
+        self.downsample_sub_cells = args['downsample_sub_cells']
+        # utils.tta.PolarTTA, the augmented copies are appended to the data tuple (see collate_fn_BEV)
+        self.tta = tta
 
         self.panoptic_proc = PanopticLabelGenerator(self.grid_size,sigma=args['gt_generator']['sigma'],polar=True)
         if self.instance_aug:
@@ -316,37 +344,24 @@ class spherical_dataset(data.Dataset):
             xyz,labels,insts,feat = self.inst_aug.instance_aug(xyz,labels.squeeze(),insts.squeeze(),feat)
             # t2 = time.time()
             # print("t:",t2-t1)
-        
-        # convert coordinate into polar coordinates
-        xyz_pol = cart2polar(xyz)
-        
-        max_bound_r = np.percentile(xyz_pol[:,0],100,axis = 0)
-        min_bound_r = np.percentile(xyz_pol[:,0],0,axis = 0)
-        max_bound = np.max(xyz_pol[:,1:],axis = 0)
-        min_bound = np.min(xyz_pol[:,1:],axis = 0)
-        max_bound = np.concatenate(([max_bound_r],max_bound))
-        min_bound = np.concatenate(([min_bound_r],min_bound))
-        if self.fixed_volume_space:
-            max_bound = np.asarray(self.max_volume_space)
-            min_bound = np.asarray(self.min_volume_space)
-
-        # get grid index
-        crop_range = max_bound - min_bound
-        cur_grid_size = self.grid_size
-        intervals = crop_range/(cur_grid_size-1)
 
-        if (intervals==0).any(): print("Zero interval!")
-        grid_ind = (np.floor((np.clip(xyz_pol,min_bound,max_bound)-min_bound)/intervals)).astype(np.int)
-
-        current_grid = grid_ind[:np.size(labels)]
+        if self.cull_out_of_range is not None:
+            point_xyz,point_labels,point_insts = xyz,labels,insts
+            in_range = in_volume(xyz,self.min_volume_space,self.max_volume_space)
+            xyz,labels,insts = xyz[in_range],labels[in_range],insts[in_range]
+            if len(data) == 4: feat = feat[in_range]
+        
+        # polar voxelization, point features and visibility feature
+        grid_ind,return_fea,distance_feature,min_bound,intervals = polar_voxelize(xyz,feat if len(data) == 4 else None,\
+            self.grid_size,self.max_volume_space,self.min_volume_space,self.fixed_volume_space)
 
         # process voxel position
-        voxel_position = np.zeros(self.grid_size,dtype = np.float32)
         dim_array = np.ones(len(self.grid_size)+1,int)
-        dim_array[0] = -1 
+        dim_array[0] = -1
         voxel_position = np.indices(self.grid_size)*intervals.reshape(dim_array) + min_bound.reshape(dim_array)
-        # voxel_position = polar2cat(voxel_position)
-        
+
+        current_grid = grid_ind[:np.size(labels)]
+
         # process labels
         processed_label = np.ones(self.grid_size,dtype = np.uint8)*self.ignore_label
         label_voxel_pair = np.concatenate([current_grid,labels],axis = 1)
@@ -375,37 +390,133 @@ class spherical_dataset(data.Dataset):
 
         center,center_points,offset = self.panoptic_proc(insts[mask],xyz[:np.size(labels)][mask[:,0]],processed_inst,voxel_position[:2,:,:,0],unique_label_dict,min_bound,intervals)
 
-        # prepare visiblity feature
-        # find max distance index in each angle,height pair
-        valid_label = np.zeros_like(processed_label,dtype=bool)
-        valid_label[current_grid[:,0],current_grid[:,1],current_grid[:,2]] = True
-        valid_label = valid_label[::-1]
-        max_distance_index = np.argmax(valid_label,axis=0)
-        max_distance = max_bound[0]-intervals[0]*(max_distance_index)
-        distance_feature = np.expand_dims(max_distance, axis=2)-np.transpose(voxel_position[0],(1,2,0))
-        distance_feature = np.transpose(distance_feature,(1,2,0))
-        # convert to boolean feature
-        distance_feature = (distance_feature>0)*-1.
-        distance_feature[current_grid[:,2],current_grid[:,0],current_grid[:,1]]=1.
-
         data_tuple = (distance_feature,processed_label,center,offset)
 
-        # center data on each voxel for PTnet
-        voxel_centers = (grid_ind.astype(np.float32) + 0.5)*intervals + min_bound
-        return_xyz = xyz_pol - voxel_centers
-        return_xyz = np.concatenate((return_xyz,xyz_pol,xyz[:,:2]),axis = 1)
+        if self.cull_out_of_range is not None:
+            point_grid_ind = culled_grid_ind(cart2polar(point_xyz),in_range,grid_ind,self.cull_out_of_range,min_bound,\
+                                             np.asarray(self.max_volume_space),intervals)
+            labels,insts = point_labels,point_insts
+        elif self.downsample_sub_cells is not None:
+            point_grid_ind = grid_ind
+
+        if self.downsample_sub_cells is not None:
+            grid_ind,return_fea = downsample_points(grid_ind,return_fea,self.grid_size,intervals,self.downsample_sub_cells)
 
-        if len(data) == 3:
-            return_fea = return_xyz
-        elif len(data) == 4:
-            return_fea = np.concatenate((return_xyz,feat),axis = 1)
-        
         if self.return_test:
             data_tuple += (grid_ind,labels,insts,return_fea,index)
         else:
             data_tuple += (grid_ind,labels,insts,return_fea)
+        if self.cull_out_of_range is not None or self.downsample_sub_cells is not None:
+            data_tuple += (point_grid_ind,)
+        if self.tta is not None:
+            data_tuple += (self.tta.augment(xyz,feat if len(data) == 4 else None),)
         return data_tuple
     
+def polar_voxelize(xyz, feat, grid_size, max_volume_space = [50,np.pi,1.5], min_volume_space = [3,-np.pi,-3], fixed_volume_space = True):
+    """Label free part of spherical_dataset: polar voxelization of a scan.
+
+    Arguments:
+        xyz: [P, 3] cartesian coordinates.
+        feat: [P, C] extra point features (e.g. remission) or None.
+        grid_size: [3] polar grid size (rho, phi, z).
+    Returns:
+        grid_ind: [P, 3] voxel index of every point.
+        return_fea: [P, 8 + C] point features of the PointNet.
+        distance_feature: [Z, rho, phi] visibility feature.
+        min_bound, intervals: [3] grid origin and voxel size.
+    """
+    grid_size = np.asarray(grid_size)
+    # convert coordinate into polar coordinates
+    xyz_pol = cart2polar(xyz)
+
+    if fixed_volume_space:
+        max_bound = np.asarray(max_volume_space)
+        min_bound = np.asarray(min_volume_space)
+    else:
+        max_bound_r = np.percentile(xyz_pol[:,0],100,axis = 0)
+        min_bound_r = np.percentile(xyz_pol[:,0],0,axis = 0)
+        max_bound = np.max(xyz_pol[:,1:],axis = 0)
+        min_bound = np.min(xyz_pol[:,1:],axis = 0)
+        max_bound = np.concatenate(([max_bound_r],max_bound))
+        min_bound = np.concatenate(([min_bound_r],min_bound))
+
+    # get grid index
+    crop_range = max_bound - min_bound
+    intervals = crop_range/(grid_size-1)
+
+    if (intervals==0).any(): print("Zero interval!")
+    grid_ind = (np.floor((np.clip(xyz_pol,min_bound,max_bound)-min_bound)/intervals)).astype(np.int)
+
+    # prepare visiblity feature
+    # find max distance index in each angle,height pair
+    max_rho_index = np.full(grid_size[1:],-1,dtype = np.int64)
+    np.maximum.at(max_rho_index,(grid_ind[:,1],grid_ind[:,2]),grid_ind[:,0])
+    max_distance_index = np.where(max_rho_index >= 0,grid_size[0]-1-max_rho_index,0)
+    max_distance = max_bound[0]-intervals[0]*(max_distance_index)
+    voxel_rho = np.arange(grid_size[0])*intervals[0] + min_bound[0]
+    # boolean feature, -1 in front of the farthest point of every angle,height pair
+    distance_feature = -(max_distance.T[:,np.newaxis,:] > voxel_rho[np.newaxis,:,np.newaxis]).astype(np.float64)
+    distance_feature[grid_ind[:,2],grid_ind[:,0],grid_ind[:,1]]=1.
+
+    # center data on each voxel for PTnet
+    voxel_centers = (grid_ind.astype(np.float32) + 0.5)*intervals + min_bound
+    return_xyz = xyz_pol - voxel_centers
+    return_xyz = np.concatenate((return_xyz,xyz_pol,xyz[:,:2]),axis = 1)
+
+    if feat is None:
+        return_fea = return_xyz
+    else:
+        return_fea = np.concatenate((return_xyz,feat),axis = 1)
+    return grid_ind,return_fea,distance_feature,min_bound,intervals
+
+def in_volume(xyz, min_volume_space, max_volume_space, polar = True):
+    """Mask of the points inside the volume bounds (polar or cartesian), the other points are culled before the
+    voxelization instead of being clipped into the border voxels."""
+    coords = cart2polar(xyz) if polar else xyz
+    return np.all((coords >= min_volume_space) & (coords <= max_volume_space),axis = 1)
+
+def culled_grid_ind(point_coords, in_range, grid_ind, mode, min_bound, max_bound, intervals):
+    """Voxel index of every loaded point after culling: the voxel index of the points in range, and for the culled
+    points the nearest voxel (mode 'nearest', the clipped index) or -1 (mode 'ignore', labelled void)."""
+    if mode == 'nearest':
+        return (np.floor((np.clip(point_coords,min_bound,max_bound)-min_bound)/intervals)).astype(np.int)
+    elif mode == 'ignore':
+        point_grid_ind = np.full((point_coords.shape[0],3),-1,dtype = grid_ind.dtype)
+        point_grid_ind[in_range] = grid_ind
+        return point_grid_ind
+    raise ValueError('unknown cull_out_of_range mode %s' % mode)
+
+def downsample_points(grid_ind, return_fea, grid_size, intervals, sub_cells):
+    """Merge the points of every sub-cell (every voxel split into sub_cells parts along each axis) into one point
+    with the mean features, before the PointNet. Dense near range regions shrink the most.
+
+    Arguments:
+        grid_ind: [P, 3] voxel index of every point.
+        return_fea: [P, C] point features, the first 3 are the position relative to the voxel center.
+        grid_size, intervals: [3] grid size and voxel size.
+        sub_cells: [3] number of sub-cells per voxel along every axis.
+    Returns:
+        grid_ind: [M, 3] voxel index of every merged point.
+        return_fea: [M, C] mean features of every merged point.
+    The merged points stay in the voxel of their points, so the labels of every point are restored from the voxel
+    index before the merge.
+    """
+    sub_cells = np.asarray(sub_cells)
+    sub_ind = np.clip(np.floor((return_fea[:,:3]/intervals + 0.5)*sub_cells),0,sub_cells-1).astype(np.int64)
+    key = np.ravel_multi_index(tuple((grid_ind*sub_cells + sub_ind).T),tuple(np.asarray(grid_size)*sub_cells))
+    # sort once, the points of a sub-cell are then contiguous
+    order = np.argsort(key)
+    key = key[order]
+    new_cell = np.concatenate(([True],key[1:] != key[:-1]))
+    start = np.flatnonzero(new_cell)
+    merged_fea = np.add.reduceat(return_fea[order],start,axis = 0)/np.diff(np.append(start,key.size))[:,np.newaxis]
+    return grid_ind[order[start]],merged_fea.astype(return_fea.dtype)
+
+def has_point_grid_ind(args):
+    """Whether the datasets append the voxel index of every loaded point to the data tuple (out of range culling or
+    input downsampling), the post-processing then uses it instead of grid_ind."""
+    return args['cull_out_of_range'] is not None or args['downsample_sub_cells'] is not None
+
 @nb.jit('u1[:,:,:](u1[:,:,:],i8[:,:])',nopython=True,cache=True,parallel = False)
 def nb_process_label(processed_label,sorted_label_voxel_pair):
     label_size = 256
@@ -443,23 +554,13 @@ def collate_fn_BEV(data):
     label2stack=np.stack([d[1] for d in data])
     center2stack=np.stack([d[2] for d in data])
     offset2stack=np.stack([d[3] for d in data])
-    grid_ind_stack = [d[4] for d in data]
-    point_label = [d[5] for d in data]
-    point_inst = [d[6] for d in data]
-    xyz = [d[7] for d in data]
-    return torch.from_numpy(data2stack),torch.from_numpy(label2stack),torch.from_numpy(center2stack),torch.from_numpy(offset2stack),grid_ind_stack,point_label,point_inst,xyz
+    # grid_ind, point labels, point instances, point features and the optional elements (index with return_test,
+    # point_grid_ind with cull_out_of_range or downsample_sub_cells, augmented copies with tta) as per scan lists
+    return (torch.from_numpy(data2stack),torch.from_numpy(label2stack),torch.from_numpy(center2stack),torch.from_numpy(offset2stack)) + \
+        tuple([d[i] for d in data] for i in range(4,len(data[0])))
 
-def collate_fn_BEV_test(data):    
-    data2stack=np.stack([d[0] for d in data]).astype(np.float32)
-    label2stack=np.stack([d[1] for d in data])
-    center2stack=np.stack([d[2] for d in data])
-    offset2stack=np.stack([d[3] for d in data])
-    grid_ind_stack = [d[4] for d in data]
-    point_label = [d[5] for d in data]
-    point_inst = [d[6] for d in data]
-    xyz = [d[7] for d in data]
-    index = [d[8] for d in data]
-    return torch.from_numpy(data2stack),torch.from_numpy(label2stack),torch.from_numpy(center2stack),torch.from_numpy(offset2stack),grid_ind_stack,point_label,point_inst,xyz,index
+# the optional elements are appended to the data tuple, the same collate function handles them
+collate_fn_BEV_test = collate_fn_BEV
 
 # load Semantic KITTI class info
 with open("semantic-kitti.yaml", 'r') as stream:
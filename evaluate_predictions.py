@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import io
+import argparse
+import sys
+import contextlib
+import yaml
+import numpy as np
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from utils.eval_pq import PanopticEval
+from utils.prediction_writer import read_archive_index
+
+#ignore weird np warning
+import warnings
+warnings.filterwarnings("ignore")
+
+def label_lut(learning_map):
+    lut = np.zeros(max(learning_map.keys())+1, dtype = np.uint32)
+    for label, train_label in learning_map.items():
+        lut[label] = train_label
+    return lut
+
+def new_evaluator(n_classes):
+    # PanopticEval prints its settings, once in the main process is enough
+    with contextlib.redirect_stdout(io.StringIO()):
+        return PanopticEval(n_classes, None, [0], min_points=50)
+
+def load_prediction(source, pred_format, learning_map_lut):
+    """Panoptic prediction of a scan in the training label space (semantic id in the lower 16 bits)."""
+    if pred_format == 'archive':
+        data_path, offset, count = source
+        panoptic = np.fromfile(data_path, dtype = np.uint32, count = count, offset = offset * 4)
+    else:
+        panoptic = np.fromfile(source, dtype = np.uint32)
+    if pred_format != 'train':
+        # original label format, written by test_pretrain.py
+        panoptic = (panoptic & 0xFFFF0000) | learning_map_lut[panoptic & 0xFFFF]
+    return panoptic
+
+def evaluate_scans(task):
+    """Score a chunk of scans of one sequence, returns (sequence, evaluator)."""
+    sequence, scans, pred_format, learning_map_lut, n_classes = task
+    evaluator = new_evaluator(n_classes)
+    for label_path, source in scans:
+        annotated_data = np.fromfile(label_path, dtype = np.uint32)
+        panoptic = load_prediction(source, pred_format, learning_map_lut)
+        if panoptic.size != annotated_data.size:
+            raise ValueError('%s: %d predicted points, %d labelled points' % (label_path, panoptic.size, annotated_data.size))
+        evaluator.addBatch(panoptic & 0xFFFF, panoptic, learning_map_lut[annotated_data & 0xFFFF], annotated_data)
+    return sequence, evaluator
+
+def find_scans(args, sequence):
+    """(ground truth label file, prediction source) of every predicted scan of a sequence."""
+    label_dir = os.path.join(args.data_dir, 'sequences', sequence, 'labels')
+    if args.format == 'archive':
+        index = read_archive_index(os.path.join(args.predictions, 'sequences', sequence))
+        predictions = {scan: index[scan] for scan in index}
+    else:
+        pred_dir = os.path.join(args.predictions, 'sequences', sequence, 'predictions')
+        predictions = {f[:-6]: os.path.join(pred_dir, f) for f in os.listdir(pred_dir) if f.endswith('.label')} if os.path.isdir(pred_dir) else {}
+    scans = sorted(f[:-6] for f in os.listdir(label_dir) if f.endswith('.label'))
+    missing = [scan for scan in scans if scan not in predictions]
+    if missing:
+        print('Sequence %s: %d of %d scans have no prediction and are skipped' % (sequence, len(missing), len(scans)))
+    return [(os.path.join(label_dir, scan + '.label'), predictions[scan]) for scan in scans if scan in predictions]
+
+def print_results(evaluator, class_names):
+    class_PQ, class_SQ, class_RQ, class_all_PQ, class_all_SQ, class_all_RQ = evaluator.getPQ()
+    miou,ious = evaluator.getSemIoU()
+    print('Per class PQ, SQ, RQ and IoU: ')
+    for class_name, class_pq, class_sq, class_rq, class_iou in zip(class_names[1:],class_all_PQ[1:],class_all_SQ[1:],class_all_RQ[1:],ious[1:]):
+        print('%15s : %6.2f%%  %6.2f%%  %6.2f%%  %6.2f%%' % (class_name, class_pq*100, class_sq*100, class_rq*100, class_iou*100))
+    print('PQ %.3f  SQ %.3f  RQ %.3f  miou %.3f' % (class_PQ*100, class_SQ*100, class_RQ*100, miou*100))
+
+def main(args):
+    with open(args.label_config, 'r') as s:
+        semkittiyaml = yaml.safe_load(s)
+    learning_map_lut = label_lut(semkittiyaml['learning_map'])
+    n_classes = len(semkittiyaml['learning_map_inv'])
+    class_names = [semkittiyaml['labels'][semkittiyaml['learning_map_inv'][i]] for i in range(n_classes)]
+    sequences = args.sequences if args.sequences else [str(i).zfill(2) for i in semkittiyaml['split'][args.split]]
+
+    # chunks of scans of the same sequence, merged per sequence and in total
+    tasks = []
+    for sequence in sequences:
+        scans = find_scans(args, sequence)
+        for i in range(0, len(scans), args.chunk_size):
+            tasks.append((sequence, scans[i:i+args.chunk_size], args.format, learning_map_lut, n_classes))
+
+    evaluator = PanopticEval(n_classes, None, [0], min_points=50)
+    sequence_evaluators = {sequence: new_evaluator(n_classes) for sequence in sequences}
+    with Pool(args.workers) as pool:
+        for sequence, part in tqdm(pool.imap_unordered(evaluate_scans, tasks), total=len(tasks)):
+            sequence_evaluators[sequence].merge(part)
+            evaluator.merge(part)
+
+    for sequence in sequences:
+        class_PQ, class_SQ, class_RQ, _, _, _ = sequence_evaluators[sequence].getPQ()
+        miou,_ = sequence_evaluators[sequence].getSemIoU()
+        print('Sequence %s: PQ %.3f  SQ %.3f  RQ %.3f  miou %.3f' % (sequence, class_PQ*100, class_SQ*100, class_RQ*100, miou*100))
+    print_results(evaluator, class_names)
+
+if __name__ == '__main__':
+    # Score saved predictions (test_pretrain.py output) against the ground truth labels
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-d', '--data_dir', default='data')
+    parser.add_argument('-p', '--predictions', default='out', help='output_path of test_pretrain.py')
+    parser.add_argument('-f', '--format', default='label', choices=['label','train','archive'],
+                        help='label: original label format, train: training label ids, archive: per sequence archives')
+    parser.add_argument('-s', '--sequences', nargs='*', default=None, help='defaults to the sequences of the split')
+    parser.add_argument('--split', default='valid', choices=['train','valid'])
+    parser.add_argument('--label_config', default='semantic-kitti.yaml')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk_size', type=int, default=50, help='scans per task')
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
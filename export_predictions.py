@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import argparse
+import sys
+from tqdm import tqdm
+
+from utils.prediction_writer import read_archive, read_archive_index
+
+def main(args):
+    sequences_dir = os.path.join(args.archive_path, 'sequences')
+    output_path = args.output_path if args.output_path is not None else args.archive_path
+    sequences = sorted(os.listdir(sequences_dir))
+    if args.sequences:
+        sequences = [s for s in sequences if s in args.sequences]
+    for sequence in sequences:
+        sequence_dir = os.path.join(sequences_dir, sequence)
+        num_scans = len(read_archive_index(sequence_dir))
+        if num_scans == 0: continue
+        save_dir = os.path.join(output_path, 'sequences', sequence, 'predictions')
+        os.makedirs(save_dir, exist_ok = True)
+        # labels in the archive are already in the original label format
+        for scan, labels in tqdm(read_archive(sequence_dir), total = num_scans, desc = sequence):
+            labels.tofile(os.path.join(save_dir, scan + '.label'))
+    print('Label files are saved in %s' % output_path)
+
+if __name__ == '__main__':
+    # Expand prediction archives (test_pretrain.py --output_format archive) to one label file per scan
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-i', '--archive_path', default='out', help='output_path of the archived test run')
+    parser.add_argument('-o', '--output_path', default=None, help='defaults to the archive path')
+    parser.add_argument('-s', '--sequences', nargs='*', default=None, help='only export these sequences')
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
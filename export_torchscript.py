@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import argparse
+import sys
+import yaml
+import numpy as np
+import torch
+
+from network.BEV_Unet import BEV_Unet
+from network.ptBEV import ptBEVnet
+from network.export import export_model
+from dataloader.dataset import SemKITTI_label_name
+from utils.configs import merge_configs
+
+def main(args):
+    with open(args.configs, 'r') as s:
+        new_args = yaml.safe_load(s)
+    args_dict = merge_configs(args,new_args)
+
+    pretrained_model = args_dict['model']['pretrained_model']
+    compression_model = args_dict['dataset']['grid_size'][2]
+    grid_size = args_dict['dataset']['grid_size']
+    visibility = args_dict['model']['visibility']
+    if args_dict['model']['polar']:
+        fea_dim = 9
+        circular_padding = True
+    else:
+        fea_dim = 7
+        circular_padding = False
+
+    with open("semantic-kitti.yaml", 'r') as stream:
+        semkittiyaml = yaml.safe_load(stream)
+    thing_list = [cl for cl, ignored in semkittiyaml['thing_class'].items() if ignored]
+    unique_label=np.asarray(sorted(list(SemKITTI_label_name.keys())))[1:] - 1
+
+    # prepare model
+    my_BEV_model=BEV_Unet(n_class=len(unique_label), n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = circular_padding, use_vis_fea=visibility)
+    my_model = ptBEVnet(my_BEV_model, pt_model = 'pointnet', grid_size =  grid_size, fea_dim = fea_dim, max_pt_per_encode = 256,
+                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model)
+    if os.path.exists(pretrained_model):
+        my_model.load_state_dict(torch.load(pretrained_model, map_location=torch.device('cpu')))
+    my_model.to(torch.device(args.device))
+
+    # script model and post-processing
+    scripted_model = export_model(my_model, thing_list, grid_size, visibility = visibility, polar = circular_padding,
+                                  threshold = args_dict['model']['post_proc']['threshold'], nms_kernel = args_dict['model']['post_proc']['nms_kernel'],
+                                  top_k = args_dict['model']['post_proc']['top_k'])
+    torch.jit.save(scripted_model, args.output)
+    print('Scripted model is saved in %s' % args.output)
+
+if __name__ == '__main__':
+    # Export settings
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-p', '--pretrained_model', default='pretrained_weight/Panoptic_SemKITTI_PolarNet.pt')
+    parser.add_argument('-c', '--configs', default='configs/SemanticKITTI_model/Panoptic-PolarNet.yaml')
+    parser.add_argument('-o', '--output', default='output/Panoptic_SemKITTI_scripted.pt')
+    parser.add_argument('--device', default='cuda')
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
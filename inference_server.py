@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import sys
+import json
+import queue
+from concurrent.futures import TimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import yaml
+import numpy as np
+
+from utils.configs import merge_configs
+from utils.streaming import StreamingInference, build_model
+from utils.micro_batcher import MicroBatcher
+
+#ignore weird np warning
+import warnings
+warnings.filterwarnings("ignore")
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """POST /infer: raw float32 [P, 4] scan (x, y, z, remission) in, uint32 [P] panoptic labels out (training label
+    ids in the lower 16 bits). GET /health and GET /metrics return JSON."""
+
+    def _reply(self, code, body, content_type = 'application/json', headers = {}):
+        if content_type == 'application/json':
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            alive = self.server.batcher.alive()
+            self._reply(200 if alive else 503, {'status': 'ok' if alive else 'stopped'})
+        elif self.path == '/metrics':
+            self._reply(200, {'batcher': self.server.batcher.stats(), 'frames': self.server.stream.num_frames,
+                              'batch_latency': {stage: {k: float(v) for k, v in stage_stats.items()}
+                                                for stage, stage_stats in self.server.stream.stats().items()}})
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/infer':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0 or length % 16:
+            self._reply(400, {'error': 'the body must be a float32 [P, 4] scan, got %d bytes' % length})
+            return
+        if length > self.server.max_request_points * 16:
+            self._reply(413, {'error': 'more than %d points' % self.server.max_request_points})
+            return
+        scan = np.frombuffer(self.rfile.read(length), dtype = np.float32).reshape(-1, 4)
+        if not np.isfinite(scan).all():
+            self._reply(400, {'error': 'the scan has NaN or infinite values'})
+            return
+        try:
+            future = self.server.batcher.submit(scan)
+        except queue.Full:
+            # backpressure, the client retries later
+            self._reply(503, {'error': 'queue full'}, headers = {'Retry-After': '1'})
+            return
+        try:
+            panoptic = future.result(timeout = self.server.request_timeout)
+        except TimeoutError:
+            self._reply(504, {'error': 'timeout'})
+            return
+        except Exception as exc:
+            self._reply(500, {'error': repr(exc)})
+            return
+        self._reply(200, panoptic.astype(np.uint32).tobytes(), content_type = 'application/octet-stream')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def main(args):
+    with open(args.configs, 'r') as s:
+        new_args = yaml.safe_load(s)
+    args_dict = merge_configs(args,new_args)
+    with open('semantic-kitti.yaml', 'r') as s:
+        semkittiyaml = yaml.safe_load(s)
+    thing_list = [cl for cl, ignored in semkittiyaml['thing_class'].items() if ignored]
+
+    # one model instance, every request goes through the micro-batcher
+    model = build_model(args_dict, args.device)
+    stream = StreamingInference(model, args_dict['dataset']['grid_size'], thing_list, args_dict['model']['post_proc'],
+                                visibility = args_dict['model']['visibility'], polar = args_dict['model']['polar'], device = args.device,
+                                max_batch_size = args.max_batch_size)
+    stream.warmup(args.warmup)
+    batcher = MicroBatcher(stream.infer_batch, max_batch_size = args.max_batch_size, max_delay = args.max_delay_ms / 1000.,
+                           queue_size = args.queue_size)
+
+    server = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    server.daemon_threads = True
+    server.stream = stream
+    server.batcher = batcher
+    server.request_timeout = args.request_timeout
+    server.max_request_points = args.max_request_points
+    server.verbose = args.verbose
+    print('Serving on http://%s:%d' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        print(stream.summary())
+
+if __name__ == '__main__':
+    # Local inference server, concurrent requests are run in micro-batches on one model instance
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-p', '--pretrained_model', default='pretrained_weight/Panoptic_SemKITTI_PolarNet.pt')
+    parser.add_argument('-c', '--configs', default='configs/SemanticKITTI_model/Panoptic-PolarNet.yaml')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch_size', type=int, default=4, help='most scans per forward')
+    parser.add_argument('--max_delay_ms', type=float, default=10., help='time a batch waits for more requests')
+    parser.add_argument('--queue_size', type=int, default=16, help='most waiting requests, further requests get 503')
+    parser.add_argument('--request_timeout', type=float, default=30., help='seconds before a request gets 504')
+    parser.add_argument('--max_request_points', type=int, default=500000)
+    parser.add_argument('--warmup', type=int, default=10, help='warmup batches')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
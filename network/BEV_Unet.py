@@ -1,23 +1,51 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import contextlib
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from dropblock import DropBlock2D
 
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    '''BatchNorm layers of module still normalize with the batch statistics, but do not update their running
+    statistics.'''
+    bn_layers = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    # momentum 0 keeps the running statistics and the batch counter is restored. track_running_stats stays on, a
+    # checkpoint recompute has to save the same tensors as the forward
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bn_layers]
+    for m in bn_layers:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(bn_layers, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+def checkpoint_block(block, *inputs):
+    '''Activation checkpointing of block. The recompute in the backward pass gives the same outputs, but does not
+    update the BatchNorm running statistics a second time.'''
+    if torch.compiler.is_compiling():
+        # the compiled backward recomputes the block without its buffer updates
+        return checkpoint(block, *inputs, use_reentrant=False)
+    return checkpoint(block, *inputs, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), frozen_batchnorm_stats(block)))
 
 class BEV_Unet(nn.Module):
 
-    def __init__(self,n_class,n_height,dilation = 1,group_conv=False,input_batch_norm = False,dropout = 0.,circular_padding = False, dropblock = True, use_vis_fea=False):
+    def __init__(self,n_class,n_height,dilation = 1,group_conv=False,input_batch_norm = False,dropout = 0.,circular_padding = False, dropblock = True, use_vis_fea=False,
+                 checkpoint_blocks = ()):
         super(BEV_Unet, self).__init__()
         self.n_class = n_class
         self.n_height = n_height
         if use_vis_fea:
-            self.network = UNet(n_class*n_height,2*n_height,dilation,group_conv,input_batch_norm,dropout,circular_padding,dropblock)
+            self.network = UNet(n_class*n_height,2*n_height,dilation,group_conv,input_batch_norm,dropout,circular_padding,dropblock,checkpoint_blocks)
         else:
-            self.network = UNet(n_class*n_height,n_height,dilation,group_conv,input_batch_norm,dropout,circular_padding,dropblock)
+            self.network = UNet(n_class*n_height,n_height,dilation,group_conv,input_batch_norm,dropout,circular_padding,dropblock,checkpoint_blocks)
 
     def forward(self, x):
         x,center,offset = self.network(x)
@@ -30,8 +58,14 @@ class BEV_Unet(nn.Module):
         return x,center,offset
     
 class UNet(nn.Module):
-    def __init__(self, n_class,n_height,dilation,group_conv,input_batch_norm, dropout,circular_padding,dropblock):
+    # blocks that can be recomputed in the backward pass instead of keeping their activations
+    CHECKPOINT_BLOCKS = ['inc','down1','down2','down3','down4','up1','up2','up3','up4','i_up4_center','i_up4_offset']
+
+    def __init__(self, n_class,n_height,dilation,group_conv,input_batch_norm, dropout,circular_padding,dropblock,checkpoint_blocks=()):
         super(UNet, self).__init__()
+        for block in checkpoint_blocks:
+            assert block in self.CHECKPOINT_BLOCKS, 'Unknown checkpoint block ' + block
+        self.checkpoint_blocks = list(checkpoint_blocks)
         # encoder
         self.inc = inconv(n_height, 64, dilation, input_batch_norm, circular_padding)
         self.down1 = down(64, 128, dilation, group_conv, circular_padding)
@@ -59,17 +93,24 @@ class UNet(nn.Module):
         self.i_outc_center = outconv(32, 1)
         self.i_outc_offset = outconv(32, 2)
 
+    def run_block(self, name, *inputs):
+        '''Run a block, with activation checkpointing if it is selected and gradients are required.'''
+        block = getattr(self, name)
+        if name in self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint_block(block, *inputs)
+        return block(*inputs)
+
     def forward(self, x):
-        x1 = self.inc(x)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
+        x1 = self.run_block('inc', x)
+        x2 = self.run_block('down1', x1)
+        x3 = self.run_block('down2', x2)
+        x4 = self.run_block('down3', x3)
+        x5 = self.run_block('down4', x4)
         # semantic
-        x = self.up1(x5, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        s_x = self.up4(x, x1)
+        x = self.run_block('up1', x5, x4)
+        x = self.run_block('up2', x, x3)
+        x = self.run_block('up3', x, x2)
+        s_x = self.run_block('up4', x, x1)
         s_x = self.outc(self.dropout(s_x))
         # instance
         # i_x = self.i_up1(x5, x4)
@@ -77,10 +118,10 @@ class UNet(nn.Module):
         # i_x = self.i_up3(i_x, x2)x
 
         # i_x = self.i_up4(i_x, x1)
-        i_x_center = self.i_up4_center(x, x1)
+        i_x_center = self.run_block('i_up4_center', x, x1)
         i_x_center = self.i_outc_center(self.dropout(i_x_center))
 
-        i_x_offset = self.i_up4_offset(x, x1)
+        i_x_offset = self.run_block('i_up4_offset', x, x1)
         i_x_offset = self.i_outc_offset(self.dropout(i_x_offset))
 
         return s_x, i_x_center, i_x_offset
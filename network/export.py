@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import copy
+from typing import List
+
+import torch
+import torch.nn as nn
+
+from .BEV_Unet import up
+from .instance_post_processing import get_panoptic_segmentation_points
+
+
+class ExportablePolarNet(nn.Module):
+    """TorchScript friendly inference wrapper of a trained ptBEVnet and its panoptic post-processing.
+
+    ptBEVnet.forward takes Python lists of per-scan tensors and may run farthest point sampling with numpy and
+    multiprocessing, which cannot be scripted. This wrapper shares the trained sub-modules but takes flat point
+    tensors with batch offsets, always uses random point selection and returns per-point panoptic labels.
+    The BEV UNet is traced (DropBlock is not scriptable), everything else is scripted.
+
+    Args:
+        model: trained ptBEVnet with pt_model 'pointnet'.
+        thing_list: A List of thing class id.
+        example_bev_input: A Tensor of shape [1, C, H, W], an example input of model.BEV_model used for tracing.
+        visibility: whether the visibility feature is fed to the UNet.
+        threshold, nms_kernel, top_k, polar: post-processing parameters, see get_panoptic_segmentation.
+    """
+    def __init__(self, model, thing_list, example_bev_input, visibility=True, threshold=0.1, nms_kernel=5, top_k=100,
+                 polar=False):
+        super(ExportablePolarNet, self).__init__()
+        assert model.pt_model == 'pointnet' and model.pt_pooling == 'max'
+        self.PPmodel = model.PPmodel
+        self.fea_compression = model.fea_compression if model.fea_compre else nn.Identity()
+        self.local_pool_op = model.local_pool_op if model.local_pool_op is not None else nn.Identity()
+        for module in model.BEV_model.modules():
+            if isinstance(module, up):
+                module.use_dropblock = False
+        self.BEV_model = torch.jit.trace(model.BEV_model, example_bev_input)
+
+        self.grid_size: List[int] = [int(i) for i in model.grid_size]
+        self.pt_fea_dim: int = model.pt_fea_dim
+        self.max_pt: int = model.max_pt
+        self.visibility: bool = bool(visibility)
+        self.thing_list: List[int] = [int(i) for i in thing_list]
+        self.threshold: float = float(threshold)
+        self.nms_kernel: int = int(nms_kernel)
+        self.top_k: int = int(top_k)
+        self.polar: bool = bool(polar)
+
+    def forward(self, pt_fea, pt_ind, batch_offsets, voxel_fea):
+        """
+        Arguments:
+            pt_fea: A float Tensor of shape [P, C], point features of all scans concatenated.
+            pt_ind: A long Tensor of shape [P, 3], voxel index of every point.
+            batch_offsets: A long Tensor of shape [N+1], scan n owns points batch_offsets[n]:batch_offsets[n+1].
+            voxel_fea: A float Tensor of shape [N, Z, H, W], visibility feature. Ignored if the model does not use
+                the visibility feature.
+        Returns:
+            A long Tensor of shape [P], panoptic label of every point.
+        """
+        height, width = self.grid_size[0], self.grid_size[1]
+        batch_size = batch_offsets.size(0) - 1
+        pt_num = pt_fea.size(0)
+
+        # flat BEV cell index of every point
+        batch_ind = torch.repeat_interleave(torch.arange(batch_size, device=pt_fea.device), batch_offsets[1:] - batch_offsets[:-1])
+        cell_ind = (batch_ind * height + pt_ind[:,0]) * width + pt_ind[:,1]
+
+        # shuffle the data and keep at most max_pt points per cell
+        shuffled_ind = torch.randperm(pt_num, device=pt_fea.device)
+        cat_pt_fea = pt_fea[shuffled_ind,:]
+        cell_ind = cell_ind[shuffled_ind]
+        unq, unq_inv, unq_cnt = torch.unique(cell_ind, return_inverse=True, return_counts=True)
+        sorted_inv, order = torch.sort(unq_inv, stable=True)
+        grp_start = torch.cumsum(unq_cnt, 0) - unq_cnt
+        grp_ind = torch.empty_like(order)
+        grp_ind[order] = torch.arange(pt_num, device=pt_fea.device) - grp_start[sorted_inv]
+        remain_ind = grp_ind < self.max_pt
+        cat_pt_fea = cat_pt_fea[remain_ind,:]
+        unq_inv = unq_inv[remain_ind]
+
+        # process feature and max pool it into BEV cells
+        processed_cat_pt_fea = self.PPmodel(cat_pt_fea)
+        pooled_data = torch.zeros((unq.size(0), processed_cat_pt_fea.size(1)), dtype=processed_cat_pt_fea.dtype, device=pt_fea.device)
+        pooled_data = pooled_data.scatter_reduce(0, unq_inv.unsqueeze(1).expand_as(processed_cat_pt_fea), processed_cat_pt_fea, 'amax', include_self=False)
+        processed_pooled_data = self.fea_compression(pooled_data)
+
+        # stuff pooled data into 4D tensor
+        out_data = torch.zeros((batch_size * height * width, self.pt_fea_dim), dtype=torch.float32, device=pt_fea.device)
+        out_data[unq] = processed_pooled_data
+        out_data = out_data.view(batch_size, height, width, self.pt_fea_dim).permute(0,3,1,2)
+        out_data = self.local_pool_op(out_data)
+        if self.visibility:
+            out_data = torch.cat((out_data, voxel_fea), 1)
+
+        # run through network
+        sem_prediction, center, offset = self.BEV_model(out_data)
+
+        # panoptic post-processing of the whole batch
+        panoptic, _, _ = get_panoptic_segmentation_points(sem_prediction, center, offset, pt_ind, batch_ind, self.thing_list,
+                                                          threshold=self.threshold, nms_kernel=self.nms_kernel,
+                                                          top_k=self.top_k, polar=self.polar)
+        return panoptic
+
+
+def flatten_batch(pt_fea, grid_ind):
+    """Convert the per-scan lists produced by collate_fn_BEV into the flat inputs of ExportablePolarNet."""
+    counts = torch.tensor([0] + [i.shape[0] for i in grid_ind], dtype=torch.long)
+    batch_offsets = torch.cumsum(counts, 0)
+    cat_pt_fea = torch.cat([torch.as_tensor(i, dtype=torch.float32) for i in pt_fea], dim=0)
+    cat_pt_ind = torch.cat([torch.as_tensor(i, dtype=torch.long) for i in grid_ind], dim=0)
+    return cat_pt_fea, cat_pt_ind, batch_offsets
+
+
+def export_model(model, thing_list, grid_size, visibility=True, threshold=0.1, nms_kernel=5, top_k=100, polar=False):
+    """Script a trained ptBEVnet together with its post-processing.
+
+    Returns:
+        A torch.jit.ScriptModule, see ExportablePolarNet.forward for its signature. The input model is not modified.
+    """
+    model = copy.deepcopy(model).eval()
+    device = next(model.parameters()).device
+    in_ch = model.pt_fea_dim + (grid_size[2] if visibility else 0)
+    example_bev_input = torch.zeros(1, in_ch, grid_size[0], grid_size[1], device=device)
+    with torch.no_grad():
+        wrapper = ExportablePolarNet(model, thing_list, example_bev_input, visibility=visibility, threshold=threshold,
+                                     nms_kernel=nms_kernel, top_k=top_k, polar=polar)
+    return torch.jit.script(wrapper.eval())
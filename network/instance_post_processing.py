@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+from typing import List, Optional
+
 import torch
 import torch.nn.functional as F
-import torch_scatter
 
 
-def find_instance_center(ctr_hmp, threshold=0.1, nms_kernel=5, top_k=None, polar=False):
+def find_instance_center(ctr_hmp, threshold: float = 0.1, nms_kernel: int = 5, top_k: Optional[int] = None,
+                         polar: bool = False):
     """
     Find the center points from the center heatmap.
     Arguments:
@@ -21,7 +23,7 @@ def find_instance_center(ctr_hmp, threshold=0.1, nms_kernel=5, top_k=None, polar
         raise ValueError('Only supports inference for batch size = 1')
 
     # thresholding, setting values below threshold to -1
-    ctr_hmp = F.threshold(ctr_hmp, threshold, -1)
+    ctr_hmp = F.threshold(ctr_hmp, threshold, -1.)
 
     # NMS
     if polar:
@@ -49,13 +51,21 @@ def find_instance_center(ctr_hmp, threshold=0.1, nms_kernel=5, top_k=None, polar
         return torch.nonzero(ctr_hmp > top_k_scores[-1])
 
 
-def group_pixels(ctr, offsets, polar=False):
+def group_pixels(ctr, offsets, polar: bool = False, thing_mask: Optional[torch.Tensor] = None,
+                 bucket_size: Optional[int] = None):
     """
     Gives each pixel in the image an instance id.
     Arguments:
         ctr: A Tensor of shape [K, 2] where K is the number of center points. The order of second dim is (y, x).
         offsets: A Tensor of shape [N, 2, H, W] of raw offset output, where N is the batch size,
             for consistent, we only support N=1. The order of second dim is (offset_y, offset_x).
+        polar: A Boolean, whether x is the angle axis that wraps around.
+        thing_mask: A bool Tensor of shape [1, H, W]. If provided, only these pixels are grouped, the others get
+            id 0.
+        bucket_size: An Integer. If provided, the centers are binned into buckets of about bucket_size pixels and
+            each pixel is only compared with the centers of its 3x3 neighbouring buckets. Pixels whose nearest
+            candidate is not guaranteed to be the nearest center are compared with all centers, so the result
+            does not change.
     Returns:
         A Tensor of shape [1, H, W] (to be gathered by distributed data parallel).
     """
@@ -72,25 +82,123 @@ def group_pixels(ctr, offsets, polar=False):
 
     ctr_loc = coord + offsets
     ctr_loc = ctr_loc.reshape((2, height * width)).transpose(1, 0)
+    if thing_mask is not None:
+        loc_ind = torch.nonzero(thing_mask.reshape(-1)).squeeze(1)
+        ctr_loc = ctr_loc[loc_ind]
+    else:
+        loc_ind = None
+
+    # finds center with minimum distance at each location
+    if bucket_size is None:
+        nearest = nearest_center(ctr, ctr_loc, width, polar)
+    else:
+        nearest = nearest_center_bucketed(ctr, ctr_loc, height, width, bucket_size, polar)
 
-    # ctr: [K, 2] -> [K, 1, 2]
-    # ctr_loc = [H*W, 2] -> [1, H*W, 2]
-    ctr = ctr.unsqueeze(1)
-    ctr_loc = ctr_loc.unsqueeze(0)
+    # offset by 1, to reserve id=0 for stuff
+    if loc_ind is None:
+        return nearest.reshape((1, height, width)) + 1
+    instance_id = torch.zeros(height * width, dtype=torch.long, device=offsets.device)
+    instance_id[loc_ind] = nearest + 1
+    return instance_id.reshape((1, height, width))
 
-    # distance: [K, H*W]
+
+def center_distance(ctr, ctr_loc, width: int, polar: bool):
+    """
+    Euclidean distance between center points and predicted center locations, broadcast over the leading dims.
+    Arguments:
+        ctr: A Tensor of shape [..., 2], center points (y, x).
+        ctr_loc: A Tensor of shape [..., 2], predicted center locations (y, x).
+        width: An Integer, size of the x axis.
+        polar: A Boolean, whether x is the angle axis that wraps around.
+    Returns:
+        A Tensor of the broadcast shape without the last dim.
+    """
     distance = ctr - ctr_loc
     if polar:
-        distance[:,:,0] = torch.add(torch.fmod(torch.add(distance[:,:,0],width/2),width),-width/2)
-    distance = torch.norm(distance, dim=-1)
+        # 2*pi is covered by the first width-1 angle bins (the last one only holds phi=pi, see utils.tta.PolarTTA),
+        # the angle difference wraps around at +-period/2
+        period = width - 1
+        distance = torch.stack((distance[..., 0], torch.remainder(distance[..., 1] + period / 2, period) - period / 2), dim=-1)
+    return torch.norm(distance, dim=-1)
 
-    # finds center with minimum distance at each location, offset by 1, to reserve id=0 for stuff
-    instance_id = torch.argmin(distance, dim=0).reshape((1, height, width)) + 1
-    return instance_id
+
+def nearest_center(ctr, ctr_loc, width: int, polar: bool = False):
+    """
+    Index of the nearest center of every predicted center location, compared with all centers.
+    Arguments:
+        ctr: A Tensor of shape [K, 2], center points (y, x).
+        ctr_loc: A Tensor of shape [M, 2], predicted center locations (y, x).
+    Returns:
+        A long Tensor of shape [M], ties are broken by the lowest center index.
+    """
+    # distance: [K, M]
+    distance = center_distance(ctr.unsqueeze(1), ctr_loc.unsqueeze(0), width, polar)
+    return torch.argmin(distance, dim=0)
 
 
-def get_instance_segmentation(sem_seg, ctr_hmp, offsets, thing_list, threshold=0.1, nms_kernel=5, top_k=None,
-                              thing_seg=None, polar=False):
+def nearest_center_bucketed(ctr, ctr_loc, height: int, width: int, bucket_size: int, polar: bool = False):
+    """
+    Same result as nearest_center, but every location is first compared with the centers in the 3x3 neighbouring
+    buckets of a coarse grid only. If the nearest candidate is closer than one bucket, no center outside the
+    neighbourhood can be closer, otherwise the location falls back to nearest_center.
+    """
+    num_ctr = ctr.size(0)
+    # the x buckets cover one angle period in polar mode (see center_distance)
+    period = width - 1 if polar else width
+    num_y = (height + bucket_size - 1) // bucket_size
+    num_x = (period + bucket_size - 1) // bucket_size
+    # buckets of equal size along each axis so that the x buckets also wrap around evenly in polar mode
+    size_y = height / num_y
+    size_x = period / num_x
+    # every center outside the neighbourhood is at least this far, minus a margin for float rounding
+    radius = min(size_y, size_x) - 1e-3
+    ctr_f = ctr.to(ctr_loc.dtype)
+
+    # padded table of the center indices in every bucket, -1 for empty slots
+    ctr_x = torch.remainder(ctr[:, 1], period) if polar else ctr[:, 1]
+    ctr_bucket = torch.div(ctr[:, 0] * num_y, height, rounding_mode='floor') * num_x + torch.div(ctr_x * num_x, period, rounding_mode='floor')
+    sorted_bucket, order = torch.sort(ctr_bucket, stable=True)
+    count = torch.bincount(ctr_bucket, minlength=num_y * num_x)
+    slot = torch.arange(num_ctr, device=ctr.device) - (torch.cumsum(count, 0) - count)[sorted_bucket]
+    table = torch.full((num_y * num_x, int(count.max())), -1, dtype=torch.long, device=ctr.device)
+    table[sorted_bucket, slot] = order
+
+    # bucket of every location, locations outside the grid go to the border buckets
+    loc_y = torch.clamp(torch.floor(ctr_loc[:, 0] / size_y).long(), 0, num_y - 1)
+    if polar:
+        loc_x = torch.floor(torch.remainder(ctr_loc[:, 1], period) / size_x).long()
+    else:
+        loc_x = torch.floor(ctr_loc[:, 1] / size_x).long()
+    loc_x = torch.clamp(loc_x, 0, num_x - 1)
+
+    # candidate centers from the 3x3 neighbouring buckets: [M, 9 * max bucket count]
+    shift = torch.arange(-1, 2, device=ctr.device)
+    nb_y = (loc_y.unsqueeze(1) + shift).unsqueeze(2).expand(-1, 3, 3)
+    nb_x = (loc_x.unsqueeze(1) + shift).unsqueeze(1).expand(-1, 3, 3)
+    if polar:
+        nb_x = torch.remainder(nb_x, num_x)
+    nb_valid = (nb_y >= 0) & (nb_y < num_y) & (nb_x >= 0) & (nb_x < num_x)
+    nb = torch.clamp(nb_y, 0, num_y - 1) * num_x + torch.clamp(nb_x, 0, num_x - 1)
+    cand = table[nb.reshape(-1, 9)]
+    cand = torch.where(nb_valid.reshape(-1, 9, 1), cand, torch.full_like(cand, -1)).reshape(cand.size(0), -1)
+
+    distance = center_distance(ctr_f[torch.clamp(cand, min=0)], ctr_loc.unsqueeze(1), width, polar)
+    distance = torch.where(cand >= 0, distance, torch.full_like(distance, float('inf')))
+    min_distance = torch.min(distance, dim=1)[0]
+    # lowest center index among the equally near candidates, as argmin over all centers
+    nearest = torch.where(distance == min_distance.unsqueeze(1), cand, torch.full_like(cand, num_ctr)).min(dim=1)[0]
+
+    # exact fallback
+    fallback = torch.nonzero(~(min_distance < radius)).squeeze(1)
+    if fallback.size(0) > 0:
+        nearest[fallback] = nearest_center(ctr, ctr_loc[fallback], width, polar)
+    return nearest
+
+
+def get_instance_segmentation(sem_seg, ctr_hmp, offsets, thing_list: List[int], threshold: float = 0.1,
+                              nms_kernel: int = 5, top_k: Optional[int] = None,
+                              thing_seg: Optional[torch.Tensor] = None, polar: bool = False,
+                              group_bucket_size: Optional[int] = None):
     """
     Post-processing for instance segmentation, gets class agnostic instance id map.
     Arguments:
@@ -103,8 +211,9 @@ def get_instance_segmentation(sem_seg, ctr_hmp, offsets, thing_list, threshold=0
         threshold: A Float, threshold applied to center heatmap score.
         nms_kernel: An Integer, NMS max pooling kernel size.
         top_k: An Integer, top k centers to keep.
-        thing_seg: A Tensor of shape [1, H, W, Z], predicted foreground mask, if not provided, inference from
-            semantic prediction.
+        thing_seg: A bool Tensor of shape [1, H, W, Z], predicted foreground mask, or a long Tensor of shape [V, 3],
+            index of the foreground voxels. If provided, only the BEV cells with a thing voxel in it are grouped.
+        group_bucket_size: An Integer, bucket size of the center grid used for grouping, see group_pixels.
     Returns:
         A Tensor of shape [1, H, W] (to be gathered by distributed data parallel).
         A Tensor of shape [1, K, 2] where K is the number of center points. The order of second dim is (y, x).
@@ -120,12 +229,23 @@ def get_instance_segmentation(sem_seg, ctr_hmp, offsets, thing_list, threshold=0
 
     ctr = find_instance_center(ctr_hmp, threshold=threshold, nms_kernel=nms_kernel, top_k=top_k, polar=polar)
     if ctr.size(0) == 0:
-        return torch.zeros_like(thing_seg[:,:,:,0]), ctr.unsqueeze(0)
-    ins_seg = group_pixels(ctr, offsets, polar=polar)
+        return torch.zeros_like(sem_seg[:,:,:,0]), ctr.unsqueeze(0)
+    if thing_seg is not None:
+        # cells without a thing voxel are not merged into instances (see merge_semantic_and_instance)
+        if thing_seg.dtype == torch.bool:
+            thing_mask = ((sem_seg <= max(thing_list)) & thing_seg).any(dim=3)
+        else:
+            thing_vox = thing_seg[sem_seg[0, thing_seg[:,0], thing_seg[:,1], thing_seg[:,2]] <= max(thing_list)]
+            thing_mask = torch.zeros_like(sem_seg[:,:,:,0], dtype=torch.bool)
+            thing_mask[0, thing_vox[:,0], thing_vox[:,1]] = True
+    else:
+        thing_mask = None
+    ins_seg = group_pixels(ctr, offsets, polar=polar, thing_mask=thing_mask, bucket_size=group_bucket_size)
     return ins_seg, ctr.unsqueeze(0)
 
 
-def merge_semantic_and_instance(sem_seg, sem, ins_seg, label_divisor, thing_list, void_label,thing_seg):
+def merge_semantic_and_instance(sem_seg, sem, ins_seg, label_divisor: int, thing_list: List[int], void_label: int,
+                                thing_seg):
     """
     Post-processing for panoptic segmentation, by merging semantic segmentation label and class agnostic
         instance segmentation label.
@@ -136,12 +256,16 @@ def merge_semantic_and_instance(sem_seg, sem, ins_seg, label_divisor, thing_list
         label_divisor: An Integer, used to convert panoptic id = semantic id * label_divisor + instance_id.
         thing_list: A List of thing class id.
         void_label: An Integer, indicates the region has no confident prediction.
-        thing_seg: A Tensor of shape [1, H, W, Z], predicted foreground mask.
+        thing_seg: A bool Tensor of shape [1, H, W, Z], predicted foreground mask, or a long Tensor of shape [V, 3],
+            index of the foreground voxels without duplicates. With the index list only these voxels are read.
     Returns:
         A Tensor of shape [1, H, W, Z] (to be gathered by distributed data parallel).
     Raises:
         ValueError, if batch size is not 1.
     """
+    if thing_seg.dtype != torch.bool:
+        return merge_semantic_and_instance_sparse(sem_seg, sem, ins_seg, label_divisor, thing_list, void_label, thing_seg)
+
     # In case thing mask does not align with semantic prediction
     # semantic_thing_seg = torch.zeros_like(sem_seg,dtype=torch.bool)
     # for thing_class in thing_list:
@@ -153,16 +277,43 @@ def merge_semantic_and_instance(sem_seg, sem, ins_seg, label_divisor, thing_list
     ins_seg = torch.unsqueeze(ins_seg,3).expand_as(sem_seg)
     thing_mask = (ins_seg > 0) & semantic_thing_seg & thing_seg
     if not torch.nonzero(thing_mask).size(0) == 0:
-        sem_sum = torch_scatter.scatter_add(sem.permute(0,2,3,4,1)[thing_mask],ins_seg[thing_mask],dim=0)
+        thing_ins = ins_seg[thing_mask]
+        sem_sum = torch.zeros((int(thing_ins.max())+1, sem.size(1)), dtype=sem.dtype, device=sem.device)
+        sem_sum.index_add_(0, thing_ins, sem.permute(0,2,3,4,1)[thing_mask])
         class_id = torch.argmax(sem_sum[:,:max(thing_list)],dim=1)
-        sem_seg[thing_mask] = (ins_seg[thing_mask] * label_divisor) + class_id[ins_seg[thing_mask]]+1
+        sem_seg[thing_mask] = (thing_ins * label_divisor) + class_id[thing_ins]+1
     else:
         sem_seg[semantic_thing_seg & thing_seg] = void_label
     return sem_seg
 
 
-def get_panoptic_segmentation(sem, ctr_hmp, offsets, thing_list, label_divisor=2**16, void_label=0,
-                              threshold=0.1, nms_kernel=5, top_k=100, foreground_mask=None, polar=False):
+def merge_semantic_and_instance_sparse(sem_seg, sem, ins_seg, label_divisor: int, thing_list: List[int],
+                                       void_label: int, vox_ind):
+    """
+    merge_semantic_and_instance on a list of foreground voxels, see merge_semantic_and_instance for the arguments.
+    vox_ind is a long Tensor of shape [V, 3], index of the foreground voxels without duplicates.
+    """
+    vox_sem_seg = sem_seg[0, vox_ind[:,0], vox_ind[:,1], vox_ind[:,2]]
+    vox_ins_seg = ins_seg[0, vox_ind[:,0], vox_ind[:,1]]
+    semantic_thing_seg = vox_sem_seg <= max(thing_list)
+    thing_mask = (vox_ins_seg > 0) & semantic_thing_seg
+    if not torch.nonzero(thing_mask).size(0) == 0:
+        thing_ins = vox_ins_seg[thing_mask]
+        thing_vox = vox_ind[thing_mask]
+        sem_sum = torch.zeros((int(thing_ins.max())+1, sem.size(1)), dtype=sem.dtype, device=sem.device)
+        sem_sum.index_add_(0, thing_ins, sem[0, :, thing_vox[:,0], thing_vox[:,1], thing_vox[:,2]].t())
+        class_id = torch.argmax(sem_sum[:,:max(thing_list)],dim=1)
+        vox_sem_seg[thing_mask] = (thing_ins * label_divisor) + class_id[thing_ins]+1
+    else:
+        vox_sem_seg[semantic_thing_seg] = void_label
+    sem_seg[0, vox_ind[:,0], vox_ind[:,1], vox_ind[:,2]] = vox_sem_seg
+    return sem_seg
+
+
+def get_panoptic_segmentation(sem, ctr_hmp, offsets, thing_list: List[int], label_divisor: int = 2**16,
+                              void_label: int = 0, threshold: float = 0.1, nms_kernel: int = 5, top_k: int = 100,
+                              foreground_mask: Optional[torch.Tensor] = None, polar: bool = False,
+                              group_bucket_size: Optional[int] = None):
     """
     Post-processing for panoptic segmentation.
     Arguments:
@@ -178,7 +329,10 @@ def get_panoptic_segmentation(sem, ctr_hmp, offsets, thing_list, label_divisor=2
         threshold: A Float, threshold applied to center heatmap score.
         nms_kernel: An Integer, NMS max pooling kernel size.
         top_k: An Integer, top k centers to keep.
-        foreground_mask: A processed Tensor of shape [N, H, W, Z], we only support N=1.
+        foreground_mask: A processed Tensor of shape [N, H, W, Z], we only support N=1. If not provided, every
+            voxel is treated as foreground. A long Tensor of shape [V, 3], index of the occupied voxels without
+            duplicates, is also accepted, then only those voxels are post-processed.
+        group_bucket_size: An Integer, bucket size of the center grid used for grouping, see group_pixels.
     Returns:
         A Tensor of shape [1, H, W, Z] (to be gathered by distributed data parallel), int64.
     Raises:
@@ -193,6 +347,17 @@ def get_panoptic_segmentation(sem, ctr_hmp, offsets, thing_list, label_divisor=2
     if offsets.size(0) != 1:
         raise ValueError('Only supports inference for batch size = 1')
     if foreground_mask is not None:
+        if foreground_mask.dtype != torch.bool:
+            if foreground_mask.dim() != 2:
+                raise ValueError('Foreground index with un-supported dimension: {}.'.format(foreground_mask.dim()))
+            # sparse foreground, only the occupied voxels are read by the voxel level post-processing
+            vox_ind = torch.cat((torch.zeros_like(foreground_mask[:,:1]), foreground_mask), dim=1)
+            panoptic, ctr, ctr_valid = get_panoptic_segmentation_batch(sem, ctr_hmp, offsets, thing_list, label_divisor=label_divisor,
+                                                                       void_label=void_label, threshold=threshold,
+                                                                       nms_kernel=nms_kernel, top_k=top_k,
+                                                                       foreground_mask=vox_ind, polar=polar,
+                                                                       group_bucket_size=group_bucket_size)
+            return panoptic, ctr[ctr_valid].unsqueeze(0)
         if foreground_mask.dim() != 4:
             raise ValueError('Foreground prediction with un-supported dimension: {}.'.format(sem.dim()))
 
@@ -200,12 +365,12 @@ def get_panoptic_segmentation(sem, ctr_hmp, offsets, thing_list, label_divisor=2
         semantic = torch.argmax(sem, dim=1)
         # shift back to original label idx 
         semantic = torch.add(semantic, 1)
-        sem = F.softmax(sem)
+        sem = F.softmax(sem, dim=1)
     else:
-        semantic = sem.type(torch.ByteTensor).cuda()
+        semantic = sem.to(torch.uint8)
         # shift back to original label idx 
-        semantic = torch.add(semantic, 1).type(torch.LongTensor).cuda()
-        one_hot = torch.zeros((sem.size(0),torch.max(semantic).item()+1,sem.size(1),sem.size(2),sem.size(3))).cuda()
+        semantic = torch.add(semantic, 1).long()
+        one_hot = torch.zeros((sem.size(0),int(torch.max(semantic))+1,sem.size(1),sem.size(2),sem.size(3)), device=sem.device)
         sem = one_hot.scatter_(1,torch.unsqueeze(semantic,1),1.)
         sem = sem[:,1:,:,:,:]
 
@@ -213,12 +378,273 @@ def get_panoptic_segmentation(sem, ctr_hmp, offsets, thing_list, label_divisor=2
     if foreground_mask is not None:
         thing_seg = foreground_mask
     else:
-        thing_seg = None
+        thing_seg = torch.ones_like(semantic, dtype=torch.bool)
 
     
     instance, center = get_instance_segmentation(semantic, ctr_hmp, offsets, thing_list,
                                                  threshold=threshold, nms_kernel=nms_kernel, top_k=top_k,
-                                                 thing_seg=thing_seg, polar=polar)
+                                                 thing_seg=thing_seg, polar=polar, group_bucket_size=group_bucket_size)
     panoptic = merge_semantic_and_instance(semantic, sem, instance, label_divisor, thing_list, void_label, thing_seg)
 
     return panoptic, center
+
+
+def find_instance_center_batch(ctr_hmp, threshold: float = 0.1, nms_kernel: int = 5, top_k: Optional[int] = None,
+                               polar: bool = False):
+    """
+    Batched find_instance_center, gives the same centers for every scan.
+    Arguments:
+        ctr_hmp: A Tensor of shape [N, 1, H, W] of raw center heatmap output, where N is the batch size.
+        threshold: A Float, threshold applied to center heatmap score.
+        nms_kernel: An Integer, NMS max pooling kernel size.
+        top_k: An Integer, top k centers to keep.
+    Returns:
+        A long Tensor of shape [N, K, 2] where K is the largest number of center points in a scan. The order of
+            last dim is (y, x), padded with -1.
+        A bool Tensor of shape [N, K], whether the center is valid.
+    """
+    batch_size = ctr_hmp.size(0)
+
+    # thresholding, setting values below threshold to -1
+    ctr_hmp = F.threshold(ctr_hmp, threshold, -1.)
+
+    # NMS
+    nms_padding = (nms_kernel - 1) // 2
+    if polar:
+        ctr_hmp_max_pooled = F.pad(ctr_hmp,(nms_padding,nms_padding,0,0),mode = 'circular')
+        ctr_hmp_max_pooled = F.max_pool2d(ctr_hmp_max_pooled, kernel_size=nms_kernel, stride=1, padding=(nms_padding,0))
+    else:
+        ctr_hmp_max_pooled = F.max_pool2d(ctr_hmp, kernel_size=nms_kernel, stride=1, padding=nms_padding)
+    ctr_hmp[ctr_hmp != ctr_hmp_max_pooled] = -1
+    ctr_hmp = ctr_hmp.squeeze(1)
+
+    # find non-zero elements
+    keep = ctr_hmp > 0
+    if top_k is not None:
+        # per scan top k, keeps the scores above the k-th score as find_instance_center does
+        flat_hmp = ctr_hmp.reshape(batch_size, -1)
+        num_ctr = keep.reshape(batch_size, -1).sum(1)
+        top_k_scores, _ = torch.topk(flat_hmp, min(top_k, flat_hmp.size(1)), dim=1)
+        keep = keep & ((num_ctr < top_k).view(-1, 1, 1) | (ctr_hmp > top_k_scores[:, -1].view(-1, 1, 1)))
+
+    # pad the centers of every scan, in the same order as torch.nonzero of a single scan
+    ctr_all = torch.nonzero(keep)
+    num_ctr = torch.bincount(ctr_all[:, 0], minlength=batch_size)
+    max_ctr = int(num_ctr.max()) if ctr_all.size(0) > 0 else 0
+    slot = torch.arange(ctr_all.size(0), device=ctr_all.device) - (torch.cumsum(num_ctr, 0) - num_ctr)[ctr_all[:, 0]]
+    ctr = torch.full((batch_size, max_ctr, 2), -1, dtype=torch.long, device=ctr_all.device)
+    ctr[ctr_all[:, 0], slot] = ctr_all[:, 1:]
+    ctr_valid = torch.arange(max_ctr, device=ctr_all.device).unsqueeze(0) < num_ctr.unsqueeze(1)
+    return ctr, ctr_valid
+
+
+def group_pixels_batch(ctr, ctr_valid, offsets, thing_mask: Optional[torch.Tensor] = None, polar: bool = False,
+                       bucket_size: Optional[int] = None):
+    """
+    Batched group_pixels, every pixel is compared with the centers of its own scan only.
+    Arguments:
+        ctr: A long Tensor of shape [N, K, 2], padded center points (y, x).
+        ctr_valid: A bool Tensor of shape [N, K], whether the center is valid.
+        offsets: A Tensor of shape [N, 2, H, W] of raw offset output. The order of second dim is (offset_y, offset_x).
+        thing_mask: A bool Tensor of shape [N, H, W]. If provided, only these pixels are grouped.
+        polar: A Boolean, whether x is the angle axis that wraps around.
+        bucket_size: An Integer, if provided, every scan is grouped with nearest_center_bucketed.
+    Returns:
+        A long Tensor of shape [N, H, W], 0 for pixels that are not grouped or scans without center.
+    """
+    batch_size, _, height, width = offsets.size()
+    instance_id = torch.zeros((batch_size, height, width), dtype=torch.long, device=offsets.device)
+    if ctr.size(1) == 0:
+        return instance_id
+
+    # generates a coordinate map, where each location is the coordinate of that loc
+    y_coord = torch.arange(height, dtype=offsets.dtype, device=offsets.device).repeat(1, width, 1).transpose(1, 2)
+    x_coord = torch.arange(width, dtype=offsets.dtype, device=offsets.device).repeat(1, height, 1)
+    coord = torch.cat((y_coord, x_coord), dim=0)
+    ctr_loc = coord.unsqueeze(0) + offsets
+
+    if thing_mask is None:
+        thing_mask = torch.ones((batch_size, height, width), dtype=torch.bool, device=offsets.device)
+    loc_ind = torch.nonzero(thing_mask)
+    batch_ind = loc_ind[:, 0]
+    ctr_loc = ctr_loc[batch_ind, :, loc_ind[:, 1], loc_ind[:, 2]]
+
+    if bucket_size is None:
+        # distance to the centers of the same scan: [M, K]
+        distance = center_distance(ctr[batch_ind], ctr_loc.unsqueeze(1), width, polar)
+        distance = distance.masked_fill(~ctr_valid[batch_ind], float('inf'))
+        nearest = torch.argmin(distance, dim=1)
+    else:
+        nearest = torch.zeros_like(batch_ind)
+        num_ctr = ctr_valid.sum(1)
+        for i_batch in range(batch_size):
+            scan_ind = torch.nonzero(batch_ind == i_batch).squeeze(1)
+            if scan_ind.size(0) > 0 and int(num_ctr[i_batch]) > 0:
+                nearest[scan_ind] = nearest_center_bucketed(ctr[i_batch, :int(num_ctr[i_batch])], ctr_loc[scan_ind], height,
+                                                            width, bucket_size, polar)
+    # offset by 1, to reserve id=0 for stuff
+    nearest = nearest + 1
+    instance_id[batch_ind, loc_ind[:, 1], loc_ind[:, 2]] = torch.where(ctr_valid[batch_ind, 0], nearest, torch.zeros_like(nearest))
+    return instance_id
+
+
+def get_panoptic_segmentation_batch(sem, ctr_hmp, offsets, thing_list: List[int], label_divisor: int = 2**16,
+                                    void_label: int = 0, threshold: float = 0.1, nms_kernel: int = 5, top_k: int = 100,
+                                    foreground_mask: Optional[torch.Tensor] = None, polar: bool = False,
+                                    group_bucket_size: Optional[int] = None):
+    """
+    Batched get_panoptic_segmentation, gives the same panoptic labels for every scan in one call.
+    Arguments:
+        sem: A Tensor of shape [N, C, H, W, Z] of raw semantic output, or [N, H, W, Z] of semantic labels.
+        ctr_hmp: A Tensor of shape [N, 1, H, W] of raw center heatmap output.
+        offsets: A Tensor of shape [N, 2, H, W] of raw offset output. The order of second dim is (offset_y, offset_x).
+        thing_list: A List of thing class id.
+        label_divisor: An Integer, used to convert panoptic id = instance_id * label_divisor + semantic_id.
+        void_label: An Integer, indicates the region has no confident prediction.
+        threshold: A Float, threshold applied to center heatmap score.
+        nms_kernel: An Integer, NMS max pooling kernel size.
+        top_k: An Integer, top k centers to keep per scan.
+        foreground_mask: A bool Tensor of shape [N, H, W, Z], or a long Tensor of shape [V, 4], (batch, y, x, z) index
+            of the foreground voxels without duplicates. If not provided, every voxel is treated as foreground.
+        group_bucket_size: An Integer, bucket size of the center grid used for grouping, see group_pixels.
+    Returns:
+        A Tensor of shape [N, H, W, Z], int64. Instance ids start from 1 in every scan.
+        A long Tensor of shape [N, K, 2], padded center points (y, x).
+        A bool Tensor of shape [N, K], whether the center is valid.
+    """
+    if sem.dim() != 5 and sem.dim() != 4:
+        raise ValueError('Semantic prediction with un-supported dimension: {}.'.format(sem.dim()))
+    if foreground_mask is not None:
+        if foreground_mask.dim() != (4 if foreground_mask.dtype == torch.bool else 2):
+            raise ValueError('Foreground prediction with un-supported dimension: {}.'.format(foreground_mask.dim()))
+
+    if foreground_mask is not None:
+        vox_ind = torch.nonzero(foreground_mask) if foreground_mask.dtype == torch.bool else foreground_mask
+    else:
+        vox_ind = torch.nonzero(torch.ones(sem.size(0), sem.size(-3), sem.size(-2), sem.size(-1), dtype=torch.bool, device=sem.device))
+
+    # only the foreground voxels are merged, the others keep their semantic label
+    if sem.dim() == 5:
+        semantic = torch.argmax(sem, dim=1)
+        vox_logits = sem.permute(0,2,3,4,1)[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2], vox_ind[:,3]]
+        thing_prob = F.softmax(vox_logits, dim=1)[:,:max(thing_list)]
+    else:
+        semantic = sem.long()
+        thing_prob = F.one_hot(semantic[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2], vox_ind[:,3]], int(torch.max(semantic)) + 1)
+        thing_prob = thing_prob[:,:max(thing_list)].float()
+    # shift back to original label idx
+    semantic = torch.add(semantic, 1)
+
+    vox_panoptic, ctr, ctr_valid = get_panoptic_segmentation_voxels(semantic[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2], vox_ind[:,3]],
+                                                                    thing_prob, vox_ind, ctr_hmp, offsets, thing_list,
+                                                                    label_divisor=label_divisor, void_label=void_label,
+                                                                    threshold=threshold, nms_kernel=nms_kernel, top_k=top_k,
+                                                                    polar=polar, group_bucket_size=group_bucket_size)
+    panoptic = semantic
+    panoptic[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2], vox_ind[:,3]] = vox_panoptic
+    return panoptic, ctr, ctr_valid
+
+
+def get_panoptic_segmentation_voxels(semantic, thing_prob, vox_ind, ctr_hmp, offsets, thing_list: List[int],
+                                     label_divisor: int = 2**16, void_label: int = 0, threshold: float = 0.1,
+                                     nms_kernel: int = 5, top_k: int = 100, polar: bool = False,
+                                     group_bucket_size: Optional[int] = None):
+    """
+    Panoptic labels of a list of foreground voxels of a batch, the voxel level core of the batched post-processing.
+    Arguments:
+        semantic: A long Tensor of shape [V], predicted semantic label of every voxel, shifted back to original
+            label idx.
+        thing_prob: A Tensor of shape [V, T], semantic probability of the first T = max(thing_list) classes.
+        vox_ind: A long Tensor of shape [V, 4], (batch, y, x, z) index of every voxel, without duplicates.
+        ctr_hmp: A Tensor of shape [N, 1, H, W] of raw center heatmap output.
+        offsets: A Tensor of shape [N, 2, H, W] of raw offset output. The order of second dim is (offset_y, offset_x).
+        thing_list, label_divisor, void_label, threshold, nms_kernel, top_k, polar, group_bucket_size:
+            see get_panoptic_segmentation_batch.
+    Returns:
+        A long Tensor of shape [V], panoptic label of every voxel.
+        A long Tensor of shape [N, K, 2], padded center points (y, x).
+        A bool Tensor of shape [N, K], whether the center is valid.
+    """
+    batch_size, _, height, width = ctr_hmp.size()
+    thing_vox = semantic <= max(thing_list)
+    thing_bev = torch.zeros((batch_size, height, width), dtype=torch.bool, device=vox_ind.device)
+    thing_bev[vox_ind[:,0][thing_vox], vox_ind[:,1][thing_vox], vox_ind[:,2][thing_vox]] = True
+
+    ctr, ctr_valid = find_instance_center_batch(ctr_hmp, threshold=threshold, nms_kernel=nms_kernel, top_k=top_k, polar=polar)
+    instance = group_pixels_batch(ctr, ctr_valid, offsets, thing_mask=thing_bev, polar=polar, bucket_size=group_bucket_size)
+    instance = instance[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2]]
+
+    # majority vote of the semantic probabilities inside every instance of every scan
+    thing_mask = (instance > 0) & thing_vox
+    thing_ins = instance[thing_mask]
+    ins_key = vox_ind[:,0][thing_mask] * (ctr.size(1) + 1) + thing_ins
+    sem_sum = torch.zeros((batch_size * (ctr.size(1) + 1), thing_prob.size(1)), dtype=thing_prob.dtype, device=thing_prob.device)
+    sem_sum.index_add_(0, ins_key, thing_prob[thing_mask])
+    class_id = torch.argmax(sem_sum, dim=1)
+
+    panoptic = semantic.clone()
+    # thing voxels of scans without any instance
+    panoptic[thing_vox & ~thing_mask] = void_label
+    panoptic[thing_mask] = (thing_ins * label_divisor) + class_id[ins_key] + 1
+    return panoptic, ctr, ctr_valid
+
+
+def occupied_voxels(pt_ind, batch_ind, grid_size: List[int]):
+    """
+    Unique occupied voxels of a batch of points.
+    Arguments:
+        pt_ind: A long Tensor of shape [P, 3], voxel index of every point, -1 for points without a voxel (culled).
+        batch_ind: A long Tensor of shape [P], scan of every point.
+        grid_size: voxel grid size [H, W, Z].
+    Returns:
+        A long Tensor of shape [V, 4], (batch, y, x, z) index of every occupied voxel, sorted.
+        A long Tensor of shape [P], occupied voxel of every point, -1 for points without a voxel.
+    """
+    height, width, depth = grid_size[0], grid_size[1], grid_size[2]
+    vox_key = ((batch_ind * height + pt_ind[:,0]) * width + pt_ind[:,1]) * depth + pt_ind[:,2]
+    vox_key = torch.where(pt_ind[:,0] >= 0, vox_key, torch.full_like(vox_key, -1))
+    vox_key, pt_inv = torch.unique(vox_key, return_inverse=True)
+    # the -1 key of the points without a voxel is the first one
+    num_void = int((vox_key[:1] < 0).sum())
+    vox_key = vox_key[num_void:]
+    pt_inv = pt_inv - num_void
+    vox_ind = torch.stack((vox_key // (height * width * depth), vox_key // (width * depth) % height,
+                           vox_key // depth % width, vox_key % depth), dim=1)
+    return vox_ind, pt_inv
+
+
+def get_panoptic_segmentation_points(sem, ctr_hmp, offsets, pt_ind, batch_ind, thing_list: List[int],
+                                     label_divisor: int = 2**16, void_label: int = 0, threshold: float = 0.1,
+                                     nms_kernel: int = 5, top_k: int = 100, polar: bool = False,
+                                     group_bucket_size: Optional[int] = None):
+    """
+    Point level panoptic post-processing of a batch. The semantic output is only read at the occupied voxels and
+    the result is a label per point instead of a dense volume, same as gathering the points from
+    get_panoptic_segmentation_batch with the occupied voxels as foreground.
+    Arguments:
+        sem: A Tensor of shape [N, C, H, W, Z] of raw semantic output.
+        ctr_hmp: A Tensor of shape [N, 1, H, W] of raw center heatmap output.
+        offsets: A Tensor of shape [N, 2, H, W] of raw offset output. The order of second dim is (offset_y, offset_x).
+        pt_ind: A long Tensor of shape [P, 3], voxel index of every point of the batch, -1 for points without a voxel
+            (culled out of range points), they are labelled void_label.
+        batch_ind: A long Tensor of shape [P], scan of every point.
+        thing_list, label_divisor, void_label, threshold, nms_kernel, top_k, polar, group_bucket_size:
+            see get_panoptic_segmentation_batch.
+    Returns:
+        A long Tensor of shape [P], panoptic label of every point.
+        A long Tensor of shape [N, K, 2], padded center points (y, x).
+        A bool Tensor of shape [N, K], whether the center is valid.
+    """
+    # the occupied voxel list is built once and used for grouping, voting and mapping back to the points
+    vox_ind, pt_inv = occupied_voxels(pt_ind, batch_ind, sem.size()[2:])
+    vox_logits = sem.permute(0,2,3,4,1)[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2], vox_ind[:,3]]
+    # shift back to original label idx
+    semantic = torch.argmax(vox_logits, dim=1) + 1
+    thing_prob = F.softmax(vox_logits, dim=1)[:,:max(thing_list)]
+    vox_panoptic, ctr, ctr_valid = get_panoptic_segmentation_voxels(semantic, thing_prob, vox_ind, ctr_hmp, offsets, thing_list,
+                                                                    label_divisor=label_divisor, void_label=void_label,
+                                                                    threshold=threshold, nms_kernel=nms_kernel, top_k=top_k,
+                                                                    polar=polar, group_bucket_size=group_bucket_size)
+    # the -1 voxel of the points without a voxel is the appended void label
+    vox_panoptic = torch.cat((vox_panoptic, vox_panoptic.new_full((1,), void_label)))
+    return vox_panoptic[pt_inv], ctr, ctr_valid
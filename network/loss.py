@@ -3,7 +3,7 @@
 
 import numpy as np
 import torch
-from .lovasz_losses import lovasz_softmax
+from .lovasz_losses import lovasz_softmax, lovasz_softmax_flat
 
 def _neg_loss(pred, gt):
     ''' Modified focal loss. Exactly the same as CornerNet.
@@ -34,7 +34,8 @@ class FocalLoss(torch.nn.Module):
         return self.neg_loss(out, target)
 
 class panoptic_loss(torch.nn.Module):
-    def __init__(self, ignore_label = 255, center_loss_weight = 100, offset_loss_weight = 1, center_loss = 'MSE', offset_loss = 'L1'):
+    def __init__(self, ignore_label = 255, center_loss_weight = 100, offset_loss_weight = 1, center_loss = 'MSE', offset_loss = 'L1',
+                 compile_friendly = False, sparse = False):
         super(panoptic_loss, self).__init__()
         self.CE_loss = torch.nn.CrossEntropyLoss(ignore_index=ignore_label)
         assert center_loss in ['MSE','FocalLoss']
@@ -51,44 +52,60 @@ class panoptic_loss(torch.nn.Module):
         else: raise NotImplementedError
         self.center_loss_weight = center_loss_weight
         self.offset_loss_weight = offset_loss_weight
+        self.compile_friendly = compile_friendly
+        self.ignore_label = ignore_label
+        self.sparse = sparse
 
         print('Using '+ center_loss +' for heatmap regression, weight: '+str(center_loss_weight))
         print('Using '+ offset_loss +' for offset regression, weight: '+str(offset_loss_weight))
 
-        self.lost_dict={'semantic_loss':[],
-                        'heatmap_loss':[],
-                        'offset_loss':[]}
+        self.loss_names = ['semantic_loss','heatmap_loss','offset_loss']
+        # running sums of the loss terms, kept on the device and only read back when logging.
+        # .item() or a growing Python list here would sync and break (or recompile) the graph every step
+        self.register_buffer('loss_sum', torch.zeros(len(self.loss_names)), persistent=False)
+        self.register_buffer('loss_count', torch.zeros(()), persistent=False)
 
     def reset_loss_dict(self):
-        self.lost_dict={'semantic_loss':[],
-                        'heatmap_loss':[],
-                        'offset_loss':[]}
+        self.loss_sum.zero_()
+        self.loss_count.zero_()
+
+    def get_loss_dict(self):
+        """Mean of every loss term since the last reset, a single device to host copy."""
+        mean_loss = (self.loss_sum / torch.clamp(self.loss_count, min=1)).tolist()
+        return dict(zip(self.loss_names, mean_loss))
+
+    def sparse_semantic_loss(self,prediction,gt_label):
+        '''Lovasz softmax + cross entropy computed on the labelled voxels only.
+        Same value as the dense version, without the softmax over the whole (mostly ignored) volume.
+        Arguments:
+            prediction (batch x c x h x w x l) logits
+            gt_label (batch x h x w x l)
+        '''
+        valid = gt_label != self.ignore_label
+        # gathered in the same order as flatten_probas so the loss is identical
+        valid_logits = prediction.permute(0,2,3,4,1)[valid]
+        valid_label = gt_label[valid]
+        valid_probas = torch.nn.functional.softmax(valid_logits, dim=1)
+        return lovasz_softmax_flat(valid_probas, valid_label, branch_free=self.compile_friendly) + \
+            torch.nn.functional.cross_entropy(valid_logits, valid_label)
 
     def forward(self,prediction,center,offset,gt_label,gt_center,gt_offset,save_loss = True):
         # semantic loss
-        loss = lovasz_softmax(torch.nn.functional.softmax(prediction), gt_label,ignore=255) + self.CE_loss(prediction,gt_label)
-        if save_loss:
-            self.lost_dict['semantic_loss'].append(loss.item())
+        if self.sparse:
+            semantic_loss = self.sparse_semantic_loss(prediction,gt_label)
+        else:
+            semantic_loss = lovasz_softmax(torch.nn.functional.softmax(prediction, dim=1), gt_label,ignore=255,branch_free=self.compile_friendly) + self.CE_loss(prediction,gt_label)
         # center heatmap loss
         center_mask = (gt_center>0) | (torch.min(torch.unsqueeze(gt_label, 1),dim=4)[0]<255)
         center_loss = self.center_loss_fn(center,gt_center) * center_mask
-        # safe division
-        if center_mask.sum() > 0:
-            center_loss = center_loss.sum() / center_mask.sum() * self.center_loss_weight
-        else:
-            center_loss = center_loss.sum() * 0
-        if save_loss:
-            self.lost_dict['heatmap_loss'].append(center_loss.item())
-        loss += center_loss
+        # safe division, the masked sum is 0 when the mask is empty
+        center_loss = center_loss.sum() / torch.clamp(center_mask.sum(), min=1) * self.center_loss_weight
         # offset loss
         offset_mask = gt_offset != 0
         offset_loss = self.offset_loss_fn(offset,gt_offset) * offset_mask
         # safe division
-        if offset_mask.sum() > 0:
-            offset_loss = offset_loss.sum() / offset_mask.sum() * self.offset_loss_weight
-        else:
-            offset_loss = offset_loss.sum() * 0
+        offset_loss = offset_loss.sum() / torch.clamp(offset_mask.sum(), min=1) * self.offset_loss_weight
         if save_loss:
-            self.lost_dict['offset_loss'].append(offset_loss.item())
-        loss += offset_loss
-        return loss
\ No newline at end of file
+            self.loss_sum += torch.stack((semantic_loss, center_loss, offset_loss)).detach()
+            self.loss_count += 1
+        return semantic_loss + center_loss + offset_loss
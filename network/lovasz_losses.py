@@ -24,9 +24,8 @@ def lovasz_grad(gt_sorted):
     intersection = gts - gt_sorted.float().cumsum(0)
     union = gts + (1 - gt_sorted).float().cumsum(0)
     jaccard = 1. - intersection / union
-    if p > 1: # cover 1-pixel case
-        jaccard[1:p] = jaccard[1:p] - jaccard[0:-1]
-    return jaccard
+    # no data-dependent branch for the 1-pixel case, keeps the graph static for torch.compile
+    return torch.cat((jaccard[:1], jaccard[1:p] - jaccard[0:-1]))
 
 
 def iou_binary(preds, labels, EMPTY=1., ignore=None, per_image=True):
@@ -149,7 +148,7 @@ def binary_xloss(logits, labels, ignore=None):
 # --------------------------- MULTICLASS LOSSES ---------------------------
 
 
-def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=None):
+def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=None, branch_free=False):
     """
     Multi-class Lovasz-Softmax loss
       probas: [B, C, H, W] Variable, class probabilities at each prediction (between 0 and 1).
@@ -158,22 +157,27 @@ def lovasz_softmax(probas, labels, classes='present', per_image=False, ignore=No
       classes: 'all' for all, 'present' for classes present in labels, or a list of classes to average.
       per_image: compute the loss per image instead of per batch
       ignore: void class labels
+      branch_free: see lovasz_softmax_flat
     """
     if per_image:
-        loss = mean(lovasz_softmax_flat(*flatten_probas(prob.unsqueeze(0), lab.unsqueeze(0), ignore), classes=classes)
+        loss = mean(lovasz_softmax_flat(*flatten_probas(prob.unsqueeze(0), lab.unsqueeze(0), ignore), classes=classes, branch_free=branch_free)
                           for prob, lab in zip(probas, labels))
     else:
-        loss = lovasz_softmax_flat(*flatten_probas(probas, labels, ignore), classes=classes)
+        loss = lovasz_softmax_flat(*flatten_probas(probas, labels, ignore), classes=classes, branch_free=branch_free)
     return loss
 
 
-def lovasz_softmax_flat(probas, labels, classes='present'):
+def lovasz_softmax_flat(probas, labels, classes='present', branch_free=False):
     """
     Multi-class Lovasz-Softmax loss
       probas: [P, C] Variable, class probabilities at each prediction (between 0 and 1)
       labels: [P] Tensor, ground truth labels (between 0 and C - 1)
       classes: 'all' for all, 'present' for classes present in labels, or a list of classes to average.
+      branch_free: with classes='present', compute every class and average with a presence mask instead of
+                   skipping absent classes on the host, so that torch.compile sees no data-dependent branch
     """
+    if branch_free and classes == 'present':
+        return lovasz_softmax_flat_masked(probas, labels)
     if probas.numel() == 0:
         # only void pixels, the gradients should be 0
         return probas * 0.
@@ -198,6 +202,22 @@ def lovasz_softmax_flat(probas, labels, classes='present'):
     return mean(losses)
 
 
+def lovasz_softmax_flat_masked(probas, labels):
+    """
+    Multi-class Lovasz-Softmax loss averaged over the classes present in labels, without host synchronization
+      probas: [P, C] Variable, class probabilities at each prediction (between 0 and 1)
+      labels: [P] Tensor, ground truth labels (between 0 and C - 1)
+    """
+    C = probas.size(1)
+    fg = (labels.unsqueeze(1) == torch.arange(C, device=labels.device)).float() # [P, C]
+    errors = (fg - probas).abs()
+    errors_sorted, perm = torch.sort(errors, 0, descending=True)
+    fg_sorted = torch.gather(fg, 0, perm)
+    losses = torch.stack([torch.dot(errors_sorted[:, c], lovasz_grad(fg_sorted[:, c])) for c in range(C)])
+    present = (fg.sum(0) > 0).float()
+    return (losses * present).sum() / torch.clamp(present.sum(), min=1.)
+
+
 def flatten_probas(probas, labels, ignore=None):
     """
     Flattens predictions in the batch
@@ -8,13 +8,18 @@ import numba as nb
 import multiprocessing
 import torch_scatter
 
+from .BEV_Unet import checkpoint_block
+
 class ptBEVnet(nn.Module):
     
     def __init__(self, BEV_net, grid_size, pt_model = 'pointnet', fea_dim = 3, pt_pooling = 'max', kernal_size = 3,
-                 out_pt_fea_dim = 64, max_pt_per_encode = 64, cluster_num = 4, pt_selection = 'farthest', fea_compre = None):
+                 out_pt_fea_dim = 64, max_pt_per_encode = 64, cluster_num = 4, pt_selection = 'farthest', fea_compre = None,
+                 compile_friendly = False, checkpoint_pointnet = False):
         super(ptBEVnet, self).__init__()
         assert pt_pooling in ['max']
         assert pt_selection in ['random','farthest']
+        # farthest point sampling runs on numpy in a process pool and cannot be captured by torch.compile
+        assert not (compile_friendly and pt_selection == 'farthest')
         
         if pt_model == 'pointnet':
             self.PPmodel = nn.Sequential(
@@ -42,6 +47,8 @@ class ptBEVnet(nn.Module):
         self.pt_selection = pt_selection
         self.fea_compre = fea_compre
         self.grid_size = grid_size
+        self.compile_friendly = compile_friendly
+        self.checkpoint_pointnet = checkpoint_pointnet
         
         # NN stuff
         if kernal_size != 1:
@@ -64,7 +71,7 @@ class ptBEVnet(nn.Module):
             self.pt_fea_dim = self.pool_dim
         
     def forward(self, pt_fea, xy_ind, voxel_fea=None):
-        cur_dev = pt_fea[0].get_device()
+        cur_dev = pt_fea[0].device
         
         # concate everything
         cat_pt_ind = []
@@ -86,7 +93,7 @@ class ptBEVnet(nn.Module):
         
         # subsample pts
         if self.pt_selection == 'random':
-            grp_ind = grp_range_torch(unq_cnt,cur_dev)[torch.argsort(torch.argsort(unq_inv))]
+            grp_ind = grp_range_torch(unq_cnt,cur_dev,pt_num)[torch.argsort(torch.argsort(unq_inv))]
             remain_ind = grp_ind < self.max_pt
         elif self.pt_selection == 'farthest':
             unq_ind = np.split(np.argsort(unq_inv.detach().cpu().numpy()), np.cumsum(unq_cnt.detach().cpu().numpy()[:-1]))
@@ -109,17 +116,32 @@ class ptBEVnet(nn.Module):
                     remain_ind[i_inds[FPS_results[count]]] = True
                     count += 1
             
-        cat_pt_fea = cat_pt_fea[remain_ind,:]
-        cat_pt_ind = cat_pt_ind[remain_ind,:]
-        unq_inv = unq_inv[remain_ind]
+        if not self.compile_friendly:
+            cat_pt_fea = cat_pt_fea[remain_ind,:]
+            cat_pt_ind = cat_pt_ind[remain_ind,:]
+            unq_inv = unq_inv[remain_ind]
         unq_cnt = torch.clamp(unq_cnt,max=self.max_pt)
         
         # process feature
         if self.pt_model == 'pointnet':
-            processed_cat_pt_fea = self.PPmodel(cat_pt_fea)
+            if self.checkpoint_pointnet and self.training and torch.is_grad_enabled():
+                # recompute the per point activations in the backward pass
+                processed_cat_pt_fea = checkpoint_block(self.PPmodel, cat_pt_fea)
+            else:
+                processed_cat_pt_fea = self.PPmodel(cat_pt_fea)
+        if self.compile_friendly:
+            # dropped points are masked out of the max pooling instead of removed, so the number of points fed to
+            # BatchNorm stays a static input size. Training BatchNorm statistics then also see the points beyond
+            # max_pt_per_encode in crowded cells; inference results are unchanged.
+            processed_cat_pt_fea = processed_cat_pt_fea.masked_fill(~remain_ind.unsqueeze(1), float('-inf'))
         
         if self.pt_pooling == 'max':
-            pooled_data = torch_scatter.scatter_max(processed_cat_pt_fea, unq_inv, dim=0)[0]
+            if self.compile_friendly:
+                # native op, torch_scatter kernels have no meta implementation for torch.compile
+                pooled_data = torch.zeros((unq.shape[0],processed_cat_pt_fea.shape[1]),dtype=processed_cat_pt_fea.dtype,device=cur_dev)
+                pooled_data = pooled_data.scatter_reduce(0,unq_inv.unsqueeze(1).expand_as(processed_cat_pt_fea),processed_cat_pt_fea,'amax',include_self=False)
+            else:
+                pooled_data = torch_scatter.scatter_max(processed_cat_pt_fea, unq_inv, dim=0)[0]
         else: raise NotImplementedError
         
         if self.fea_compre:
@@ -129,7 +151,7 @@ class ptBEVnet(nn.Module):
         
         # stuff pooled data into 4D tensor
         out_data_dim = [len(pt_fea),self.grid_size[0],self.grid_size[1],self.pt_fea_dim]
-        out_data = torch.zeros(out_data_dim, dtype=torch.float32).to(cur_dev)
+        out_data = torch.zeros(out_data_dim, dtype=torch.float32, device=cur_dev)
         out_data[unq[:,0],unq[:,1],unq[:,2],:] = processed_pooled_data
         out_data = out_data.permute(0,3,1,2)
         if self.local_pool_op != None:
@@ -142,9 +164,10 @@ class ptBEVnet(nn.Module):
        
         return sem_prediction, center, offset
     
-def grp_range_torch(a,dev):
+def grp_range_torch(a,dev,total=None):
     idx = torch.cumsum(a,0)
-    id_arr = torch.ones(idx[-1],dtype = torch.int64,device=dev)
+    # passing the known total avoids reading idx[-1] back from the device
+    id_arr = torch.ones(idx[-1] if total is None else total,dtype = torch.int64,device=dev)
     id_arr[0] = 0
     id_arr[idx[:-1]] = -a[:-1]+1
     return torch.cumsum(id_arr,0)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from .BEV_Unet import up
+
+# Linear + BatchNorm1d pairs inside ptBEVnet.PPmodel that can be folded before quantization
+PPMODEL_FUSE_PAIRS = [['1','2'],['4','5'],['7','8']]
+
+def quantize_pointnet_dynamic(model):
+    """Dynamic int8 quantization of the PointNet Linear layers of a ptBEVnet (in place).
+
+    Args:
+        model: ptBEVnet in eval mode.
+
+    Returns:
+        The same model with PPmodel and fea_compression replaced by their dynamically quantized versions.
+    """
+    assert not model.training, 'Quantization only supports models in eval mode'
+    if model.pt_model == 'pointnet':
+        pp_model = torch.ao.quantization.fuse_modules(model.PPmodel, PPMODEL_FUSE_PAIRS)
+        model.PPmodel = quantize_dynamic(pp_model, {nn.Linear}, dtype=torch.qint8)
+    if model.fea_compre:
+        model.fea_compression = quantize_dynamic(model.fea_compression, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+def prepare_static_quantization(model, example_input, backend='fbgemm'):
+    """Insert observers into the BEV UNet conv trunk of a ptBEVnet (in place).
+
+    DropBlock is an identity in eval mode but is not symbolically traceable, so it is
+    switched off before the trunk is traced.
+
+    Args:
+        model: ptBEVnet in eval mode.
+        example_input: A Tensor of shape [N, C, H, W], an example input of the UNet.
+        backend: Quantized engine, 'fbgemm' for x86 or 'qnnpack' for ARM.
+
+    Returns:
+        The same model, ready for calibration.
+    """
+    assert not model.training, 'Quantization only supports models in eval mode'
+    torch.backends.quantized.engine = backend
+    for module in model.BEV_model.network.modules():
+        if isinstance(module, up):
+            module.use_dropblock = False
+    model.BEV_model.network = prepare_fx(model.BEV_model.network, get_default_qconfig_mapping(backend), (example_input,))
+    return model
+
+def convert_static_quantization(model):
+    """Convert a calibrated BEV UNet conv trunk of a ptBEVnet to int8 (in place)."""
+    model.BEV_model.network = convert_fx(model.BEV_model.network)
+    return model
+
+def calibrate(model, data_loader, num_batches, visibility=True):
+    """Run calibration forward passes over the first num_batches batches of data_loader on CPU."""
+    with torch.no_grad():
+        for i_iter,batch in enumerate(data_loader):
+            vox_fea,_,_,_,grid,_,_,pt_fea = batch[:8]
+            if i_iter >= num_batches:
+                break
+            pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor) for i in pt_fea]
+            grid_ten = [torch.from_numpy(i[:,:2]) for i in grid]
+            if visibility:
+                model(pt_fea_ten,grid_ten,vox_fea)
+            else:
+                model(pt_fea_ten,grid_ten)
+    return model
+
+def quantize_model(model, data_loader, num_batches, grid_size, visibility=True, backend='fbgemm'):
+    """Post-training quantization of a float ptBEVnet for CPU inference.
+
+    The conv trunk of the BEV UNet is statically quantized with observers calibrated on
+    data_loader, the PointNet Linear layers are dynamically quantized.
+
+    Args:
+        model: float ptBEVnet, it is not modified.
+        data_loader: calibration DataLoader, usually SemKITTI val scans with collate_fn_BEV.
+        num_batches: number of calibration batches.
+        grid_size: voxel grid size [H, W, Z].
+        visibility: whether the visibility feature is fed to the UNet.
+        backend: Quantized engine, 'fbgemm' for x86 or 'qnnpack' for ARM.
+
+    Returns:
+        A quantized copy of the model on CPU.
+    """
+    q_model = copy.deepcopy(model).cpu().eval()
+    in_ch = q_model.pt_fea_dim + (grid_size[2] if visibility else 0)
+    example_input = torch.zeros(1,in_ch,grid_size[0],grid_size[1])
+    prepare_static_quantization(q_model, example_input, backend)
+    calibrate(q_model, data_loader, num_batches, visibility)
+    convert_static_quantization(q_model)
+    quantize_pointnet_dynamic(q_model)
+    return q_model
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import argparse
+import sys
+import yaml
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from network.BEV_Unet import BEV_Unet
+from network.ptBEV import ptBEVnet
+from network.instance_post_processing import get_panoptic_segmentation_points
+from network.quantization import quantize_model
+from dataloader.dataset import collate_fn_BEV,SemKITTI,SemKITTI_label_name,spherical_dataset
+from utils.eval_pq import PanopticEval
+from utils.configs import merge_configs
+from utils import common_utils
+
+#ignore weird np warning
+import warnings
+warnings.filterwarnings("ignore")
+
+def evaluate(model, data_loader, thing_list, post_proc, n_classes, visibility, polar, grid_size, num_batches=None):
+    """Score a model on CPU with PanopticEval, returns the evaluator and the mean forward time per batch."""
+    evaluator = PanopticEval(n_classes, None, [0], min_points=50)
+    time_list = []
+    pbar = tqdm(total=len(data_loader) if num_batches is None else min(num_batches,len(data_loader)))
+    with torch.no_grad():
+        for i_iter,batch in enumerate(data_loader):
+            vox_fea,_,_,_,grid,pt_labels,pt_ints,pt_fea = batch[:8]
+            if num_batches is not None and i_iter >= num_batches:
+                break
+            pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor) for i in pt_fea]
+            grid_ten = [torch.from_numpy(i[:,:2]) for i in grid]
+
+            start_time = time.time()
+            if visibility:
+                predict_labels,center,offset = model(pt_fea_ten,grid_ten,vox_fea)
+            else:
+                predict_labels,center,offset = model(pt_fea_ten,grid_ten)
+            time_list.append(time.time()-start_time)
+
+            # post processing
+            # with out of range culling, the voxel index of every loaded point is the last element
+            pt_ind,batch_ind,split = common_utils.flatten_grid_ind(batch[8] if len(batch) > 8 else grid)
+            panoptic_labels,_,_ = get_panoptic_segmentation_points(predict_labels,center,offset,pt_ind,batch_ind,thing_list,\
+                                                                   threshold=post_proc['threshold'], nms_kernel=post_proc['nms_kernel'],\
+                                                                   top_k=post_proc['top_k'], polar=polar,\
+                                                                   group_bucket_size=post_proc['group_bucket_size'])
+            panoptic_labels = np.split(panoptic_labels.numpy().astype(np.uint32), split)
+            for count,panoptic in enumerate(panoptic_labels):
+                evaluator.addBatch(panoptic & 0xFFFF,panoptic,np.squeeze(pt_labels[count]),np.squeeze(pt_ints[count]))
+            pbar.update(1)
+    pbar.close()
+    return evaluator, np.mean(time_list)
+
+def report_quantization_delta(float_evaluator, quant_evaluator, unique_label_str):
+    """Print per-class and overall PQ/mIoU of the float and int8 models and their difference."""
+    f_PQ, _, _, f_all_PQ, _, _ = float_evaluator.getPQ()
+    q_PQ, _, _, q_all_PQ, _, _ = quant_evaluator.getPQ()
+    f_miou, f_ious = float_evaluator.getSemIoU()
+    q_miou, q_ious = quant_evaluator.getSemIoU()
+    print('Per class PQ and IoU delta (int8 - float): ')
+    for class_name, f_pq, q_pq, f_iou, q_iou in zip(unique_label_str,f_all_PQ[1:],q_all_PQ[1:],f_ious[1:],q_ious[1:]):
+        print('%15s : %+6.2f%%  %+6.2f%%' % (class_name, (q_pq-f_pq)*100, (q_iou-f_iou)*100))
+    print('float PQ %.3f, int8 PQ %.3f, delta %+.3f' % (f_PQ*100, q_PQ*100, (q_PQ-f_PQ)*100))
+    print('float miou %.3f, int8 miou %.3f, delta %+.3f' % (f_miou*100, q_miou*100, (q_miou-f_miou)*100))
+
+def main(args):
+    with open(args.configs, 'r') as s:
+        new_args = yaml.safe_load(s)
+    args_dict = merge_configs(args,new_args)
+
+    data_path = args_dict['dataset']['path']
+    val_batch_size = args_dict['model']['val_batch_size']
+    pretrained_model = args_dict['model']['pretrained_model']
+    compression_model = args_dict['dataset']['grid_size'][2]
+    grid_size = args_dict['dataset']['grid_size']
+    visibility = args_dict['model']['visibility']
+    quant_args = args_dict['model']['quantization']
+    if args_dict['model']['polar']:
+        fea_dim = 9
+        circular_padding = True
+    else:
+        fea_dim = 7
+        circular_padding = False
+
+    # prepare miou fun
+    unique_label=np.asarray(sorted(list(SemKITTI_label_name.keys())))[1:] - 1
+    unique_label_str=[SemKITTI_label_name[x] for x in unique_label+1]
+
+    # prepare float model on CPU
+    my_BEV_model=BEV_Unet(n_class=len(unique_label), n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = circular_padding, use_vis_fea=visibility)
+    my_model = ptBEVnet(my_BEV_model, pt_model = 'pointnet', grid_size =  grid_size, fea_dim = fea_dim, max_pt_per_encode = 256,
+                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model)
+    if os.path.exists(pretrained_model):
+        my_model.load_state_dict(torch.load(pretrained_model, map_location=torch.device('cpu')))
+    my_model.eval()
+
+    # prepare dataset
+    val_pt_dataset = SemKITTI(data_path + '/sequences/', imageset = 'val', return_ref = True, instance_pkl_path=args_dict['dataset']['instance_pkl_path'])
+    if args_dict['model']['polar']:
+        val_dataset=spherical_dataset(val_pt_dataset, args_dict['dataset'], grid_size = grid_size, ignore_label = 0)
+    val_dataset_loader = torch.utils.data.DataLoader(dataset = val_dataset,
+                                            batch_size = val_batch_size,
+                                            collate_fn = collate_fn_BEV,
+                                            shuffle = False,
+                                            num_workers = 4)
+
+    # quantize
+    print('Calibrating on %d validation batches' % quant_args['calibration_batches'])
+    quant_model = quantize_model(my_model, val_dataset_loader, quant_args['calibration_batches'], grid_size,
+                                 visibility = visibility, backend = quant_args['backend'])
+    torch.save(quant_model, quant_args['quantized_model_path'])
+    print('Quantized model is saved in %s' % quant_args['quantized_model_path'])
+
+    # evaluate both models
+    if args.eval:
+        num_batches = quant_args['eval_batches']
+        evaluate_args = (val_pt_dataset.thing_list, args_dict['model']['post_proc'], len(unique_label)+1, visibility, circular_padding, grid_size, num_batches)
+        print('Evaluate float model')
+        float_evaluator, float_time = evaluate(my_model, val_dataset_loader, *evaluate_args)
+        print('Evaluate int8 model')
+        quant_evaluator, quant_time = evaluate(quant_model, val_dataset_loader, *evaluate_args)
+        report_quantization_delta(float_evaluator, quant_evaluator, unique_label_str)
+        print('Inference time per %d is %.4f seconds (float) and %.4f seconds (int8)' %
+            (val_batch_size, float_time, quant_time))
+
+if __name__ == '__main__':
+    # Quantization settings
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-d', '--data_dir', default='data')
+    parser.add_argument('-p', '--pretrained_model', default='pretrained_weight/Panoptic_SemKITTI_PolarNet.pt')
+    parser.add_argument('-c', '--configs', default='configs/SemanticKITTI_model/Panoptic-PolarNet.yaml')
+    parser.add_argument('--eval', default=True)
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
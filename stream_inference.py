@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import argparse
+import sys
+import queue
+import threading
+import time
+import yaml
+import numpy as np
+
+from utils.configs import merge_configs
+from utils.streaming import StreamingInference, build_model
+from utils.prediction_writer import PredictionWriter
+
+#ignore weird np warning
+import warnings
+warnings.filterwarnings("ignore")
+
+def replay(scan_paths, scan_queue, rate):
+    """Put the scans of a recorded sequence into scan_queue, at rate scans per second (0: as fast as possible)."""
+    start = time.perf_counter()
+    for i, scan_path in enumerate(scan_paths):
+        if rate > 0:
+            time.sleep(max(start + i / rate - time.perf_counter(), 0))
+        scan_queue.put(np.fromfile(scan_path, dtype=np.float32).reshape((-1, 4)))
+    scan_queue.put(None)
+
+def main(args):
+    with open(args.configs, 'r') as s:
+        new_args = yaml.safe_load(s)
+    args_dict = merge_configs(args,new_args)
+    with open('semantic-kitti.yaml', 'r') as s:
+        semkittiyaml = yaml.safe_load(s)
+    thing_list = [cl for cl, ignored in semkittiyaml['thing_class'].items() if ignored]
+
+    model = build_model(args_dict, args.device)
+    stream = StreamingInference(model, args_dict['dataset']['grid_size'], thing_list, args_dict['model']['post_proc'],
+                                visibility = args_dict['model']['visibility'], polar = args_dict['model']['polar'], device = args.device,
+                                reuse_tolerance = args.reuse_tolerance, reuse_max_frames = args.reuse_max_frames)
+    stream.warmup(args.warmup)
+
+    scan_dir = os.path.join(args_dict['dataset']['path'], 'sequences', args.sequence, 'velodyne')
+    scan_paths = sorted(os.path.join(scan_dir, f) for f in os.listdir(scan_dir) if f.endswith('.bin'))
+    writer = PredictionWriter(args.output_path, semkittiyaml['learning_map_inv'], skip_existing = False) if args.output_path else None
+
+    # the scans arrive from a reader thread, as from a sensor driver
+    scan_queue = queue.Queue(maxsize = 2)
+    reader = threading.Thread(target = replay, args = (scan_paths, scan_queue, args.rate), daemon = True)
+    reader.start()
+    for scan_path, panoptic in zip(scan_paths, stream.run(scan_queue)):
+        if writer is not None:
+            writer.write(scan_path, panoptic)
+    reader.join()
+    print(stream.summary())
+
+if __name__ == '__main__':
+    # Streaming inference over a recorded sequence, one scan at a time
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('-d', '--data_dir', default='data')
+    parser.add_argument('-p', '--pretrained_model', default='pretrained_weight/Panoptic_SemKITTI_PolarNet.pt')
+    parser.add_argument('-c', '--configs', default='configs/SemanticKITTI_model/Panoptic-PolarNet.yaml')
+    parser.add_argument('-s', '--sequence', default='08')
+    parser.add_argument('-o', '--output_path', default=None, help='write the predictions in the original label format')
+    parser.add_argument('--rate', type=float, default=10., help='scans per second of the replay, 0 for as fast as possible')
+    parser.add_argument('--warmup', type=int, default=10, help='warmup frames')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--reuse_tolerance', type=float, default=None,
+                        help='reuse the previous outputs when at most this fraction of the occupied BEV cells changed (stationary sensor)')
+    parser.add_argument('--reuse_max_frames', type=int, default=10, help='most frames in a row reusing the same outputs')
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
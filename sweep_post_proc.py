@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import argparse
+import sys
+import itertools
+import contextlib
+import yaml
+import torch
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from network.instance_post_processing import get_panoptic_segmentation_voxels
+from utils.eval_pq import PanopticEval
+from utils.output_cache import load_cached_scan, cached_scans
+
+#ignore weird np warning
+import warnings
+warnings.filterwarnings("ignore")
+
+def new_evaluator(n_classes):
+    # PanopticEval prints its settings, once in the main process is enough
+    with contextlib.redirect_stdout(io.StringIO()):
+        return PanopticEval(n_classes, None, [0], min_points=50)
+
+def evaluate_scans(task):
+    """Post-process a chunk of cached scans with every setting, every scan is loaded once."""
+    cache_paths, settings, thing_list, n_classes, polar, group_bucket_size = task
+    torch.set_num_threads(1)
+    evaluators = [new_evaluator(n_classes) for _ in settings]
+    with torch.no_grad():
+        for cache_path in cache_paths:
+            scan = load_cached_scan(cache_path, thing_list)
+            for evaluator, (threshold, nms_kernel, top_k) in zip(evaluators, settings):
+                if threshold < scan['center_threshold']:
+                    raise ValueError('threshold %g is below the center threshold %g of the cache' % (threshold, scan['center_threshold']))
+                panoptic,_,_ = get_panoptic_segmentation_voxels(scan['semantic'], scan['thing_prob'], scan['vox_ind'], scan['ctr_hmp'],
+                                                                scan['offsets'], thing_list, threshold=threshold, nms_kernel=nms_kernel,
+                                                                top_k=top_k, polar=polar, group_bucket_size=group_bucket_size)
+                # points without a voxel (pt_inv -1) get the appended void label
+                panoptic = torch.cat((panoptic, panoptic.new_full((1,), 0)))[scan['pt_inv']].numpy()
+                evaluator.addBatch(panoptic & 0xFFFF, panoptic, scan['pt_labels'], scan['pt_ints'])
+    return evaluators
+
+def main(args):
+    with open(args.configs, 'r') as s:
+        new_args = yaml.safe_load(s)
+    with open('semantic-kitti.yaml', 'r') as s:
+        semkittiyaml = yaml.safe_load(s)
+    thing_list = [cl for cl, ignored in semkittiyaml['thing_class'].items() if ignored]
+    n_classes = len(semkittiyaml['learning_map_inv'])
+    polar = new_args['model']['polar']
+    post_proc = new_args['model']['post_proc']
+    group_bucket_size = post_proc['group_bucket_size']
+
+    # unset parameters are taken from the config
+    settings = list(itertools.product(args.threshold or [post_proc['threshold']], args.nms_kernel or [post_proc['nms_kernel']],
+                                      args.top_k or [post_proc['top_k']]))
+    scans = cached_scans(args.cache_dir)
+    print('%d settings over %d cached scans' % (len(settings), len(scans)))
+    tasks = [(scans[i:i+args.chunk_size], settings, thing_list, n_classes, polar, group_bucket_size)
+             for i in range(0, len(scans), args.chunk_size)]
+
+    evaluators = [new_evaluator(n_classes) for _ in settings]
+    with Pool(args.workers) as pool:
+        for parts in tqdm(pool.imap_unordered(evaluate_scans, tasks), total=len(tasks)):
+            for evaluator, part in zip(evaluators, parts):
+                evaluator.merge(part)
+
+    results = []
+    for (threshold, nms_kernel, top_k), evaluator in zip(settings, evaluators):
+        class_PQ, class_SQ, class_RQ, _, _, _ = evaluator.getPQ()
+        results.append((class_PQ, class_SQ, class_RQ, threshold, nms_kernel, top_k))
+    print('%9s %10s %5s : %7s %7s %7s' % ('threshold', 'nms_kernel', 'top_k', 'PQ', 'SQ', 'RQ'))
+    for class_PQ, class_SQ, class_RQ, threshold, nms_kernel, top_k in sorted(results, reverse=True):
+        print('%9g %10d %5d : %7.3f %7.3f %7.3f' % (threshold, nms_kernel, top_k, class_PQ*100, class_SQ*100, class_RQ*100))
+
+if __name__ == '__main__':
+    # Post-processing parameter sweep over the outputs cached by test_pretrain.py --cache_dir
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--cache_dir', default='output/cache')
+    parser.add_argument('-c', '--configs', default='configs/SemanticKITTI_model/Panoptic-PolarNet.yaml')
+    parser.add_argument('--threshold', type=float, nargs='+', default=None)
+    parser.add_argument('--nms_kernel', type=int, nargs='+', default=None)
+    parser.add_argument('--top_k', type=int, nargs='+', default=None)
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--chunk_size', type=int, default=20, help='scans per task')
+
+    args = parser.parse_args()
+
+    print(' '.join(sys.argv))
+    print(args)
+    main(args)
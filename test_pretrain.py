@@ -10,15 +10,18 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from tqdm import tqdm
-import errno
 
 from network.BEV_Unet import BEV_Unet
 from network.ptBEV import ptBEVnet
-from dataloader.dataset import collate_fn_BEV,SemKITTI,SemKITTI_label_name,spherical_dataset,voxel_dataset,collate_fn_BEV_test
-from network.instance_post_processing import get_panoptic_segmentation
-from utils.eval_pq import PanopticEval
+from dataloader.dataset import collate_fn_BEV,SemKITTI,SemKITTI_label_name,spherical_dataset,voxel_dataset,collate_fn_BEV_test,has_point_grid_ind
+from network.instance_post_processing import get_panoptic_segmentation_points
+from utils.eval_pq_torch import PanopticEvalTorch
 from utils.configs import merge_configs
 from utils import common_utils
+from utils.pipeline import PipelinedInference
+from utils.prediction_writer import PredictionWriter,PredictionArchiveWriter
+from utils.output_cache import OutputCache
+from utils.tta import PolarTTA
 
 from mmcv.runner import init_dist
 #ignore weird np warning
@@ -56,12 +59,23 @@ def main(args):
     compression_model = args_dict['dataset']['grid_size'][2]
     grid_size = args_dict['dataset']['grid_size']
     visibility = args_dict['model']['visibility']
+    compile_model = args_dict['model']['compile']
     if args_dict['model']['polar']:
         fea_dim = 9
         circular_padding = True
     else:
         fea_dim = 7
         circular_padding = False
+    if args.tta:
+        # augmented copies of every scan, run in one batch and fused on the polar grid
+        tta = PolarTTA(grid_size, rotations = args_dict['model']['tta']['rotations'], flip = args_dict['model']['tta']['flip'],
+                       downsample_sub_cells = args_dict['dataset']['downsample_sub_cells'])
+        print('Test time augmentation with %d copies per scan' % len(tta))
+    else:
+        tta = None
+    # out of range culling or input downsampling: the labels are written for every loaded point, with the voxel index
+    # after the scan index
+    point_grid = has_point_grid_ind(args_dict['dataset'])
 
     # prepare miou fun
     unique_label=np.asarray(sorted(list(SemKITTI_label_name.keys())))[1:] - 1
@@ -70,13 +84,16 @@ def main(args):
     # prepare model
     my_BEV_model=BEV_Unet(n_class=len(unique_label), n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = circular_padding, use_vis_fea=visibility)
     my_model = ptBEVnet(my_BEV_model, pt_model = 'pointnet', grid_size =  grid_size, fea_dim = fea_dim, max_pt_per_encode = 256,
-                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model)
+                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model,
+                            compile_friendly = compile_model)
     if os.path.exists(pretrained_model):
         loc_type = torch.device('cpu') if distributed else None # balance GPU load
         my_model.load_state_dict(torch.load(pretrained_model, map_location=loc_type))
     pytorch_total_params = sum(p.numel() for p in my_model.parameters())
     print('params: ',pytorch_total_params)
     my_model.cuda()
+    if compile_model:
+        common_utils.compile_module(my_model, args_dict['model']['compile_backend'])
 
     if distributed:
         my_model = nn.parallel.DistributedDataParallel(my_model, device_ids=[args.local_rank % torch.cuda.device_count()], find_unused_parameters=True)
@@ -86,14 +103,14 @@ def main(args):
     if args.val:
         val_pt_dataset = SemKITTI(data_path + '/sequences/', imageset = 'val', return_ref = True, instance_pkl_path=args_dict['dataset']['instance_pkl_path'])       
         if args_dict['model']['polar']:
-            val_dataset=spherical_dataset(val_pt_dataset, args_dict['dataset'], grid_size = grid_size, ignore_label = 0)
+            val_dataset=spherical_dataset(val_pt_dataset, args_dict['dataset'], grid_size = grid_size, ignore_label = 0, return_test = True, tta = tta)
         if distributed:
             val_sampler = torch.utils.data.distributed.DistributedSampler(val_dataset)
         else:
             val_sampler = None
         val_dataset_loader = torch.utils.data.DataLoader(dataset = val_dataset,
                                                 batch_size = test_batch_size,
-                                                collate_fn = collate_fn_BEV,
+                                                collate_fn = collate_fn_BEV_test,
                                                 shuffle = False,
                                                 sampler = val_sampler,
                                                 num_workers = 4)
@@ -101,16 +118,34 @@ def main(args):
     if args.test:
         test_pt_dataset = SemKITTI(data_path + '/sequences/', imageset = 'test', return_ref = True, instance_pkl_path=args_dict['dataset']['instance_pkl_path'])       
         if args_dict['model']['polar']:
-            test_dataset=spherical_dataset(test_pt_dataset, args_dict['dataset'], grid_size = grid_size, ignore_label = 0)
+            test_dataset=spherical_dataset(test_pt_dataset, args_dict['dataset'], grid_size = grid_size, ignore_label = 0, return_test = True, tta = tta)
+        # resume, scans with a label file from a previous run are skipped
+        if args.output_format == 'archive':
+            # one archive per sequence and process
+            writer = PredictionArchiveWriter(output_path, test_pt_dataset.learning_map_inv, skip_existing = not args.overwrite,
+                                             suffix = '_%d' % torch.distributed.get_rank() if distributed else '')
+            if args.overwrite and (not distributed or torch.distributed.get_rank() == 0):
+                # the archives of an earlier run would be merged with the new predictions
+                writer.remove_archives(test_pt_dataset.im_idx)
+        else:
+            writer = PredictionWriter(output_path, test_pt_dataset.learning_map_inv, skip_existing = not args.overwrite)
+        test_remaining = writer.remaining(test_pt_dataset.im_idx)
+        if distributed:
+            # every process has read the previous outputs before any of them writes
+            torch.distributed.barrier()
+        if len(test_remaining) < len(test_dataset):
+            print('%d of %d test scans already predicted, skipped' % (len(test_dataset)-len(test_remaining), len(test_dataset)))
+            test_dataset = torch.utils.data.Subset(test_dataset, test_remaining)
         if distributed:
             test_sampler = torch.utils.data.distributed.DistributedSampler(test_dataset)
         else:
             test_sampler = None
         test_dataset_loader = torch.utils.data.DataLoader(dataset = test_dataset,
                                                 batch_size = test_batch_size,
-                                                collate_fn = collate_fn_BEV,
+                                                collate_fn = collate_fn_BEV_test,
                                                 shuffle = False,
                                                 sampler = test_sampler,
+                                                pin_memory = True,
                                                 num_workers = 4)
 
     # validation
@@ -120,54 +155,58 @@ def main(args):
             print('Test network performance on validation split')
             print('*'*80)
             pbar = tqdm(total=len(val_dataset_loader))
-        time_list = []
-        pp_time_list = []
-        evaluator = PanopticEval(len(unique_label)+1, None, [0], min_points=50)
+        # timed with device events, the host is not synchronized for every scan
+        inference_timer = common_utils.DeviceTimer()
+        pp_timer = common_utils.DeviceTimer()
+        # scored on the GPU, only the final statistics are copied to the host
+        if args.cache_dir:
+            output_cache = OutputCache(args.cache_dir, val_pt_dataset.thing_list, center_threshold = args.cache_center_threshold)
+        evaluator = PanopticEvalTorch(len(unique_label)+1, 'cuda', [0], min_points=50)
         with torch.no_grad():
-            for i_iter_val,(val_vox_fea,val_vox_label,val_gt_center,val_gt_offset,val_grid,val_pt_labels,val_pt_ints,val_pt_fea) in enumerate(val_dataset_loader):
-                val_vox_fea_ten = val_vox_fea.cuda()
+            for i_iter_val,val_batch in enumerate(val_dataset_loader):
+                val_vox_fea,val_vox_label,val_gt_center,val_gt_offset,val_grid,val_pt_labels,val_pt_ints,val_pt_fea,val_index = val_batch[:9]
+                val_net_vox_fea,val_net_grid,val_net_pt_fea = tta.batch(val_vox_fea,val_grid,val_pt_fea,val_batch[-1]) if tta else (val_vox_fea,val_grid,val_pt_fea)
+                val_vox_fea_ten = val_net_vox_fea.cuda()
                 val_vox_label = SemKITTI2train(val_vox_label)
-                val_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda() for i in val_pt_fea]
-                val_grid_ten = [torch.from_numpy(i[:,:2]).cuda() for i in val_grid]
+                val_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda() for i in val_net_pt_fea]
+                val_grid_ten = [torch.from_numpy(i[:,:2]).cuda() for i in val_net_grid]
                 val_label_tensor=val_vox_label.type(torch.LongTensor).cuda()
                 val_gt_center_tensor = val_gt_center.cuda()
                 val_gt_offset_tensor = val_gt_offset.cuda()
 
-                torch.cuda.synchronize()
-                start_time = time.time()
+                inference_timer.start()
                 if visibility:            
                     predict_labels,center,offset = my_model(val_pt_fea_ten, val_grid_ten, val_vox_fea_ten)
                 else:
                     predict_labels,center,offset = my_model(val_pt_fea_ten, val_grid_ten)
-                torch.cuda.synchronize()
-                time_list.append(time.time()-start_time)
-
-                for count,i_val_grid in enumerate(val_grid):
-                    # get foreground_mask
-                    for_mask = torch.zeros(1,grid_size[0],grid_size[1],grid_size[2],dtype=torch.bool).cuda()
-                    for_mask[0,val_grid[count][:,0],val_grid[count][:,1],val_grid[count][:,2]] = True
-                    # post processing
-                    torch.cuda.synchronize()
-                    start_time = time.time()
-                    panoptic_labels,center_points = get_panoptic_segmentation(torch.unsqueeze(predict_labels[count], 0),torch.unsqueeze(center[count], 0),torch.unsqueeze(offset[count], 0),val_pt_dataset.thing_list,\
-                                                                            threshold=args_dict['model']['post_proc']['threshold'], nms_kernel=args_dict['model']['post_proc']['nms_kernel'],\
-                                                                            top_k=args_dict['model']['post_proc']['top_k'], polar=circular_padding,foreground_mask=for_mask)
-                    torch.cuda.synchronize()
-                    pp_time_list.append(time.time()-start_time)
-                    panoptic_labels = panoptic_labels.cpu().detach().numpy().astype(np.uint32)
-                    panoptic = panoptic_labels[0,val_grid[count][:,0],val_grid[count][:,1],val_grid[count][:,2]]
-
-                    evaluator.addBatch(panoptic & 0xFFFF,panoptic,np.squeeze(val_pt_labels[count]),np.squeeze(val_pt_ints[count]))
+                if tta:
+                    predict_labels,center,offset = tta.fuse(predict_labels,center,offset)
+                inference_timer.stop()
+
+                # voxel index of every point
+                val_pt_ind,val_batch_ind,val_split = common_utils.flatten_grid_ind(val_batch[9] if point_grid else val_grid)
+                # post processing of the whole batch
+                pp_timer.start()
+                panoptic_labels,center_points,_ = get_panoptic_segmentation_points(predict_labels,center,offset,val_pt_ind.cuda(),val_batch_ind.cuda(),val_pt_dataset.thing_list,\
+                                                                                        threshold=args_dict['model']['post_proc']['threshold'], nms_kernel=args_dict['model']['post_proc']['nms_kernel'],\
+                                                                                        top_k=args_dict['model']['post_proc']['top_k'], polar=circular_padding,\
+                                                                                        group_bucket_size=args_dict['model']['post_proc']['group_bucket_size'])
+                pp_timer.stop()
+                if args.cache_dir:
+                    # network outputs for post-processing sweeps (sweep_post_proc.py)
+                    output_cache.write_batch([val_pt_dataset.im_idx[i] for i in val_index],predict_labels,center,offset,\
+                                             val_pt_ind,val_batch_ind,val_pt_labels,val_pt_ints)
+                panoptic_labels = torch.tensor_split(panoptic_labels, list(val_split))
+
+                for count,panoptic in enumerate(panoptic_labels):
+                    evaluator.addBatch(panoptic & 0xFFFF,panoptic,val_pt_labels[count],val_pt_ints[count])
                 del val_vox_label,val_pt_fea_ten,val_label_tensor,val_grid_ten,val_gt_center,val_gt_center_tensor,val_gt_offset,val_gt_offset_tensor,predict_labels,center,offset,panoptic_labels,center_points
                 if args.local_rank == 0:
                     pbar.update(1)
         
         if distributed:
-            tmp_dir = os.path.join('output', 'tmp')
-            if not os.path.exists(tmp_dir):
-                os.makedirs(tmp_dir, exist_ok=True)
-            evaluator = common_utils.merge_evaluator(evaluator, tmp_dir)
-            torch.distributed.barrier() #同步GPU
+            # sum the statistics of all GPUs in memory
+            evaluator = common_utils.all_reduce_evaluator(evaluator)
         if args.local_rank == 0:
             class_PQ, class_SQ, class_RQ, class_all_PQ, class_all_SQ, class_all_RQ = evaluator.getPQ()
             miou,ious = evaluator.getSemIoU()
@@ -180,8 +219,8 @@ def main(args):
                 (class_PQ*100))               
             print('Current val miou is %.3f'%
                 (miou*100))
-            print('Inference time per %d is %.4f seconds\n, postprocessing time is %.4f seconds per scan' %
-                (test_batch_size,np.mean(time_list),np.mean(pp_time_list)))
+            print('Inference time per %d is %.4f seconds\n, postprocessing time is %.4f seconds per %d' %
+                (test_batch_size,inference_timer.mean(),pp_timer.mean(),test_batch_size))
     
     # test
     if args.test:
@@ -190,45 +229,56 @@ def main(args):
             print('Generate predictions for test split')
             print('*'*80)
             pbar = tqdm(total=len(test_dataset_loader))
-        with torch.no_grad():
-            for i_iter_test,(test_vox_fea,_,_,_,test_grid,_,_,test_pt_fea,test_index) in enumerate(test_dataset_loader):
-                # predict
-                test_vox_fea_ten = test_vox_fea.cuda()
-                test_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda() for i in test_pt_fea]
-                test_grid_ten = [torch.from_numpy(i[:,:2]).cuda() for i in test_grid]
-
-                if visibility:
-                    predict_labels,center,offset = my_model(test_pt_fea_ten,test_grid_ten,test_vox_fea_ten)
-                else:
-                    predict_labels,center,offset = my_model(test_pt_fea_ten,test_grid_ten)
-                # write to label file
-                for count,i_test_grid in enumerate(test_grid):
-                    # get foreground_mask
-                    for_mask = torch.zeros(1,grid_size[0],grid_size[1],grid_size[2],dtype=torch.bool).cuda()
-                    for_mask[0,test_grid[count][:,0],test_grid[count][:,1],test_grid[count][:,2]] = True
-                    # post processing
-                    panoptic_labels,center_points = get_panoptic_segmentation(torch.unsqueeze(predict_labels[count], 0),torch.unsqueeze(center[count], 0),torch.unsqueeze(offset[count], 0),test_pt_dataset.thing_list,\
-                                                                                            threshold=args_dict['model']['post_proc']['threshold'], nms_kernel=args_dict['model']['post_proc']['nms_kernel'],\
-                                                                                            top_k=args_dict['model']['post_proc']['top_k'], polar=circular_padding,foreground_mask=for_mask)
-                    panoptic_labels = panoptic_labels.cpu().detach().numpy().astype(np.uint32)
-                    panoptic = panoptic_labels[0,test_grid[count][:,0],test_grid[count][:,1],test_grid[count][:,2]]
-                    save_dir = test_pt_dataset.im_idx[test_index[count]]
-                    _,dir2 = save_dir.split('/sequences/',1)
-                    new_save_dir = output_path + '/sequences/' +dir2.replace('velodyne','predictions')[:-3]+'label'
-                    if not os.path.exists(os.path.dirname(new_save_dir)):
-                        try:
-                            os.makedirs(os.path.dirname(new_save_dir))
-                        except OSError as exc:
-                            if exc.errno != errno.EEXIST:
-                                raise
-                    panoptic.tofile(new_save_dir)
-                del test_pt_fea_ten,test_grid_ten,test_pt_fea,predict_labels,center,offset
-                if args.local_rank == 0:
-                    pbar.update(1)
+        def test_forward(batch):
+            test_vox_fea,_,_,_,test_grid,_,_,test_pt_fea,_ = batch[:9]
+            if tta:
+                test_vox_fea,test_grid,test_pt_fea = tta.batch(test_vox_fea,test_grid,test_pt_fea,batch[-1])
+            test_vox_fea_ten = test_vox_fea.cuda(non_blocking=True)
+            test_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda(non_blocking=True) for i in test_pt_fea]
+            test_grid_ten = [torch.from_numpy(i[:,:2]).cuda(non_blocking=True) for i in test_grid]
+            if visibility:
+                output = my_model(test_pt_fea_ten,test_grid_ten,test_vox_fea_ten)
+            else:
+                output = my_model(test_pt_fea_ten,test_grid_ten)
+            return tta.fuse(*output) if tta else output
+
+        def test_postprocess(output, batch):
+            predict_labels,center,offset = output
+            test_grid,test_index = (batch[9] if point_grid else batch[4]),batch[8]
+            # voxel index of every point
+            test_pt_ind,test_batch_ind,test_split = common_utils.flatten_grid_ind(test_grid)
+            # post processing of the whole batch
+            panoptic_labels,_,_ = get_panoptic_segmentation_points(predict_labels,center,offset,test_pt_ind.cuda(),test_batch_ind.cuda(),test_pt_dataset.thing_list,\
+                                                                    threshold=args_dict['model']['post_proc']['threshold'], nms_kernel=args_dict['model']['post_proc']['nms_kernel'],\
+                                                                    top_k=args_dict['model']['post_proc']['top_k'], polar=circular_padding,\
+                                                                    group_bucket_size=args_dict['model']['post_proc']['group_bucket_size'])
+            panoptic_labels = np.split(panoptic_labels.cpu().numpy().astype(np.uint32), test_split)
+            return list(zip(test_index,panoptic_labels))
+
+        def test_write(result):
+            # write to label file (or archive) in the original label format
+            index,panoptic = result
+            writer.write(test_pt_dataset.im_idx[index],panoptic)
+
+        progress = pbar.update if args.local_rank == 0 else None
+        if args.pipeline:
+            # overlap the forward of a batch with the post processing and writing of the previous ones
+            runner = PipelinedInference(test_forward, test_postprocess, test_write, queue_size=2, num_writers=args.num_writers)
+            runner.run(test_dataset_loader, progress=progress)
+        else:
+            with torch.no_grad():
+                for batch in test_dataset_loader:
+                    for result in test_postprocess(test_forward(batch), batch):
+                        test_write(result)
+                    if progress is not None: progress()
+        writer.close()
         if args.local_rank == 0:
             pbar.close()
-            print('Predicted test labels are saved in %s. Need to be shifted to original label format before submitting to the Competition website.' % output_path)
-            print('Remapping script can be found in semantic-kitti-api.')
+            if args.pipeline:
+                print(runner.summary())
+            print('Predicted test labels are saved in %s in the original label format.' % output_path)
+            if args.output_format == 'archive':
+                print('Use export_predictions.py to expand the archives to one label file per scan.')
 
 if __name__ == '__main__':
     # Testing settings
@@ -240,6 +290,13 @@ if __name__ == '__main__':
     parser.add_argument('--launcher', default=None)
     parser.add_argument('--test', default=False)
     parser.add_argument('--val', default=True)
+    parser.add_argument('--cache_dir', default=None, help='cache the network outputs of the validation split for sweep_post_proc.py')
+    parser.add_argument('--cache_center_threshold', type=float, default=0.01, help='lowest center threshold the cache can be swept with')
+    parser.add_argument('--output_format', default='label', choices=['label','archive'], help='one label file per scan or one archive per sequence')
+    parser.add_argument('--overwrite', action='store_true', help='predict again the test scans which already have a label file')
+    parser.add_argument('--pipeline', action='store_true', help='pipelined test split generation')
+    parser.add_argument('--num_writers', type=int, default=4, help='label writer threads of the pipelined test run')
+    parser.add_argument('--tta', action='store_true', help='test time augmentation, see model: tta in the config')
 
     args = parser.parse_args()
 
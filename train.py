@@ -12,10 +12,10 @@ from tqdm import tqdm
 
 from network.BEV_Unet import BEV_Unet
 from network.ptBEV import ptBEVnet
-from dataloader.dataset import collate_fn_BEV,SemKITTI,SemKITTI_label_name,spherical_dataset,voxel_dataset
-from network.instance_post_processing import get_panoptic_segmentation
+from dataloader.dataset import collate_fn_BEV,SemKITTI,SemKITTI_label_name,spherical_dataset,voxel_dataset,has_point_grid_ind
+from network.instance_post_processing import get_panoptic_segmentation_points
 from network.loss import panoptic_loss
-from utils.eval_pq import PanopticEval
+from utils.eval_pq_torch import PanopticEvalTorch
 from utils.configs import merge_configs
 from utils import common_utils
 
@@ -65,6 +65,11 @@ def main(args):
     compression_model = args_dict['dataset']['grid_size'][2]
     grid_size = args_dict['dataset']['grid_size']
     visibility = args_dict['model']['visibility']
+    point_grid = has_point_grid_ind(args_dict['dataset'])
+    compile_model = args_dict['model']['compile']
+    checkpoint_blocks = args_dict['model']['checkpoint']
+    accumulation_steps = args_dict['model']['accumulation_steps']
+    micro_batch_size = args_dict['model']['micro_batch_size'] or train_batch_size
     if args_dict['model']['polar']:
         fea_dim = 9
         circular_padding = True
@@ -77,9 +82,11 @@ def main(args):
     unique_label_str=[SemKITTI_label_name[x] for x in unique_label+1]
 
     #prepare model
-    my_BEV_model=BEV_Unet(n_class=len(unique_label), n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = circular_padding, use_vis_fea=visibility)
+    my_BEV_model=BEV_Unet(n_class=len(unique_label), n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = circular_padding, use_vis_fea=visibility,
+                          checkpoint_blocks = [i for i in checkpoint_blocks if i != 'PPmodel'])
     my_model = ptBEVnet(my_BEV_model, pt_model = 'pointnet', grid_size =  grid_size, fea_dim = fea_dim, max_pt_per_encode = 256,
-                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model)
+                            out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model,
+                            compile_friendly = compile_model, checkpoint_pointnet = 'PPmodel' in checkpoint_blocks)
     if os.path.exists(model_save_path):
         loc_type = torch.device('cpu') if distributed else None # balance GPU load
         my_model.load_state_dict(torch.load(model_save_path, map_location=loc_type))
@@ -93,7 +100,12 @@ def main(args):
     
     optimizer = optim.Adam(my_model.parameters())
     loss_fn = panoptic_loss(center_loss_weight = args_dict['model']['center_loss_weight'], offset_loss_weight = args_dict['model']['offset_loss_weight'],\
-                            center_loss = args_dict['model']['center_loss'], offset_loss=args_dict['model']['offset_loss'])
+                            center_loss = args_dict['model']['center_loss'], offset_loss=args_dict['model']['offset_loss'], compile_friendly = compile_model,\
+                            sparse = args_dict['model']['sparse_loss'])
+    loss_fn.cuda()
+    if compile_model:
+        common_utils.compile_module(my_model, args_dict['model']['compile_backend'])
+        common_utils.compile_module(loss_fn, args_dict['model']['compile_backend'])
 
     #prepare dataset
     val_pt_dataset = SemKITTI(data_path + '/sequences/', imageset = 'val', return_ref = True, instance_pkl_path=args_dict['dataset']['instance_pkl_path'])       
@@ -122,6 +134,7 @@ def main(args):
                                             collate_fn = collate_fn_BEV,
                                             shuffle = False,
                                             sampler = train_sampler,
+                                            pin_memory = True,
                                             num_workers = 4)
 
 
@@ -139,17 +152,20 @@ def main(args):
         # validation
         if True:
             my_model.eval()
-            evaluator = PanopticEval(len(unique_label)+1, None, [0], min_points=50)
+            # scored on the GPU, only the final statistics are copied to the host
+            evaluator = PanopticEvalTorch(len(unique_label)+1, 'cuda', [0], min_points=50)
             #evaluator.reset()
             if args.local_rank == 0:
                 print('*'*80)
                 print('Test network performance on validation split')
                 print('*'*80)
                 pbar = tqdm(total=len(val_dataset_loader))
-            time_list = []
-            pp_time_list = []
+            # timed with device events, the host is not synchronized for every scan
+            inference_timer = common_utils.DeviceTimer()
+            pp_timer = common_utils.DeviceTimer()
             with torch.no_grad():
-                for i_iter_val,(val_vox_fea,val_vox_label,val_gt_center,val_gt_offset,val_grid,val_pt_labels,val_pt_ints,val_pt_fea) in enumerate(val_dataset_loader):
+                for i_iter_val,val_batch in enumerate(val_dataset_loader):
+                    val_vox_fea,val_vox_label,val_gt_center,val_gt_offset,val_grid,val_pt_labels,val_pt_ints,val_pt_fea = val_batch[:8]
                     val_vox_fea_ten = val_vox_fea.cuda()
                     val_vox_label = SemKITTI2train(val_vox_label)
                     val_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda() for i in val_pt_fea]
@@ -158,41 +174,33 @@ def main(args):
                     val_gt_center_tensor = val_gt_center.cuda()
                     val_gt_offset_tensor = val_gt_offset.cuda()
 
-                    torch.cuda.synchronize()
-                    start_time = time.time()
+                    inference_timer.start()
                     if visibility:            
                         predict_labels,center,offset = my_model(val_pt_fea_ten, val_grid_ten, val_vox_fea_ten)
                     else:
                         predict_labels,center,offset = my_model(val_pt_fea_ten, val_grid_ten)
-                    torch.cuda.synchronize()
-                    time_list.append(time.time()-start_time)
+                    inference_timer.stop()
 
-                    for count,i_val_grid in enumerate(val_grid):
-                        # get foreground_mask
-                        for_mask = torch.zeros(1,grid_size[0],grid_size[1],grid_size[2],dtype=torch.bool).cuda()
-                        for_mask[0,val_grid[count][:,0],val_grid[count][:,1],val_grid[count][:,2]] = True
-                        # post processing
-                        torch.cuda.synchronize()
-                        start_time = time.time()
-                        panoptic_labels,center_points = get_panoptic_segmentation(torch.unsqueeze(predict_labels[count], 0),torch.unsqueeze(center[count], 0),torch.unsqueeze(offset[count], 0),val_pt_dataset.thing_list,\
-                                                                                threshold=args_dict['model']['post_proc']['threshold'], nms_kernel=args_dict['model']['post_proc']['nms_kernel'],\
-                                                                                top_k=args_dict['model']['post_proc']['top_k'], polar=circular_padding,foreground_mask=for_mask)
-                        torch.cuda.synchronize()
-                        pp_time_list.append(time.time()-start_time)
-                        panoptic_labels = panoptic_labels.cpu().detach().numpy().astype(np.uint32)
-                        panoptic = panoptic_labels[0,val_grid[count][:,0],val_grid[count][:,1],val_grid[count][:,2]]
+                    # voxel index of every point
+                    val_pt_ind,val_batch_ind,val_split = common_utils.flatten_grid_ind(val_batch[8] if point_grid else val_grid)
+                    # post processing of the whole batch
+                    pp_timer.start()
+                    panoptic_labels,center_points,_ = get_panoptic_segmentation_points(predict_labels,center,offset,val_pt_ind.cuda(),val_batch_ind.cuda(),val_pt_dataset.thing_list,\
+                                                                                            threshold=args_dict['model']['post_proc']['threshold'], nms_kernel=args_dict['model']['post_proc']['nms_kernel'],\
+                                                                                            top_k=args_dict['model']['post_proc']['top_k'], polar=circular_padding,\
+                                                                                            group_bucket_size=args_dict['model']['post_proc']['group_bucket_size'])
+                    pp_timer.stop()
+                    panoptic_labels = torch.tensor_split(panoptic_labels, list(val_split))
 
-                        evaluator.addBatch(panoptic & 0xFFFF,panoptic,np.squeeze(val_pt_labels[count]),np.squeeze(val_pt_ints[count]))
+                    for count,panoptic in enumerate(panoptic_labels):
+                        evaluator.addBatch(panoptic & 0xFFFF,panoptic,val_pt_labels[count],val_pt_ints[count])
                     del val_vox_label,val_pt_fea_ten,val_label_tensor,val_grid_ten,val_gt_center,val_gt_center_tensor,val_gt_offset,val_gt_offset_tensor,predict_labels,center,offset,panoptic_labels,center_points
                     if args.local_rank == 0:
                         pbar.update(1)
             
             if distributed:
-                tmp_dir = os.path.join('output', 'tmp')
-                if not os.path.exists(tmp_dir):
-                    os.makedirs(tmp_dir, exist_ok=True)
-                evaluator = common_utils.merge_evaluator(evaluator, tmp_dir)
-                torch.distributed.barrier() #同步GPU
+                # sum the statistics of all GPUs in memory
+                evaluator = common_utils.all_reduce_evaluator(evaluator)
             if args.local_rank == 0:
                 class_PQ, class_SQ, class_RQ, class_all_PQ, class_all_SQ, class_all_RQ = evaluator.getPQ()
                 miou,ious = evaluator.getSemIoU()
@@ -209,11 +217,12 @@ def main(args):
                     (class_PQ*100))               
                 print('Current val miou is %.3f'%
                     (miou*100))
-                print('Inference time per %d is %.4f seconds\n, postprocessing time is %.4f seconds per scan' %
-                    (val_batch_size,np.mean(time_list),np.mean(pp_time_list)))
+                print('Inference time per %d is %.4f seconds\n, postprocessing time is %.4f seconds per %d' %
+                    (val_batch_size,inference_timer.mean(),pp_timer.mean(),val_batch_size))
 
                 if start_training:
-                    sem_l ,hm_l, os_l = np.mean(loss_fn.lost_dict['semantic_loss']), np.mean(loss_fn.lost_dict['heatmap_loss']), np.mean(loss_fn.lost_dict['offset_loss'])
+                    loss_dict = loss_fn.get_loss_dict()
+                    sem_l ,hm_l, os_l = loss_dict['semantic_loss'], loss_dict['heatmap_loss'], loss_dict['offset_loss']
                     print('epoch %d iter %5d, loss: %.3f, semantic loss: %.3f, heatmap loss: %.3f, offset loss: %.3f\n' %
                         (epoch, i_iter, sem_l+hm_l+os_l, sem_l, hm_l, os_l))
                 print('%d exceptions encountered during last training\n' %
@@ -223,60 +232,70 @@ def main(args):
 
         if args.local_rank == 0: 
             pbar = tqdm(total=len(train_dataset_loader))
-        for i_iter,(train_vox_fea,train_label_tensor,train_gt_center,train_gt_offset,train_grid,_,_,train_pt_fea) in enumerate(train_dataset_loader):
-            # training
-            # try:
-            train_vox_fea_ten = train_vox_fea.cuda()
-            train_label_tensor = SemKITTI2train(train_label_tensor)
-            train_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda() for i in train_pt_fea]
-            train_grid_ten = [torch.from_numpy(i[:,:2]).cuda() for i in train_grid]
-            train_label_tensor=train_label_tensor.type(torch.LongTensor).cuda()
-            train_gt_center_tensor = train_gt_center.cuda()
-            train_gt_offset_tensor = train_gt_offset.cuda()
+        for i_iter,train_batch in enumerate(train_dataset_loader):
+            # the optimizer steps once every accumulation_steps loader batches, each of them is split into micro-batches
+            window_start = i_iter - i_iter % accumulation_steps
+            accumulation_window = min(accumulation_steps, len(train_dataset_loader) - window_start)
+            update_step = i_iter == window_start + accumulation_window - 1
+            micro_batches = common_utils.split_batch(train_batch, micro_batch_size)
+            for i_micro,micro_batch in enumerate(micro_batches):
+                train_vox_fea,train_label_tensor,train_gt_center,train_gt_offset,train_grid,_,_,train_pt_fea = micro_batch[:8]
+                # training
+                # try:
+                # batch tensors are pinned by the loader, copy them without blocking the host
+                train_vox_fea_ten = train_vox_fea.cuda(non_blocking=True)
+                train_label_tensor = SemKITTI2train(train_label_tensor)
+                train_pt_fea_ten = [torch.from_numpy(i).type(torch.FloatTensor).cuda() for i in train_pt_fea]
+                train_grid_ten = [torch.from_numpy(i[:,:2]).cuda() for i in train_grid]
+                train_label_tensor=train_label_tensor.cuda(non_blocking=True).long()
+                train_gt_center_tensor = train_gt_center.cuda(non_blocking=True)
+                train_gt_offset_tensor = train_gt_offset.cuda(non_blocking=True)
+                # the loss is a mean over the scans of a micro-batch, weight it by its share of the loader batch (a short
+                # last batch included) and average the loader batches of the accumulation window
+                loss_scale = len(train_grid) / (len(train_batch[4]) * accumulation_window)
+                # gradients are only all-reduced in the last backward before the optimizer step
+                sync_grad = update_step and i_micro == len(micro_batches) - 1
 
-            if args_dict['model']['enable_SAP'] and epoch>=args_dict['model']['SAP']['start_epoch']:
-                for fea in train_pt_fea_ten:
-                    fea.requires_grad_()
-    
-            # forward
-            if visibility:
-                sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten,train_vox_fea_ten)
-            else:
-                sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten)
-            # loss
-            loss = loss_fn(sem_prediction,center,offset,train_label_tensor,train_gt_center_tensor,train_gt_offset_tensor)
-            
-            
-            # self adversarial pruning
-            if args_dict['model']['enable_SAP'] and epoch>=args_dict['model']['SAP']['start_epoch']:
-                loss.backward()
-                for i,fea in enumerate(train_pt_fea_ten):
-                    fea_grad = torch.norm(fea.grad,dim=1)
-                    top_k_grad, _ = torch.topk(fea_grad, int(args_dict['model']['SAP']['rate']*fea_grad.shape[0]))
-                    # delete high influential points
-                    train_pt_fea_ten[i] = train_pt_fea_ten[i][fea_grad < top_k_grad[-1]]
-                    train_grid_ten[i] = train_grid_ten[i][fea_grad < top_k_grad[-1]]
-                optimizer.zero_grad()
+                # self adversarial pruning
+                if args_dict['model']['enable_SAP'] and epoch>=args_dict['model']['SAP']['start_epoch']:
+                    for fea in train_pt_fea_ten:
+                        fea.requires_grad_()
+                    # first pass, only the input gradients are computed so the accumulated parameter gradients are kept
+                    with common_utils.grad_sync_context(my_model, False):
+                        if visibility:
+                            sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten,train_vox_fea_ten)
+                        else:
+                            sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten)
+                        loss = loss_fn(sem_prediction,center,offset,train_label_tensor,train_gt_center_tensor,train_gt_offset_tensor)
+                        fea_grads = torch.autograd.grad(loss, train_pt_fea_ten)
+                    for i,fea_grad in enumerate(fea_grads):
+                        fea_grad = torch.norm(fea_grad,dim=1)
+                        top_k_grad, _ = torch.topk(fea_grad, int(args_dict['model']['SAP']['rate']*fea_grad.shape[0]))
+                        # delete high influential points
+                        remain_ind = torch.nonzero(fea_grad < top_k_grad[-1]).squeeze(1)
+                        train_pt_fea_ten[i] = train_pt_fea_ten[i][remain_ind]
+                        train_grid_ten[i] = train_grid_ten[i][remain_ind]
 
-                # second pass
-                # forward
-                if visibility:
-                    sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten,train_vox_fea_ten)
-                else:
-                    sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten)
-                # loss
-                loss = loss_fn(sem_prediction,center,offset,train_label_tensor,train_gt_center_tensor,train_gt_offset_tensor)
-                
-            # backward + optimize
-            loss.backward()
-            optimizer.step()
-            # except Exception as error: 
-            # if exce_counter == 0:
-            #     print(error)
-            # exce_counter += 1
-            
-            # zero the parameter gradients
-            optimizer.zero_grad()
+                with common_utils.grad_sync_context(my_model, sync_grad):
+                    # forward
+                    if visibility:
+                        sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten,train_vox_fea_ten)
+                    else:
+                        sem_prediction,center,offset = my_model(train_pt_fea_ten,train_grid_ten)
+                    # loss
+                    loss = loss_fn(sem_prediction,center,offset,train_label_tensor,train_gt_center_tensor,train_gt_offset_tensor)
+                    # backward
+                    (loss * loss_scale).backward()
+                # except Exception as error: 
+                # if exce_counter == 0:
+                #     print(error)
+                # exce_counter += 1
+
+            if update_step:
+                # optimize
+                optimizer.step()
+                # zero the parameter gradients
+                optimizer.zero_grad()
             if args.local_rank == 0:
                 pbar.update(1)
                 start_training=True
@@ -1,3 +1,5 @@
+import contextlib
+import time
 import numpy as np
 import torch
 import random
@@ -93,6 +95,80 @@ def merge_ins_sem(_sem, ins, ins_classified_labels=None, ins_classified_ids=None
                 sem[ind] = mode_sem_id
     return sem
 
+def compile_module(module, backend='inductor'):
+    """Compile a module in place with torch.compile, keeping its state_dict keys.
+
+    Dynamic shapes are enabled since the number of points changes every scan, and the data-dependent output
+    shapes of torch.unique and boolean masking are captured instead of breaking the graph.
+    """
+    import torch._dynamo
+    torch._dynamo.config.capture_dynamic_output_shape_ops = True
+    torch._dynamo.config.capture_scalar_outputs = True
+    module.compile(backend=backend, dynamic=True)
+    return module
+
+def split_batch(batch, micro_batch_size):
+    """Split a collated batch (tensors and per-scan lists) into micro-batches of at most micro_batch_size scans."""
+    batch_size = len(batch[0])
+    return [tuple(item[i:i+micro_batch_size] for item in batch) for i in range(0, batch_size, micro_batch_size)]
+
+def grad_sync_context(model, sync):
+    """Skip the DistributedDataParallel gradient all-reduce of the forward and backward run in this context
+    unless sync is True. Gradients accumulate locally until the next synchronized backward."""
+    if isinstance(model, torch.nn.parallel.DistributedDataParallel) and not sync:
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+def flatten_grid_ind(grid_ind):
+    """Concatenate the per-scan voxel indices of a collate_fn_BEV batch.
+
+    Returns:
+        pt_ind: A long Tensor of shape [P, 3], voxel index of every point.
+        batch_ind: A long Tensor of shape [P], scan of every point.
+        split: split points of the scans in the flat arrays, for np.split.
+    """
+    counts = [i.shape[0] for i in grid_ind]
+    pt_ind = torch.from_numpy(np.concatenate(grid_ind)).long()
+    batch_ind = torch.repeat_interleave(torch.arange(len(grid_ind)), torch.tensor(counts))
+    return pt_ind, batch_ind, np.cumsum(counts)[:-1]
+
+class DeviceTimer(object):
+    """Accumulate the run time of code regions without stalling the host.
+
+    On CUDA, start and stop record events on the current stream and the elapsed times are only read back
+    (a single synchronization) when mean is called. On CPU the wall clock is used.
+    """
+    def __init__(self, device='cuda'):
+        self.use_events = torch.device(device).type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.events = []
+        self.times = []
+
+    def start(self):
+        if self.use_events:
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.start_event.record()
+        else:
+            self.start_time = time.time()
+
+    def stop(self):
+        if self.use_events:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+            self.events.append((self.start_event, end_event))
+        else:
+            self.times.append(time.time() - self.start_time)
+
+    def mean(self):
+        """Mean time of the recorded regions in seconds."""
+        if self.events:
+            self.events[-1][1].synchronize()
+            self.times.extend(start.elapsed_time(end) / 1000. for start, end in self.events)
+            self.events = []
+        return np.mean(self.times) if self.times else 0.
+
 def create_logger(log_file=None, rank=0, log_level=logging.INFO):
     logger = logging.getLogger(__name__)
     logger.setLevel(log_level if rank == 0 else 'ERROR')
@@ -189,6 +265,33 @@ def merge_evaluator(evaluator, tmp_dir, prefix=''):
 
     return evaluator
 
+def all_reduce_evaluator(evaluator):
+    """Sum the statistics of a PanopticEval (or PanopticEvalTorch) over all ranks in place with torch.distributed,
+    every rank gets the merged evaluator. The arrays go through the device of the backend (CUDA for nccl, CPU
+    for gloo)."""
+    device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    int_names = ['px_iou_conf_matrix', 'pan_tp', 'pan_fp', 'pan_fn']
+    if isinstance(evaluator.pan_tp, torch.Tensor):
+        for name in int_names + ['pan_iou']:
+            tensor = getattr(evaluator, name)
+            reduced = tensor.to(device)
+            dist.all_reduce(reduced)
+            tensor.copy_(reduced)
+        return evaluator
+    # one collective per dtype
+    counts = torch.from_numpy(np.concatenate([getattr(evaluator, name).ravel() for name in int_names])).to(device)
+    iou = torch.from_numpy(evaluator.pan_iou).to(device)
+    dist.all_reduce(counts)
+    dist.all_reduce(iou)
+    counts = counts.cpu().numpy()
+    start = 0
+    for name in int_names:
+        array = getattr(evaluator, name)
+        array[...] = counts[start:start+array.size].reshape(array.shape)
+        start += array.size
+    evaluator.pan_iou[...] = iou.cpu().numpy()
+    return evaluator
+
 # def save_test_results(ret_dict, output_dir, batch):
 #     assert len(ret_dict['sem_preds']) == 1
 
@@ -9,11 +9,15 @@ class PanopticEval:
   authors: Andres Milioto and Jens Behley
   """
 
-  def __init__(self, n_classes, device=None, ignore=None, offset=2**32, min_points=30):
+  def __init__(self, n_classes, device=None, ignore=None, offset=2**32, min_points=30, vectorized=True):
     self.n_classes = n_classes
     assert (device == None)
     self.ignore = np.array(ignore, dtype=np.int64)
     self.include = np.array([n for n in range(self.n_classes) if n not in self.ignore], dtype=np.int64)
+    self.is_include = np.zeros(self.n_classes, dtype=bool)
+    self.is_include[self.include] = True
+    # all classes at once (default) or the reference per class loop, same numbers
+    self.vectorized = vectorized
 
     print("[PANOPTIC EVAL] IGNORE: ", self.ignore)
     print("[PANOPTIC EVAL] INCLUDE: ", self.include)
@@ -47,10 +51,14 @@ class PanopticEval:
 
   ################################# IoU STUFF ##################################
   def addBatchSemIoU(self, x_sem, y_sem):
+    # make confusion matrix (cols = gt, rows = pred)
+    if self.vectorized:
+      idxs = np.asarray(x_sem, dtype=np.int64).ravel() * self.n_classes + np.asarray(y_sem, dtype=np.int64).ravel()
+      self.px_iou_conf_matrix += np.bincount(idxs, minlength=self.n_classes**2).reshape(self.n_classes, self.n_classes)
+      return
+
     # idxs are labels and predictions
     idxs = np.stack([x_sem, y_sem], axis=0)
-
-    # make confusion matrix (cols = gt, rows = pred)
     np.add.at(self.px_iou_conf_matrix, tuple(idxs), 1)
 
   def getSemIoUStats(self):
@@ -109,6 +117,10 @@ class PanopticEval:
       x_inst_row = x_inst_row[gt_not_in_excl_mask]
       y_inst_row = y_inst_row[gt_not_in_excl_mask]
 
+    if self.vectorized:
+      self.addBatchPanopticAllClasses(x_sem_row, x_inst_row, y_sem_row, y_inst_row)
+      return
+
     # first step is to count intersections > 0.5 IoU for each class (except the ignored ones)
     for cl in self.include:
       # print("*"*80)
@@ -162,6 +174,60 @@ class PanopticEval:
       # count the FP
       self.pan_fp[cl] += np.sum(np.logical_and(counts_pred >= self.min_points, matched_pred == False))
 
+  def addBatchPanopticAllClasses(self, x_sem_row, x_inst_row, y_sem_row, y_inst_row):
+    # same as the per class loop of addBatchPanoptic (instances shifted by 1, ignored gt removed), all classes at
+    # once: instances are keyed by (class, instance), intersections by (gt instance, pred instance) in one unique
+    x_sem_row = np.asarray(x_sem_row, dtype=np.int64).ravel()
+    y_sem_row = np.asarray(y_sem_row, dtype=np.int64).ravel()
+    x_inst_row = np.asarray(x_inst_row, dtype=np.int64).ravel()
+    y_inst_row = np.asarray(y_inst_row, dtype=np.int64).ravel()
+
+    # points of an instance of an included class
+    x_valid = (x_inst_row > 0) & (x_sem_row >= 0) & (x_sem_row < self.n_classes)
+    x_valid[x_valid] = self.is_include[x_sem_row[x_valid]]
+    y_valid = (y_inst_row > 0) & (y_sem_row >= 0) & (y_sem_row < self.n_classes)
+    y_valid[y_valid] = self.is_include[y_sem_row[y_valid]]
+
+    # areas of every (class, instance), sorted by class then instance id
+    unique_pred, pred_idx, counts_pred = np.unique((x_sem_row[x_valid] << 34) | x_inst_row[x_valid], return_inverse=True, return_counts=True)
+    unique_gt, gt_idx, counts_gt = np.unique((y_sem_row[y_valid] << 34) | y_inst_row[y_valid], return_inverse=True, return_counts=True)
+    cl_pred = unique_pred >> 34
+    cl_gt = unique_gt >> 34
+    x_idx = np.full(x_sem_row.shape, -1, dtype=np.int64)
+    x_idx[x_valid] = pred_idx.ravel()
+    y_idx = np.full(y_sem_row.shape, -1, dtype=np.int64)
+    y_idx[y_valid] = gt_idx.ravel()
+
+    # intersections, only between instances of the same class. Sorted by gt then pred instance within a class
+    valid_combos = x_valid & y_valid & (x_sem_row == y_sem_row)
+    unique_combo, counts_combo = np.unique(y_idx[valid_combos] * unique_pred.shape[0] + x_idx[valid_combos], return_counts=True)
+    gt_labels = unique_combo // max(unique_pred.shape[0], 1)
+    pred_labels = unique_combo % max(unique_pred.shape[0], 1)
+    intersections = counts_combo
+    unions = counts_gt[gt_labels] + counts_pred[pred_labels] - intersections
+    ious = intersections.astype(np.float64) / unions.astype(np.float64)
+
+    # count the intersections with over 0.5 IoU as TP
+    tp_indexes = ious > 0.5
+    tp_cl = cl_gt[gt_labels[tp_indexes]]
+    self.pan_tp += np.bincount(tp_cl, minlength=self.n_classes)
+    # IoU sums per class with np.sum over the same values in the same order as the per class loop (bit-identical)
+    tp_ious = ious[tp_indexes]
+    cl_start = np.flatnonzero(np.r_[True, tp_cl[1:] != tp_cl[:-1]]) if tp_cl.size > 0 else np.zeros(0, dtype=np.int64)
+    for cl, cl_ious in zip(tp_cl[cl_start], np.split(tp_ious, cl_start[1:])):
+      self.pan_iou[cl] += np.sum(cl_ious)
+
+    matched_gt = np.zeros(unique_gt.shape[0], dtype=bool)
+    matched_gt[gt_labels[tp_indexes]] = True
+    matched_pred = np.zeros(unique_pred.shape[0], dtype=bool)
+    matched_pred[pred_labels[tp_indexes]] = True
+
+    # count the FN
+    self.pan_fn += np.bincount(cl_gt[(counts_gt >= self.min_points) & ~matched_gt], minlength=self.n_classes)
+
+    # count the FP
+    self.pan_fp += np.bincount(cl_pred[(counts_pred >= self.min_points) & ~matched_pred], minlength=self.n_classes)
+
   def getPQ(self):
     # first calculate for all classes
     sq_all = self.pan_iou.astype(np.double) / np.maximum(self.pan_tp.astype(np.double), self.eps)
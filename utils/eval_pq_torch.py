@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import numpy as np
+import torch
+
+from .eval_pq import PanopticEval
+
+
+class PanopticEvalTorch:
+  """ Panoptic evaluation using torch, same numbers as PanopticEval (utils/eval_pq.py)
+
+  Predictions and labels are tensors on any device, the confusion matrix and the panoptic counters are
+  accumulated on that device. Only the final statistics are copied to the host by getPQ / getSemIoU / getSemAcc.
+  """
+
+  def __init__(self, n_classes, device=None, ignore=None, offset=2**32, min_points=30):
+    self.n_classes = n_classes
+    self.device = torch.device('cpu') if device is None else torch.device(device)
+    # host evaluator, only used to compute the final metrics
+    self.host_evaluator = PanopticEval(n_classes, None, ignore, offset, min_points)
+    self.ignore = torch.as_tensor(self.host_evaluator.ignore, device=self.device)
+    self.is_include = torch.as_tensor(self.host_evaluator.is_include, device=self.device)
+    self.min_points = min_points
+
+    self.reset()
+
+  def num_classes(self):
+    return self.n_classes
+
+  def merge(self, evaluator):
+    self.px_iou_conf_matrix += evaluator.px_iou_conf_matrix.to(self.device)
+    self.pan_tp += evaluator.pan_tp.to(self.device)
+    self.pan_iou += evaluator.pan_iou.to(self.device)
+    self.pan_fp += evaluator.pan_fp.to(self.device)
+    self.pan_fn += evaluator.pan_fn.to(self.device)
+
+  def reset(self):
+    # iou stuff
+    self.px_iou_conf_matrix = torch.zeros((self.n_classes, self.n_classes), dtype=torch.int64, device=self.device)
+    # panoptic stuff
+    self.pan_tp = torch.zeros(self.n_classes, dtype=torch.int64, device=self.device)
+    self.pan_iou = torch.zeros(self.n_classes, dtype=torch.float64, device=self.device)
+    self.pan_fp = torch.zeros(self.n_classes, dtype=torch.int64, device=self.device)
+    self.pan_fn = torch.zeros(self.n_classes, dtype=torch.int64, device=self.device)
+
+  def _to_device(self, x):
+    if isinstance(x, np.ndarray):
+      x = torch.from_numpy(x.astype(np.int64))
+    return x.to(self.device, torch.int64, non_blocking=True).reshape(-1)
+
+  def host(self):
+    """PanopticEval with the statistics accumulated so far, a single device to host copy."""
+    counts = torch.cat((self.px_iou_conf_matrix.reshape(-1), self.pan_tp, self.pan_fp, self.pan_fn)).cpu().numpy()
+    n = self.n_classes
+    self.host_evaluator.px_iou_conf_matrix = counts[:n*n].reshape(n, n)
+    self.host_evaluator.pan_tp = counts[n*n:n*n+n]
+    self.host_evaluator.pan_fp = counts[n*n+n:n*n+2*n]
+    self.host_evaluator.pan_fn = counts[n*n+2*n:]
+    self.host_evaluator.pan_iou = self.pan_iou.cpu().numpy()
+    return self.host_evaluator
+
+  ################################# IoU STUFF ##################################
+  def addBatchSemIoU(self, x_sem, y_sem):
+    # make confusion matrix (cols = gt, rows = pred)
+    idxs = self._to_device(x_sem) * self.n_classes + self._to_device(y_sem)
+    self.px_iou_conf_matrix += torch.bincount(idxs, minlength=self.n_classes**2).reshape(self.n_classes, self.n_classes)
+
+  def getSemIoU(self):
+    return self.host().getSemIoU()
+
+  def getSemAcc(self):
+    return self.host().getSemAcc()
+
+  #############################  Panoptic STUFF ################################
+  def addBatchPanoptic(self, x_sem_row, x_inst_row, y_sem_row, y_inst_row):
+    # see PanopticEval.addBatchPanopticAllClasses
+    x_sem_row = self._to_device(x_sem_row)
+    y_sem_row = self._to_device(y_sem_row)
+    # make sure instances are not zeros
+    x_inst_row = self._to_device(x_inst_row) + 1
+    y_inst_row = self._to_device(y_inst_row) + 1
+
+    # only interested in points that are outside the void area (not in excluded classes)
+    gt_not_in_excl_mask = ~torch.isin(y_sem_row, self.ignore)
+    x_sem_row = x_sem_row[gt_not_in_excl_mask]
+    y_sem_row = y_sem_row[gt_not_in_excl_mask]
+    x_inst_row = x_inst_row[gt_not_in_excl_mask]
+    y_inst_row = y_inst_row[gt_not_in_excl_mask]
+
+    # points of an instance of an included class
+    x_valid = (x_inst_row > 0) & (x_sem_row >= 0) & (x_sem_row < self.n_classes)
+    x_valid &= self.is_include[x_sem_row.clamp(0, self.n_classes-1)]
+    y_valid = (y_inst_row > 0) & (y_sem_row >= 0) & (y_sem_row < self.n_classes)
+    y_valid &= self.is_include[y_sem_row.clamp(0, self.n_classes-1)]
+
+    # areas of every (class, instance), sorted by class then instance id
+    unique_pred, pred_idx, counts_pred = torch.unique((x_sem_row[x_valid] << 34) | x_inst_row[x_valid], return_inverse=True, return_counts=True)
+    unique_gt, gt_idx, counts_gt = torch.unique((y_sem_row[y_valid] << 34) | y_inst_row[y_valid], return_inverse=True, return_counts=True)
+    cl_pred = unique_pred >> 34
+    cl_gt = unique_gt >> 34
+    x_idx = torch.full_like(x_sem_row, -1)
+    x_idx[x_valid] = pred_idx
+    y_idx = torch.full_like(y_sem_row, -1)
+    y_idx[y_valid] = gt_idx
+
+    # intersections, only between instances of the same class
+    n_pred = max(unique_pred.shape[0], 1)
+    valid_combos = x_valid & y_valid & (x_sem_row == y_sem_row)
+    unique_combo, counts_combo = torch.unique(y_idx[valid_combos] * n_pred + x_idx[valid_combos], return_counts=True)
+    gt_labels = unique_combo // n_pred
+    pred_labels = unique_combo % n_pred
+    intersections = counts_combo
+    unions = counts_gt[gt_labels] + counts_pred[pred_labels] - intersections
+    ious = intersections.double() / unions.double()
+
+    # count the intersections with over 0.5 IoU as TP
+    tp_indexes = ious > 0.5
+    tp_cl = cl_gt[gt_labels[tp_indexes]]
+    self.pan_tp += torch.bincount(tp_cl, minlength=self.n_classes)
+    self.pan_iou.index_add_(0, tp_cl, ious[tp_indexes])
+
+    matched_gt = torch.zeros_like(cl_gt, dtype=torch.bool)
+    matched_gt[gt_labels[tp_indexes]] = True
+    matched_pred = torch.zeros_like(cl_pred, dtype=torch.bool)
+    matched_pred[pred_labels[tp_indexes]] = True
+
+    # count the FN
+    self.pan_fn += torch.bincount(cl_gt[(counts_gt >= self.min_points) & ~matched_gt], minlength=self.n_classes)
+
+    # count the FP
+    self.pan_fp += torch.bincount(cl_pred[(counts_pred >= self.min_points) & ~matched_pred], minlength=self.n_classes)
+
+  def getPQ(self):
+    return self.host().getPQ()
+
+  #############################  Panoptic STUFF ################################
+  ##############################################################################
+
+  def addBatch(self, x_sem, x_inst, y_sem, y_inst):  # x=preds, y=targets
+    ''' Tensors (or numpy arrays) of any shape, one scan
+    '''
+    # add to IoU calculation (for checking purposes)
+    self.addBatchSemIoU(x_sem, y_sem)
+
+    # now do the panoptic stuff
+    self.addBatchPanoptic(x_sem, x_inst, y_sem, y_inst)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Coalesce concurrent requests into micro-batches for a single model instance
+"""
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+_STOP = object()
+
+class MicroBatcher(object):
+    """Collect the items submitted from many threads into batches and run process_fn on every batch in a single
+    worker thread.
+
+    A batch is closed when it holds max_batch_size items or max_delay seconds after its first item was submitted,
+    whichever comes first. Items that waited longer than max_delay (backlog) are batched right away. The queue is
+    bounded: submit raises queue.Full when queue_size items are waiting, the caller should reject the request
+    (backpressure) instead of letting the latency grow. When process_fn raises on a batch, its items are run again
+    one at a time, so that only the futures of the failing items get the exception.
+
+    Arguments:
+        process_fn: list of items -> list of results (same order), run in the worker thread.
+        max_batch_size: An Integer, most items per batch.
+        max_delay: A Float, seconds a batch waits for more items after its first one.
+        queue_size: An Integer, most items waiting for a batch.
+        stats_window: An Integer, number of requests and batches kept for the statistics.
+    """
+    def __init__(self, process_fn, max_batch_size = 4, max_delay = 0.01, queue_size = 16, stats_window = 1000):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.num_failed = 0
+        self.num_batches = 0
+        self.batch_sizes = deque(maxlen = stats_window)
+        self.wait_time = deque(maxlen = stats_window)
+        self.request_time = deque(maxlen = stats_window)
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target = self._run, daemon = True)
+        self._worker.start()
+
+    def submit(self, item):
+        """Queue an item, returns a concurrent.futures.Future of its result. Raises queue.Full when the queue is full."""
+        future = Future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            with self._lock:
+                self.num_rejected += 1
+            raise
+        with self._lock:
+            self.num_requests += 1
+        return future
+
+    def alive(self):
+        return self._worker.is_alive()
+
+    def close(self):
+        """Stop the worker after the items already queued."""
+        self.queue.put(_STOP)
+        self._worker.join()
+
+    def _next_batch(self):
+        first = self.queue.get()
+        if first is _STOP: return None, True
+        batch = [first]
+        deadline = first[2] + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout = timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP: return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._next_batch()
+            if not batch: continue
+            start = time.perf_counter()
+            items = [item for item,_,_ in batch]
+            try:
+                results, errors = self.process_fn(items), [None] * len(batch)
+            except BaseException as exc:
+                if len(batch) == 1:
+                    results, errors = [None], [exc]
+                else:
+                    # one bad item must not fail the others of its batch
+                    results, errors = zip(*[self._process_one(item) for item in items])
+            end = time.perf_counter()
+            with self._lock:
+                self.num_batches += 1
+                self.batch_sizes.append(len(batch))
+                for (_, _, submit_time), error in zip(batch, errors):
+                    if error is None:
+                        self.wait_time.append(start - submit_time)
+                        self.request_time.append(end - submit_time)
+                    else:
+                        self.num_failed += 1
+            for (_, future, _), result, error in zip(batch, results, errors):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    def _process_one(self, item):
+        """(result, None) of a single item, or (None, exception) when it fails."""
+        try:
+            return self.process_fn([item])[0], None
+        except BaseException as exc:
+            return None, exc
+
+    def stats(self):
+        """Request counters, queue depth, mean batch size, and queue wait and request latency (seconds: mean, p50,
+        p95, p99, max) over the last requests."""
+        with self._lock:
+            stats = {'requests': self.num_requests, 'rejected': self.num_rejected, 'failed': self.num_failed,
+                     'batches': self.num_batches, 'queue_depth': self.queue.qsize(),
+                     'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.}
+            for name, times in (('queue_wait', self.wait_time), ('request', self.request_time)):
+                times = np.asarray(times) if times else np.zeros(1)
+                stats[name] = {'mean': float(times.mean()), 'p50': float(np.percentile(times, 50)), 'p95': float(np.percentile(times, 95)),
+                               'p99': float(np.percentile(times, 99)), 'max': float(times.max())}
+        return stats
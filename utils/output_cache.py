@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cache of the network outputs needed by the panoptic post-processing, for post-processing parameter sweeps
+"""
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from network.instance_post_processing import occupied_voxels
+
+class OutputCache(object):
+    """Per scan cache of the network outputs, <cache_dir>/sequences/XX/XXXXXX.npz.
+
+    Only what get_panoptic_segmentation_voxels reads is kept: the occupied voxels with their semantic argmax, the
+    thing class probabilities of the thing voxels, the center heatmap above center_threshold and the offsets of the
+    BEV cells with a thing voxel, plus the point to voxel index and the ground truth labels. Post-processing the
+    cached outputs with a center threshold not lower than center_threshold gives the same labels as the network.
+
+    Arguments:
+        cache_dir: cache root folder.
+        thing_list: thing classes (shifted back to original label idx).
+        center_threshold: A Float, lowest center heatmap threshold of the sweeps.
+    """
+    def __init__(self, cache_dir, thing_list, center_threshold = 0.):
+        self.cache_dir = cache_dir
+        self.thing_list = thing_list
+        self.center_threshold = center_threshold
+
+    def path(self, scan_path):
+        _,dir2 = scan_path.split('/sequences/',1)
+        sequence = dir2.split('/',1)[0]
+        return os.path.join(self.cache_dir, 'sequences', sequence, os.path.splitext(os.path.basename(dir2))[0] + '.npz')
+
+    def write_batch(self, scan_paths, sem, ctr_hmp, offsets, pt_ind, batch_ind, pt_labels, pt_ints):
+        """Cache a batch of scans.
+        Arguments:
+            scan_paths: velodyne file of every scan.
+            sem, ctr_hmp, offsets: network outputs of the batch, [N, C, H, W, Z], [N, 1, H, W] and [N, 2, H, W].
+            pt_ind, batch_ind: voxel index [P, 3] and scan [P] of every point, see common_utils.flatten_grid_ind. Points
+                without a voxel (index -1, culled) are cached with pt_inv -1 and are labelled void.
+            pt_labels, pt_ints: per scan ground truth semantic and instance labels of the points.
+        """
+        batch_size, _, height, width, depth = sem.size()
+        pt_ind = pt_ind.to(sem.device)
+        batch_ind = batch_ind.to(sem.device)
+        vox_ind, pt_inv = occupied_voxels(pt_ind, batch_ind, [height, width, depth])
+        vox_logit = sem.permute(0,2,3,4,1)[vox_ind[:,0], vox_ind[:,1], vox_ind[:,2], vox_ind[:,3]]
+        semantic = torch.argmax(vox_logit, dim=1) + 1
+        thing_vox = semantic <= max(self.thing_list)
+        thing_prob = F.softmax(vox_logit[thing_vox], dim=1)[:, :max(self.thing_list)]
+        thing_bev = torch.zeros((batch_size, height, width), dtype=torch.bool, device=sem.device)
+        thing_bev[vox_ind[:,0][thing_vox], vox_ind[:,1][thing_vox], vox_ind[:,2][thing_vox]] = True
+        thing_cell = torch.nonzero(thing_bev)
+        cell_offset = offsets.permute(0,2,3,1)[thing_cell[:,0], thing_cell[:,1], thing_cell[:,2]]
+        center_cell = torch.nonzero(ctr_hmp[:,0] > self.center_threshold)
+        center_value = ctr_hmp[center_cell[:,0], 0, center_cell[:,1], center_cell[:,2]]
+
+        # one device to host copy per array, then split per scan
+        arrays = {
+            'vox_ind': (vox_ind[:,1:].cpu().numpy().astype(np.int16), vox_ind[:,0]),
+            'semantic': (semantic.cpu().numpy().astype(np.uint8), vox_ind[:,0]),
+            'thing_prob': (thing_prob.float().cpu().numpy(), vox_ind[:,0][thing_vox]),
+            'thing_cell': (thing_cell[:,1:].cpu().numpy().astype(np.int16), thing_cell[:,0]),
+            'cell_offset': (cell_offset.float().cpu().numpy(), thing_cell[:,0]),
+            'center_cell': (center_cell[:,1:].cpu().numpy().astype(np.int16), center_cell[:,0]),
+            'center_value': (center_value.float().cpu().numpy(), center_cell[:,0]),
+        }
+        for name, (array, scan_ind) in arrays.items():
+            split = np.cumsum(torch.bincount(scan_ind, minlength=batch_size).cpu().numpy())[:-1]
+            arrays[name] = np.split(array, split)
+        vox_start = np.concatenate(([0], np.cumsum([a.shape[0] for a in arrays['vox_ind']])))
+        pt_inv = np.split(pt_inv.cpu().numpy(), np.cumsum(torch.bincount(batch_ind, minlength=batch_size).cpu().numpy())[:-1])
+
+        for i, scan_path in enumerate(scan_paths):
+            save_path = self.path(scan_path)
+            os.makedirs(os.path.dirname(save_path), exist_ok = True)
+            scan_arrays = {name: array[i] for name, array in arrays.items()}
+            # written to a temporary file first, a cache file that exists is complete
+            tmp_path = save_path[:-4] + '.tmp.npz'
+            np.savez(tmp_path, grid_size = np.array([height, width, depth]), center_threshold = np.array(self.center_threshold),
+                     pt_inv = np.where(pt_inv[i] >= 0, pt_inv[i] - vox_start[i], -1).astype(np.int32), pt_labels = np.squeeze(pt_labels[i]).astype(np.uint8),
+                     pt_ints = np.squeeze(pt_ints[i]).astype(np.uint32), **scan_arrays)
+            os.replace(tmp_path, save_path)
+
+def load_cached_scan(cache_path, thing_list):
+    """Tensors of a cached scan, in the format of get_panoptic_segmentation_voxels (batch size 1)."""
+    with np.load(cache_path) as data:
+        height, width, _ = data['grid_size'].tolist()
+        center_threshold = float(data['center_threshold'])
+        vox_ind = torch.from_numpy(data['vox_ind'].astype(np.int64))
+        semantic = torch.from_numpy(data['semantic'].astype(np.int64))
+        thing_prob = torch.zeros((semantic.size(0), max(thing_list)), dtype=torch.float32)
+        thing_prob[semantic <= max(thing_list)] = torch.from_numpy(data['thing_prob'])
+        offsets = torch.zeros((1, 2, height, width), dtype=torch.float32)
+        thing_cell = torch.from_numpy(data['thing_cell'].astype(np.int64))
+        offsets[0, :, thing_cell[:,0], thing_cell[:,1]] = torch.from_numpy(data['cell_offset']).t()
+        # cells not cached are below every swept threshold
+        ctr_hmp = torch.full((1, 1, height, width), center_threshold, dtype=torch.float32)
+        center_cell = torch.from_numpy(data['center_cell'].astype(np.int64))
+        ctr_hmp[0, 0, center_cell[:,0], center_cell[:,1]] = torch.from_numpy(data['center_value'])
+        return {
+            'semantic': semantic,
+            'thing_prob': thing_prob,
+            'vox_ind': torch.cat((torch.zeros_like(vox_ind[:,:1]), vox_ind), dim=1),
+            'ctr_hmp': ctr_hmp,
+            'offsets': offsets,
+            'center_threshold': center_threshold,
+            'pt_inv': torch.from_numpy(data['pt_inv'].astype(np.int64)),
+            'pt_labels': data['pt_labels'],
+            'pt_ints': data['pt_ints'],
+        }
+
+def cached_scans(cache_dir):
+    scans = []
+    for dirpath,_,filenames in os.walk(cache_dir):
+        scans += [os.path.join(dirpath, f) for f in filenames if f.endswith('.npz') and not f.endswith('.tmp.npz')]
+    return sorted(scans)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pipelined inference: data loading, forward, post-processing and writing of consecutive batches overlap
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+_STOP = object()
+
+class PipelinedInference(object):
+    """Run inference over a data loader in overlapping stages connected by bounded queues.
+
+    The calling thread takes a batch from the loader and runs forward_fn on it (H2D copy and network forward).
+    A worker thread runs postprocess_fn on the output of the previous batch, in its own CUDA stream, and hands
+    every result to a pool of writer threads running write_fn. The throughput is bounded by the slowest stage
+    instead of the sum of all stages.
+
+    Arguments:
+        forward_fn: batch -> output, run in the calling thread.
+        postprocess_fn: (output, batch) -> list of results, run in the post-processing thread.
+        write_fn: result -> None, run in the writer pool.
+        queue_size: An Integer, number of batches waiting for post-processing, and of results waiting for the
+            writers per writer thread. Bounds the memory held by the pipeline.
+        num_writers: An Integer, number of writer threads.
+    """
+    STAGES = ['load', 'forward', 'postprocess', 'write']
+
+    def __init__(self, forward_fn, postprocess_fn, write_fn, queue_size=2, num_writers=4):
+        self.forward_fn = forward_fn
+        self.postprocess_fn = postprocess_fn
+        self.write_fn = write_fn
+        self.queue_size = queue_size
+        self.num_writers = num_writers
+        self.busy_time = {stage: 0. for stage in self.STAGES}
+        self.wall_time = 0.
+        self.num_batches = 0
+        self._lock = threading.Lock()
+
+    def _add_time(self, stage, start):
+        with self._lock:
+            self.busy_time[stage] += time.perf_counter() - start
+
+    def _write(self, result):
+        start = time.perf_counter()
+        try:
+            self.write_fn(result)
+        finally:
+            self._add_time('write', start)
+            self._write_slots.release()
+
+    def _postprocess_worker(self, work_queue, writers, errors):
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        while True:
+            item = work_queue.get()
+            if item is _STOP: return
+            if errors: continue # drain the queue so that the loader thread is not blocked
+            output, batch, ready = item
+            start = time.perf_counter()
+            try:
+                if stream is not None:
+                    # wait for the forward of this batch only, the next forward keeps running
+                    stream.wait_event(ready)
+                    for tensor in _tensors(output):
+                        tensor.record_stream(stream)
+                    with torch.cuda.stream(stream):
+                        results = self.postprocess_fn(output, batch)
+                else:
+                    results = self.postprocess_fn(output, batch)
+                del output
+                self._add_time('postprocess', start)
+                for result in results:
+                    self._write_slots.acquire()
+                    writers.submit(self._write, result).add_done_callback(_collect_error(errors))
+            except BaseException as exc:
+                errors.append(exc)
+
+    def run(self, loader, progress=None):
+        """Run all batches of loader through the pipeline, returns when every result is written.
+        progress is called once per batch after its forward."""
+        self._write_slots = threading.BoundedSemaphore(self.queue_size * self.num_writers)
+        work_queue = queue.Queue(maxsize=self.queue_size)
+        errors = []
+        run_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.num_writers) as writers:
+            worker = threading.Thread(target=self._postprocess_worker, args=(work_queue, writers, errors), daemon=True)
+            worker.start()
+            try:
+                loader_iter = iter(loader)
+                while not errors:
+                    start = time.perf_counter()
+                    batch = next(loader_iter, _STOP)
+                    self._add_time('load', start)
+                    if batch is _STOP: break
+
+                    start = time.perf_counter()
+                    with torch.no_grad():
+                        output = self.forward_fn(batch)
+                    ready = None
+                    if torch.cuda.is_available():
+                        ready = torch.cuda.Event()
+                        ready.record()
+                    self._add_time('forward', start)
+                    work_queue.put((output, batch, ready))
+                    del output
+                    self.num_batches += 1
+                    if progress is not None: progress()
+            finally:
+                work_queue.put(_STOP)
+                worker.join()
+        self.wall_time += time.perf_counter() - run_start
+        if errors:
+            raise errors[0]
+
+    def stats(self):
+        """Busy time (seconds) and utilization (busy time / wall time) of every stage. The write stage is averaged
+        over the writer threads. The forward time is host side (kernel launches), the device time of the forward
+        shows up in the stage that waits for it, usually post-processing."""
+        threads = {stage: 1 for stage in self.STAGES}
+        threads['write'] = self.num_writers
+        return {stage: {'busy': self.busy_time[stage], 'utilization': self.busy_time[stage] / max(self.wall_time * threads[stage], 1e-9)}
+                for stage in self.STAGES}
+
+    def summary(self):
+        lines = ['%d batches in %.2f seconds' % (self.num_batches, self.wall_time)]
+        for stage, stage_stats in self.stats().items():
+            lines.append('%12s : %8.2f seconds busy, %6.1f%% utilization' % (stage, stage_stats['busy'], stage_stats['utilization']*100))
+        return '\n'.join(lines)
+
+def _tensors(output):
+    if isinstance(output, torch.Tensor):
+        if output.is_cuda: yield output
+    elif isinstance(output, (list, tuple)):
+        for item in output:
+            for tensor in _tensors(item): yield tensor
+
+def _collect_error(errors):
+    def callback(future):
+        if future.exception() is not None:
+            errors.append(future.exception())
+    return callback
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Write panoptic predictions in the original SemanticKITTI label format, one label file per scan or one archive
+per sequence
+"""
+import os
+import threading
+import numpy as np
+
+class PredictionWriter(object):
+    """Write the panoptic prediction of a scan to <output_path>/sequences/XX/predictions/XXXXXX.label.
+
+    The semantic part (lower 16 bits) is mapped back to the original label ids with learning_map_inv in the same
+    pass, the instance part (upper 16 bits) is kept. Every file is written to a temporary file first and renamed,
+    so a label file that exists is always complete and an interrupted run can be resumed with skip_existing.
+
+    Arguments:
+        output_path: output root folder.
+        learning_map_inv: dict, train label -> original label (semantic-kitti.yaml).
+        skip_existing: bool, do not predict and write scans whose label file already exists.
+    """
+    def __init__(self, output_path, learning_map_inv, skip_existing = True):
+        self.output_path = output_path
+        self.skip_existing = skip_existing
+        self.label_lut = np.zeros(max(learning_map_inv.keys())+1, dtype = np.uint32)
+        for train_label, label in learning_map_inv.items():
+            self.label_lut[train_label] = label
+
+    def label_path(self, scan_path):
+        _,dir2 = scan_path.split('/sequences/',1)
+        return self.output_path + '/sequences/' + dir2.replace('velodyne','predictions')[:-3]+'label'
+
+    def remaining(self, scan_paths):
+        """Indices of the scans which still have to be predicted."""
+        if not self.skip_existing:
+            return list(range(len(scan_paths)))
+        return [i for i, scan_path in enumerate(scan_paths) if not os.path.exists(self.label_path(scan_path))]
+
+    def remap(self, panoptic):
+        panoptic = panoptic.astype(np.uint32)
+        return (panoptic & 0xFFFF0000) | self.label_lut[panoptic & 0xFFFF]
+
+    def write(self, scan_path, panoptic):
+        save_path = self.label_path(scan_path)
+        os.makedirs(os.path.dirname(save_path), exist_ok = True)
+        # unique temporary name, the writer may run in several threads and processes
+        tmp_path = '%s.%d.%d.tmp' % (save_path, os.getpid(), id(panoptic))
+        try:
+            self.remap(panoptic).tofile(tmp_path)
+            os.replace(tmp_path, save_path)
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+
+    def close(self):
+        pass
+
+class PredictionArchiveWriter(PredictionWriter):
+    """Append the predictions of every sequence to a single archive instead of one label file per scan.
+
+    <output_path>/sequences/XX/predictions<suffix>.bin holds the concatenated uint32 labels (original label format)
+    and predictions<suffix>.idx one "<scan> <offset> <number of points>" line per scan, offsets in labels. The index
+    line is appended after the data is flushed, so only complete scans are indexed; data after the last indexed
+    scan (interrupted run) is truncated when the archive is opened again. Use a different suffix for every process
+    writing to the same output_path. export_predictions.py expands an archive to the per-file layout.
+    """
+    def __init__(self, output_path, learning_map_inv, skip_existing = True, suffix = ''):
+        super(PredictionArchiveWriter, self).__init__(output_path, learning_map_inv, skip_existing)
+        self.suffix = suffix
+        self._archives = {}
+        self._lock = threading.Lock()
+
+    def archive_path(self, sequence):
+        return os.path.join(self.output_path, 'sequences', sequence, 'predictions' + self.suffix)
+
+    def remaining(self, scan_paths):
+        if not self.skip_existing:
+            return list(range(len(scan_paths)))
+        indexed = {}
+        remaining = []
+        for i, scan_path in enumerate(scan_paths):
+            sequence, scan = split_scan_path(scan_path)
+            if sequence not in indexed:
+                indexed[sequence] = read_archive_index(os.path.join(self.output_path, 'sequences', sequence))
+            if scan not in indexed[sequence]:
+                remaining.append(i)
+        return remaining
+
+    def remove_archives(self, scan_paths):
+        """Delete the archives of every suffix in the sequences of scan_paths. read_archive_index merges all archives of
+        a sequence, so before predicting everything again, the archives of an earlier run (possibly written with other
+        suffixes, e.g. by another number of processes) have to go. Call it in one process, before any of them writes."""
+        for sequence in sorted(set(split_scan_path(scan_path)[0] for scan_path in scan_paths)):
+            sequence_dir = os.path.join(self.output_path, 'sequences', sequence)
+            for file_name in os.listdir(sequence_dir) if os.path.isdir(sequence_dir) else []:
+                if file_name.startswith('predictions') and os.path.splitext(file_name)[1] in ('.idx', '.bin', '.tmp'):
+                    os.remove(os.path.join(sequence_dir, file_name))
+
+    def _open(self, sequence):
+        with self._lock:
+            if sequence not in self._archives:
+                path = self.archive_path(sequence)
+                os.makedirs(os.path.dirname(path), exist_ok = True)
+                index = _read_index_file(path + '.idx') if self.skip_existing else {}
+                end = max([offset + count for offset, count in index.values()], default = 0)
+                # drop the incomplete tail of an interrupted run. The rebuilt index replaces the old one atomically
+                # before the data is truncated, a crash in between never loses indexed scans
+                with open(path + '.idx.tmp', 'w') as tmp_file:
+                    for scan, (offset, count) in index.items():
+                        tmp_file.write('%s %d %d\n' % (scan, offset, count))
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+                os.replace(path + '.idx.tmp', path + '.idx')
+                index_file = open(path + '.idx', 'a')
+                data_file = open(path + '.bin', 'ab')
+                data_file.truncate(end * 4)
+                self._archives[sequence] = (threading.Lock(), data_file, index_file)
+            return self._archives[sequence]
+
+    def write(self, scan_path, panoptic):
+        sequence, scan = split_scan_path(scan_path)
+        panoptic = self.remap(panoptic)
+        lock, data_file, index_file = self._open(sequence)
+        with lock:
+            offset = data_file.seek(0, os.SEEK_END) // 4
+            data_file.write(panoptic.tobytes())
+            data_file.flush()
+            index_file.write('%s %d %d\n' % (scan, offset, panoptic.size))
+            index_file.flush()
+
+    def close(self):
+        with self._lock:
+            for _, data_file, index_file in self._archives.values():
+                data_file.close()
+                index_file.close()
+            self._archives = {}
+
+def split_scan_path(scan_path):
+    """'.../sequences/08/velodyne/000123.bin' -> ('08', '000123')"""
+    _,dir2 = scan_path.split('/sequences/',1)
+    sequence = dir2.split('/',1)[0]
+    return sequence, os.path.splitext(os.path.basename(dir2))[0]
+
+def _read_index_file(index_path):
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                # an incomplete last line is ignored
+                if len(fields) == 3 and line.endswith('\n'):
+                    index[fields[0]] = (int(fields[1]), int(fields[2]))
+    return index
+
+def read_archive_index(sequence_dir):
+    """Index of every prediction archive in sequence_dir: scan -> (archive data file, offset, number of points)."""
+    index = {}
+    for file_name in sorted(os.listdir(sequence_dir)) if os.path.isdir(sequence_dir) else []:
+        if file_name.startswith('predictions') and file_name.endswith('.idx'):
+            data_path = os.path.join(sequence_dir, file_name[:-4] + '.bin')
+            for scan, (offset, count) in _read_index_file(os.path.join(sequence_dir, file_name)).items():
+                index[scan] = (data_path, offset, count)
+    return index
+
+def read_archive(sequence_dir):
+    """Yield (scan, labels) of every scan archived in sequence_dir, labels are read from a memory map."""
+    index = read_archive_index(sequence_dir)
+    data = {}
+    for scan in sorted(index):
+        data_path, offset, count = index[scan]
+        if data_path not in data:
+            data[data_path] = np.memmap(data_path, dtype = np.uint32, mode = 'r')
+        yield scan, np.asarray(data[data_path][offset:offset+count])
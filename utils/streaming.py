@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming inference: one raw scan in, per point panoptic labels out, with steady per frame latency
+"""
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import torch
+
+from dataloader.dataset import polar_voxelize
+from network.instance_post_processing import get_panoptic_segmentation_points
+
+class StreamingInference(object):
+    """Panoptic inference of a stream of raw scans, one scan at a time.
+
+    Every scan ([P, 4] float32 x, y, z, remission, as in the velodyne .bin files) goes through the polar
+    voxelization of spherical_dataset (without labels), the network and the panoptic post-processing. The host
+    and device input buffers are allocated once (pinned on the host) and only grow when a scan has more points
+    than any scan before. The returned labels are in the training label space (semantic id 1-19 in the lower 16
+    bits, see PredictionWriter.remap for the original label format).
+
+    The latency of every frame is recorded per stage (host voxelization, network forward, post-processing and
+    total) over the last stats_window frames, see stats and summary. infer_batch runs up to max_batch_size scans
+    in one forward (micro-batches of a server), its latency is recorded once per batch.
+
+    With reuse_tolerance set, a frame-change detector skips the network on a stationary sensor. The signature of a
+    scan is its BEV occupancy on the polar grid. When it differs from the signature of the last processed frame
+    in at most reuse_tolerance of the occupied cells, the labels of that frame are gathered at the voxels of the
+    new points instead. Points in voxels that were empty in that frame get its semantic argmax without an instance.
+    At most reuse_max_frames frames in a row reuse the same outputs. Single scan calls (infer) only.
+
+    Arguments:
+        model: ptBEVnet, moved to device and set to eval mode.
+        grid_size: polar grid size (rho, phi, z).
+        thing_list: thing classes (shifted back to original label idx).
+        post_proc: dict with threshold, nms_kernel, top_k and group_bucket_size (model: post_proc in the config).
+        visibility: bool, the model takes the visibility feature.
+        polar: bool, circular padding of the angle axis in the post-processing.
+        max_points: An Integer, points per scan of the buffers allocated up front (and of the warmup scans).
+        max_batch_size: An Integer, most scans per infer_batch call.
+        stats_window: An Integer, number of frames kept for the latency statistics.
+        reuse_tolerance: A Float, changed fraction of the occupied BEV cells under which the previous outputs are
+            reused, None disables the frame-change detector.
+        reuse_max_frames: An Integer, most frames in a row reusing the same outputs.
+    """
+    STAGES = ['voxelize', 'forward', 'postprocess', 'total']
+
+    def __init__(self, model, grid_size, thing_list, post_proc, visibility = True, polar = True, device = 'cuda',
+                 max_volume_space = [50,np.pi,1.5], min_volume_space = [3,-np.pi,-3], max_points = 150000, max_batch_size = 1,
+                 stats_window = 1000, reuse_tolerance = None, reuse_max_frames = 10):
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.grid_size = np.asarray(grid_size)
+        self.thing_list = thing_list
+        self.post_proc = post_proc
+        self.visibility = visibility
+        self.polar = polar
+        self.max_volume_space = max_volume_space
+        self.min_volume_space = min_volume_space
+        self.use_cuda = self.device.type == 'cuda'
+        self.num_frames = 0
+        self.num_reused = 0
+        self.latency = {stage: deque(maxlen = stats_window) for stage in self.STAGES}
+        # the statistics are read from other threads (inference_server.py /metrics) while frames are recorded
+        self._stats_lock = threading.Lock()
+        self.reuse_tolerance = reuse_tolerance
+        self.reuse_max_frames = reuse_max_frames
+        self.ref_label = None
+        self.reset_reference()
+
+        self.capacity = 0
+        self.fea_dim = None
+        self.max_points = max_points
+        self.max_batch_size = max_batch_size
+        vox_shape = (max_batch_size, int(self.grid_size[2]), int(self.grid_size[0]), int(self.grid_size[1]))
+        self.host_vox = self._host_buffer(vox_shape, torch.float32)
+        self.dev_vox = torch.empty(vox_shape, dtype = torch.float32, device = self.device)
+
+    def _host_buffer(self, shape, dtype):
+        buffer = torch.empty(shape, dtype = dtype)
+        return buffer.pin_memory() if self.use_cuda else buffer
+
+    def _reserve(self, num_points, fea_dim):
+        """Grow the point buffers to hold num_points points."""
+        if num_points <= self.capacity and fea_dim == self.fea_dim: return
+        capacity = max(num_points, self.max_points * self.max_batch_size, int(self.capacity * 1.25))
+        self.host_fea = self._host_buffer((capacity, fea_dim), torch.float32)
+        self.host_ind = self._host_buffer((capacity, 3), torch.int64)
+        self.host_batch = self._host_buffer((capacity,), torch.int64)
+        self.host_out = self._host_buffer((capacity,), torch.int64)
+        self.dev_fea = torch.empty((capacity, fea_dim), dtype = torch.float32, device = self.device)
+        self.dev_ind = torch.empty((capacity, 3), dtype = torch.int64, device = self.device)
+        self.dev_batch = torch.empty((capacity,), dtype = torch.int64, device = self.device)
+        self.capacity = capacity
+        self.fea_dim = fea_dim
+
+    def voxelize(self, scans):
+        """Polar voxelization of raw scans into the host buffers, returns the number of points of every scan. Raises
+        ValueError for scans without points or with NaN or infinite values."""
+        if len(scans) > self.max_batch_size:
+            raise ValueError('%d scans in a batch, max_batch_size is %d' % (len(scans), self.max_batch_size))
+        voxelized = []
+        for scan in scans:
+            scan = np.asarray(scan, dtype = np.float32).reshape(-1, 4)
+            if scan.shape[0] == 0:
+                raise ValueError('the scan has no points')
+            if not np.isfinite(scan).all():
+                raise ValueError('the scan has NaN or infinite values')
+            voxelized.append(polar_voxelize(scan[:,:3], scan[:,3:], self.grid_size, self.max_volume_space, self.min_volume_space))
+        counts = [grid_ind.shape[0] for grid_ind,_,_,_,_ in voxelized]
+        self._reserve(sum(counts), voxelized[0][1].shape[1])
+        start = 0
+        for i, (grid_ind,return_fea,distance_feature,_,_) in enumerate(voxelized):
+            end = start + counts[i]
+            self.host_fea[start:end].numpy()[...] = return_fea
+            self.host_ind[start:end].numpy()[...] = grid_ind
+            self.host_batch[start:end] = i
+            self.host_vox[i].numpy()[...] = distance_feature
+            start = end
+        return counts
+
+    def forward(self, counts):
+        """Network forward on the scans in the host buffers, returns the semantic, center and offset outputs."""
+        num_points = sum(counts)
+        pt_fea = self.dev_fea[:num_points].copy_(self.host_fea[:num_points], non_blocking = True)
+        pt_ind = self.dev_ind[:num_points].copy_(self.host_ind[:num_points], non_blocking = True)
+        pt_fea = list(torch.split(pt_fea, counts))
+        grid_ind = list(torch.split(pt_ind[:,:2], counts))
+        if self.visibility:
+            vox_fea = self.dev_vox[:len(counts)].copy_(self.host_vox[:len(counts)], non_blocking = True)
+            return self.model(pt_fea, grid_ind, vox_fea)
+        else:
+            return self.model(pt_fea, grid_ind)
+
+    def postprocess(self, output, counts):
+        """Panoptic labels of the points from the network outputs."""
+        num_points = sum(counts)
+        sem, ctr_hmp, offsets = output
+        batch_ind = self.dev_batch[:num_points].copy_(self.host_batch[:num_points], non_blocking = True)
+        panoptic,_,_ = get_panoptic_segmentation_points(sem, ctr_hmp, offsets, self.dev_ind[:num_points], batch_ind,
+                                                        self.thing_list, threshold = self.post_proc['threshold'],
+                                                        nms_kernel = self.post_proc['nms_kernel'], top_k = self.post_proc['top_k'],
+                                                        polar = self.polar, group_bucket_size = self.post_proc['group_bucket_size'])
+        return panoptic
+
+    def reset_reference(self):
+        """Forget the last processed frame, the next frame runs the network (e.g. at the start of a new sequence)."""
+        self.ref_signature = None
+        self.reused_frames = 0
+
+    def _stationary(self, counts):
+        """Whether the scan in the host buffers is within reuse_tolerance of the last processed frame."""
+        if self.reuse_tolerance is None or len(counts) != 1:
+            return False
+        grid_ind = self.host_ind[:counts[0]].numpy()
+        signature = np.zeros(int(self.grid_size[0]) * int(self.grid_size[1]), dtype = bool)
+        signature[grid_ind[:,0] * int(self.grid_size[1]) + grid_ind[:,1]] = True
+        if self.ref_signature is not None and self.reused_frames < self.reuse_max_frames:
+            changed = np.count_nonzero(signature != self.ref_signature) / max(np.count_nonzero(signature | self.ref_signature), 1)
+            if changed <= self.reuse_tolerance:
+                self.reused_frames += 1
+                return True
+        self.ref_signature = signature
+        self.reused_frames = 0
+        return False
+
+    def _set_reference(self, sem, panoptic, num_points):
+        """Keep the labels of a processed frame as a dense voxel volume for the following stationary frames."""
+        if self.ref_label is None:
+            self.ref_label = torch.empty(tuple(self.grid_size), dtype = torch.int64, device = self.device)
+        pt_ind = self.dev_ind[:num_points]
+        self.ref_label.fill_(-1)
+        self.ref_label[pt_ind[:,0], pt_ind[:,1], pt_ind[:,2]] = panoptic
+        self.ref_semantic = torch.argmax(sem[0], dim = 0) + 1
+
+    def gather(self, num_points):
+        """Panoptic labels of the points of a stationary frame from the last processed frame."""
+        pt_ind = self.dev_ind[:num_points].copy_(self.host_ind[:num_points], non_blocking = True)
+        panoptic = self.ref_label[pt_ind[:,0], pt_ind[:,1], pt_ind[:,2]]
+        return torch.where(panoptic >= 0, panoptic, self.ref_semantic[pt_ind[:,0], pt_ind[:,1], pt_ind[:,2]])
+
+    def _mark(self):
+        if self.use_cuda:
+            event = torch.cuda.Event(enable_timing = True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def _elapsed(self, start, end):
+        return start.elapsed_time(end) / 1000. if self.use_cuda else end - start
+
+    def infer_batch(self, scans):
+        """Panoptic labels of a list of raw [P, 4] scans in one forward, a list of uint32 arrays of shape [P]."""
+        start = time.perf_counter()
+        counts = self.voxelize(scans)
+        voxelize_time = time.perf_counter() - start
+        reuse = self._stationary(counts)
+        with torch.no_grad():
+            marks = [self._mark()]
+            if reuse:
+                # stationary frame, no forward
+                marks.append(self._mark())
+                panoptic = self.gather(counts[0])
+                self.num_reused += 1
+            else:
+                output = self.forward(counts)
+                marks.append(self._mark())
+                panoptic = self.postprocess(output, counts)
+                if self.reuse_tolerance is not None and len(counts) == 1:
+                    self._set_reference(output[0], panoptic, counts[0])
+            panoptic = self.host_out[:sum(counts)].copy_(panoptic, non_blocking = True)
+            marks.append(self._mark())
+            if self.use_cuda:
+                marks[-1].synchronize()
+        forward_time = self._elapsed(marks[0], marks[1])
+        postprocess_time = self._elapsed(marks[1], marks[2])
+        # the host buffer is reused by the next frame
+        panoptic = np.split(panoptic.numpy().astype(np.uint32), np.cumsum(counts)[:-1])
+        with self._stats_lock:
+            self.num_frames += len(scans)
+            for stage, stage_time in zip(self.STAGES, (voxelize_time, forward_time, postprocess_time, time.perf_counter() - start)):
+                self.latency[stage].append(stage_time)
+        return panoptic
+
+    def infer(self, scan):
+        """Panoptic label of every point of a raw [P, 4] scan, a uint32 array of shape [P]."""
+        return self.infer_batch([scan])[0]
+
+    def run(self, source):
+        """Yield the panoptic labels of every scan of source, an iterable of scans or a queue.Queue ended by None."""
+        if isinstance(source, queue.Queue):
+            source = _queue_items(source)
+        for scan in source:
+            yield self.infer(scan)
+
+    def warmup(self, iters = 5, scan = None):
+        """Run iters frames (scan, or a random scan of max_points points, also as a full batch) so that the CUDA context, the kernels and
+        the allocator cache are set up before the first real frame. The latency statistics are reset."""
+        if scan is None:
+            rng = np.random.default_rng(0)
+            rho = rng.uniform(self.min_volume_space[0], self.max_volume_space[0], self.max_points)
+            phi = rng.uniform(-np.pi, np.pi, self.max_points)
+            z = rng.uniform(self.min_volume_space[2], self.max_volume_space[2], self.max_points)
+            scan = np.stack((rho*np.cos(phi), rho*np.sin(phi), z, rng.random(self.max_points)), axis = 1).astype(np.float32)
+        reuse_tolerance, self.reuse_tolerance = self.reuse_tolerance, None
+        for _ in range(iters):
+            for batch_size in sorted({1, self.max_batch_size}):
+                self.infer_batch([scan] * batch_size)
+        self.reuse_tolerance = reuse_tolerance
+        self.reset_reference()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.num_frames = 0
+            self.num_reused = 0
+            for stage in self.STAGES:
+                self.latency[stage].clear()
+
+    def stats(self):
+        """Latency (seconds) of every stage over the recorded frames: mean, median, 95th and 99th percentile, max."""
+        with self._stats_lock:
+            latency = {stage: list(self.latency[stage]) for stage in self.STAGES}
+        stats = {}
+        for stage in self.STAGES:
+            times = np.asarray(latency[stage]) if latency[stage] else np.zeros(1)
+            stats[stage] = {'mean': times.mean(), 'p50': np.percentile(times, 50), 'p95': np.percentile(times, 95),
+                            'p99': np.percentile(times, 99), 'max': times.max()}
+        return stats
+
+    def summary(self):
+        lines = ['%d frames, latency in ms (last %d calls)' % (self.num_frames, len(self.latency['total']))]
+        if self.reuse_tolerance is not None:
+            lines[0] += ', %d stationary frames reused the previous outputs' % self.num_reused
+        lines.append('%12s : %8s %8s %8s %8s %8s' % ('stage', 'mean', 'p50', 'p95', 'p99', 'max'))
+        for stage, stage_stats in self.stats().items():
+            lines.append('%12s : %8.2f %8.2f %8.2f %8.2f %8.2f' % ((stage,) + tuple(stage_stats[k]*1000 for k in ('mean', 'p50', 'p95', 'p99', 'max'))))
+        return '\n'.join(lines)
+
+def _queue_items(scan_queue):
+    while True:
+        scan = scan_queue.get()
+        if scan is None: return
+        yield scan
+
+def build_model(args_dict, device = 'cuda'):
+    """ptBEVnet of a config (test_pretrain.py settings) with the weights of model: pretrained_model, in eval mode."""
+    from network.BEV_Unet import BEV_Unet
+    from network.ptBEV import ptBEVnet
+    grid_size = args_dict['dataset']['grid_size']
+    compression_model = grid_size[2]
+    polar = args_dict['model']['polar']
+    my_BEV_model = BEV_Unet(n_class=19, n_height = compression_model, input_batch_norm = True, dropout = 0.5, circular_padding = polar,
+                            use_vis_fea = args_dict['model']['visibility'])
+    my_model = ptBEVnet(my_BEV_model, pt_model = 'pointnet', grid_size = grid_size, fea_dim = 9 if polar else 7, max_pt_per_encode = 256,
+                        out_pt_fea_dim = 512, kernal_size = 1, pt_selection = 'random', fea_compre = compression_model)
+    pretrained_model = args_dict['model']['pretrained_model']
+    if os.path.exists(pretrained_model):
+        my_model.load_state_dict(torch.load(pretrained_model, map_location = torch.device(device)))
+    else:
+        print('%s not found, the model is randomly initialized' % pretrained_model)
+    return my_model.to(device).eval()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched test time augmentation on the polar BEV grid
+"""
+import numpy as np
+import torch
+
+from dataloader.dataset import polar_voxelize, downsample_points
+
+class PolarTTA(object):
+    """Test time augmentation with yaw rotations and a mirror (y -> -y), fused on the polar BEV grid.
+
+    The angle axis of the polar grid has grid_size[1] bins, 2*pi is covered by the first grid_size[1]-1 of them.
+    A yaw rotation by a whole number of bins is a cyclic shift of these columns and the mirror reverses them, so
+    every transform is undone exactly on the network outputs. Rotations are snapped to whole bins. A flip of x
+    (or of x and y) as in the training flip_aug is the mirror combined with a half turn rotation.
+
+    All augmented copies of a scan are run in one batch: copy t of scan i is row i * len(transforms) + t. The
+    outputs are mapped back to the original frame and averaged (semantic logits, center heatmap and offsets),
+    the post-processing then runs on the fused outputs with the voxel index of the original scan.
+
+    Arguments:
+        grid_size: polar grid size (rho, phi, z).
+        rotations: yaw rotations in degrees. The identity is always the first transform.
+        flip: bool, add the mirrored copy of every rotation.
+        downsample_sub_cells: sub-cells of the input downsampling of the copies (see downsample_points), None keeps
+            every point.
+    """
+    def __init__(self, grid_size, rotations = (0,), flip = False, max_volume_space = [50,np.pi,1.5], min_volume_space = [3,-np.pi,-3],
+                 downsample_sub_cells = None):
+        self.grid_size = np.asarray(grid_size)
+        self.downsample_sub_cells = downsample_sub_cells
+        self.max_volume_space = max_volume_space
+        self.min_volume_space = min_volume_space
+        self.period = int(self.grid_size[1]) - 1
+        self.phi_interval = (max_volume_space[1] - min_volume_space[1]) / self.period
+        shifts = [0] + [int(round(np.deg2rad(r) / self.phi_interval)) % self.period for r in rotations]
+        shifts = sorted(set(shifts), key = shifts.index)
+        self.transforms = [(shift, mirror) for mirror in ([False, True] if flip else [False]) for shift in shifts]
+
+        # phi index of every output column in every augmented frame
+        column = np.arange(self.grid_size[1])
+        phi_index = []
+        for shift, mirror in self.transforms:
+            index = column.copy()
+            index[:self.period] = ((self.period - 1 - column[:self.period]) if mirror else column[:self.period]) + shift
+            index[:self.period] %= self.period
+            phi_index.append(index)
+        self.phi_index = torch.from_numpy(np.stack(phi_index))
+
+    def __len__(self):
+        return len(self.transforms)
+
+    def augment(self, xyz, feat):
+        """Voxelized copies of a scan, (distance_feature, grid_ind, return_fea) of every transform but the identity."""
+        copies = []
+        for shift, mirror in self.transforms[1:]:
+            aug_xyz = xyz.copy()
+            if mirror:
+                aug_xyz[:,1] = -aug_xyz[:,1]
+            rotate_rad = shift * self.phi_interval
+            c, s = np.cos(rotate_rad), np.sin(rotate_rad)
+            aug_xyz[:,0], aug_xyz[:,1] = c*aug_xyz[:,0] - s*aug_xyz[:,1], s*aug_xyz[:,0] + c*aug_xyz[:,1]
+            grid_ind,return_fea,distance_feature,_,intervals = polar_voxelize(aug_xyz, feat, self.grid_size, self.max_volume_space,
+                                                                              self.min_volume_space)
+            if self.downsample_sub_cells is not None:
+                grid_ind,return_fea = downsample_points(grid_ind, return_fea, self.grid_size, intervals, self.downsample_sub_cells)
+            copies.append((distance_feature, grid_ind, return_fea))
+        return copies
+
+    def batch(self, vox_fea, grid_ind, pt_fea, copies):
+        """Network inputs of the augmented batch from a collate_fn_BEV batch, copies is its last element."""
+        aug_vox_fea, aug_grid_ind, aug_pt_fea = [], [], []
+        for i in range(len(grid_ind)):
+            aug_vox_fea += [vox_fea[i]] + [torch.from_numpy(c[0].astype(np.float32)) for c in copies[i]]
+            aug_grid_ind += [grid_ind[i]] + [c[1] for c in copies[i]]
+            aug_pt_fea += [pt_fea[i]] + [c[2] for c in copies[i]]
+        return torch.stack(aug_vox_fea), aug_grid_ind, aug_pt_fea
+
+    def fuse(self, sem, ctr_hmp, offsets):
+        """Map the outputs of the augmented batch back to the original frame and average the copies of every scan.
+        Arguments:
+            sem: [N*T, C, H, W, Z] semantic logits, ctr_hmp: [N*T, 1, H, W], offsets: [N*T, 2, H, W].
+        Returns:
+            The fused outputs, [N, C, H, W, Z], [N, 1, H, W] and [N, 2, H, W].
+        """
+        num_transforms = len(self.transforms)
+        phi_index = self.phi_index.to(sem.device)
+        sign = torch.tensor([-1. if mirror else 1. for _, mirror in self.transforms], device=sem.device)
+        fused = []
+        for output, dim in ((sem, 3), (ctr_hmp, 3), (offsets, 3)):
+            output = output.view((-1, num_transforms) + output.shape[1:])
+            index_shape = [1] * output.dim()
+            index_shape[1] = num_transforms
+            index_shape[dim + 1] = output.size(dim + 1)
+            index = phi_index.view(index_shape).expand(output.shape)
+            fused.append(torch.gather(output, dim + 1, index))
+        sem, ctr_hmp, offsets = fused
+        # the phi offset changes sign in the mirrored copies
+        offsets = torch.stack((offsets[:,:,0], offsets[:,:,1] * sign.view(1, -1, 1, 1)), dim=2)
+        return sem.mean(1), ctr_hmp.mean(1), offsets.mean(1)